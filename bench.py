@@ -0,0 +1,343 @@
+"""Benchmark suite for the cookbook's search, render and write hot paths.
+
+Generates a synthetic cookbook of the requested size (cached between runs
+in --cache-dir), times each hot path and prints the results as JSON.
+Results can be saved as a baseline and later runs compared against it:
+
+    python bench.py --size 1000 --save baseline.json
+    python bench.py --size 1000 --compare baseline.json
+
+With --compare, the exit status is 1 if any benchmark's median is slower
+than the baseline by more than --tolerance.
+
+The startup benchmarks run the command line tools in fresh interpreters:
+import_cli and import_main are the times python -X importtime reports for
+importing cli.py and main.py, and startup_cli_show the wall time of a
+whole `cli.py show` run.
+"""
+import argparse
+import compileall
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from database import configure_database
+from import_recipes import import_recipes
+from recipes import *
+
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+INGREDIENT_NAMES = (
+    'salt', 'black pepper', 'olive oil', 'butter', 'garlic', 'onion', 'sugar',
+    'all-purpose flour', 'eggs', 'milk', 'water', 'red onion', 'tomatoes',
+    'lemon juice', 'cumin', 'paprika', 'chicken breast', 'ground beef',
+    'black beans', 'rice', 'parsley', 'cilantro', 'basil', 'oregano',
+    'soy sauce', 'ginger', 'carrots', 'celery', 'potatoes', 'heavy cream',
+    'parmesan cheese', 'cheddar cheese', 'baking soda', 'baking powder',
+    'vanilla extract', 'cinnamon', 'honey', 'brown sugar', 'spinach',
+    'broccoli', 'bell pepper', 'jalapeno', 'lime', 'tortillas', 'bread',
+    'garlic salt', 'chili powder', 'vegetable broth', 'chicken broth', 'mushrooms',
+)
+UNITS = ('tsp', 'Tbsp', 'cup', 'cups', 'oz', 'lb', 'g', 'slices', 'whole', 'pinch')
+PREPS = ('', '', '', 'chopped', 'minced', 'diced', 'sliced', 'to taste', 'divided')
+
+
+def ingredient_vocabulary(size=2000):
+    """Common ingredient names followed by rarer generated variations."""
+    names = list(INGREDIENT_NAMES)
+    for i in range(size - len(names)):
+        names.append(f'{INGREDIENT_NAMES[i % len(INGREDIENT_NAMES)]} variety {i}')
+    return names
+
+
+def synthetic_recipes(count, seed=0):
+    """Yields JSON Lines for count recipes. Ingredient popularity follows
+    a Zipf-like curve, like real cookbooks where salt is everywhere.
+    """
+    rng = random.Random(seed)
+    vocabulary = ingredient_vocabulary()
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    for recipe_number in range(count):
+        names = set(rng.choices(vocabulary, weights, k=rng.randint(4, 16)))
+        ingredients = [{
+            'ingredient_name': name,
+            'ingredient_amount': rng.choice(('1', '2', '1/2', '1 1/2', '3', '')),
+            'ingredient_units': rng.choice(UNITS),
+            'optional': rng.random() < 0.1,
+            'prep': rng.choice(PREPS),
+        } for name in names]
+        yield json.dumps({
+            'name': f'recipe {recipe_number}',
+            'ingredient_list': ingredients,
+            'prep_time': f'{rng.randint(1, 6) * 5} mins',
+            'cook_time': f'{rng.randint(1, 12) * 5} mins',
+            'instructions': ' '.join(rng.choices(vocabulary[:50], k=40)),
+        })
+
+
+def cookbook_path(size, cache_dir, seed=0):
+    """Returns the path of a synthetic cookbook, generating it if needed."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'cookbook-{size}-{seed}.db')
+    if not os.path.exists(path):
+        building = path + '.building'
+        configure_database(building)
+        Recipe.initialize()
+        import_recipes(synthetic_recipes(size, seed), batch_size=2000)
+        db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE);')
+        db.close()
+        os.replace(building, path)
+    return path
+
+
+def time_calls(function, arguments, min_seconds=0.5, max_calls=10000):
+    """Calls function once per argument until min_seconds have passed.
+    Returns a dict of call count and timing statistics in microseconds.
+    """
+    timings = []
+    deadline = time.perf_counter() + min_seconds
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        timings.append(time.perf_counter() - start)
+        if len(timings) >= max_calls or time.perf_counter() > deadline:
+            break
+    return summarize(timings)
+
+
+def summarize(timings):
+    """Returns a dict of call count and timing statistics in microseconds
+    for a list of timings in seconds."""
+    return {
+        'calls': len(timings),
+        'median_us': round(statistics.median(timings) * 1e6, 2),
+        'min_us': round(min(timings) * 1e6, 2),
+        'mean_us': round(statistics.fmean(timings) * 1e6, 2),
+    }
+
+
+def random_ids(size, seed=1):
+    rng = random.Random(seed)
+    while True:
+        yield rng.randint(1, size)
+
+
+def scripted_input(answers):
+    """Patches input() to return answers in order."""
+    answers = iter(answers)
+    return mock.patch('builtins.input', lambda *args: next(answers))
+
+
+def bench_search(size):
+    rng = random.Random(2)
+    vocabulary = ingredient_vocabulary()[:200]
+    queries = (rng.choice(vocabulary) for _ in itertools.count())
+    return time_calls(Recipe.view_recipes, queries)
+
+
+def bench_render(size):
+    # A small working set, like a menu redrawing the same few recipes.
+    def render(recipe_id):
+        Recipe.print_ingredients(recipe=Recipe.get_cached(recipe_id)[0])
+    return time_calls(render, itertools.cycle(range(1, min(size, 100) + 1)))
+
+
+def bench_render_uncached(size):
+    def render(recipe_id):
+        Recipe.get_recipe_cache().clear()
+        Recipe.print_ingredients(recipe=Recipe.get_by_id(recipe_id))
+    return time_calls(render, random_ids(size))
+
+
+def bench_select_by_id(size):
+    def select(recipe_id):
+        with scripted_input([str(recipe_id)]):
+            Recipe.select_recipe()
+    return time_calls(select, random_ids(size))
+
+
+def bench_select_by_name(size):
+    def select(recipe_id):
+        with scripted_input([f'recipe {recipe_id - 1}']):
+            Recipe.select_recipe()
+    return time_calls(select, random_ids(size))
+
+
+def bench_similar(size):
+    RecipeSignature.build_missing()
+    return time_calls(RecipeService.similar_recipes, random_ids(size))
+
+
+def bench_add_ingredient(size):
+    def add(recipe_id):
+        session = RecipeEditSession(Recipe.get_by_id(recipe_id))
+        with scripted_input(['nutmeg', 'pinch', '1', '', 'n', 'y']):
+            Recipe.add_ingredient(session=session)
+        session.commit()
+    return time_calls(add, random_ids(size), max_calls=500)
+
+
+def bench_bulk_insert(size, count=2000):
+    workdir = tempfile.mkdtemp()
+    try:
+        configure_database(os.path.join(workdir, 'insert.db'))
+        Recipe.initialize()
+        start = time.perf_counter()
+        import_recipes(synthetic_recipes(count, seed=99), batch_size=500)
+        seconds = time.perf_counter() - start
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        'calls': count,
+        'median_us': round(seconds / count * 1e6, 2),
+        'min_us': round(seconds / count * 1e6, 2),
+        'mean_us': round(seconds / count * 1e6, 2),
+    }
+
+
+def import_time(module):
+    """Returns the seconds a fresh interpreter takes to import module and
+    everything it imports, as reported by python -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=HERE, capture_output=True, text=True, check=True)
+    # Lines are 'import time: self | cumulative | name', with the name
+    # indented by how deeply it was imported.
+    for line in reversed(result.stderr.splitlines()):
+        _, cumulative, name = line.split('|')
+        if name == f' {module}':
+            return int(cumulative) / 1e6
+    raise ValueError(f'python -X importtime did not report {module}')
+
+
+def compile_sources():
+    """Writes bytecode for the cookbook's modules, as the first run after
+    an install or edit does, so startup is not timed recompiling them."""
+    compileall.compile_dir(HERE, maxlevels=0, quiet=1)
+
+
+def bench_import_cli(size, runs=10):
+    compile_sources()
+    return summarize([import_time('cli') for _ in range(runs)])
+
+
+def bench_import_main(size, runs=10):
+    compile_sources()
+    return summarize([import_time('main') for _ in range(runs)])
+
+
+def bench_startup_cli_show(size):
+    compile_sources()
+    command = [sys.executable, 'cli.py', '--db', db.obj.database, 'show', '1']
+
+    def start(_):
+        subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, check=True)
+    return time_calls(start, itertools.repeat(None), min_seconds=2, max_calls=20)
+
+
+BENCHMARKS = {
+    'search_ingredient': bench_search,
+    'render_ingredients': bench_render,
+    'render_ingredients_uncached': bench_render_uncached,
+    'select_recipe_by_id': bench_select_by_id,
+    'select_recipe_by_name': bench_select_by_name,
+    'similar_recipes': bench_similar,
+    'add_ingredient': bench_add_ingredient,
+    'bulk_insert': bench_bulk_insert,
+    'import_cli': bench_import_cli,
+    'import_main': bench_import_main,
+    'startup_cli_show': bench_startup_cli_show,
+}
+
+# Benchmarks that write run last, against a scratch copy of the cookbook.
+WRITE_BENCHMARKS = ('add_ingredient', 'bulk_insert')
+
+
+def run(size, cache_dir, names=None):
+    """Runs the benchmarks and returns the results as a dict."""
+    names = names or list(BENCHMARKS)
+    template = cookbook_path(size, cache_dir)
+    workdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        path = os.path.join(workdir, 'cookbook.db')
+        shutil.copy(template, path)
+        configure_database(path)
+        Recipe.initialize()
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            for name in sorted(names, key=lambda name: name in WRITE_BENCHMARKS):
+                results[name] = BENCHMARKS[name](size)
+                out.seek(0)
+                out.truncate()
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        'size': size,
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'results': results,
+    }
+
+
+def compare(current, baseline, tolerance=0.2):
+    """Returns (report lines, regressed) comparing median times."""
+    lines = []
+    regressed = False
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            lines.append(f'{name:30} {result["median_us"]:>12.2f} us   (no baseline)')
+            continue
+        ratio = result['median_us'] / base['median_us'] if base['median_us'] else 1.0
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'SLOWER'
+            regressed = True
+        elif ratio < 1 - tolerance:
+            flag = 'faster'
+        lines.append(f'{name:30} {base["median_us"]:>12.2f} -> {result["median_us"]:>12.2f} us'
+                     f'  x{ratio:.2f} {flag}')
+    return lines, regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark cookbook hot paths.')
+    parser.add_argument('--size', default='1k',
+                        help=f'cookbook size: {", ".join(SIZES)} or a number (default: 1k)')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        help='run only these benchmarks')
+    parser.add_argument('--cache-dir',
+                        default=os.path.join(tempfile.gettempdir(), 'cookbook-bench'),
+                        help='where generated cookbooks are kept between runs')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against a saved JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before --compare fails (default: 0.2)')
+    args = parser.parse_args()
+
+    size = SIZES.get(args.size.lower()) or int(args.size)
+    results = run(size, args.cache_dir, args.only)
+    print(json.dumps(results, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            lines, regressed = compare(results, json.load(f), args.tolerance)
+        print('\n'.join(lines), file=sys.stderr)
+        sys.exit(1 if regressed else 0)
@@ -0,0 +1,110 @@
+"""Read/write throughput of the default and tuned SQLite configurations.
+
+Builds a scratch cookbook, then runs reader threads next to a writer
+thread for a fixed time under each configuration and prints operations
+per second and how many operations failed with "database is locked".
+
+Usage:
+    python bench_database.py --recipes 5000 --readers 4 --seconds 5
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from bench import INGREDIENT_NAMES, synthetic_recipes
+from database import DEFAULT_PRAGMAS, TUNED_PRAGMAS, configure_database
+from import_recipes import import_recipes
+from recipes import *
+
+
+CONFIGURATIONS = {
+    'default': {'pragmas': DEFAULT_PRAGMAS},
+    'tuned': {'pragmas': TUNED_PRAGMAS},
+    'tuned-pooled': {'pragmas': TUNED_PRAGMAS, 'pooled': True},
+}
+
+
+def run_workload(recipe_count, readers, seconds):
+    """Runs readers and one writer against db for a number of seconds."""
+    counts = {'reads': 0, 'writes': 0, 'read_errors': 0, 'write_errors': 0}
+    lock = threading.Lock()
+    stop = time.perf_counter() + seconds
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def read():
+        rng = random.Random()
+        while time.perf_counter() < stop:
+            try:
+                recipe = Recipe.get_by_id(rng.randint(1, recipe_count))
+                list(Ingredient.search(rng.choice(INGREDIENT_NAMES)).limit(20))
+                json.loads(recipe.ingredient_list)
+                count('reads')
+            except OperationalError:
+                count('read_errors')
+        db.close()
+
+    def write():
+        rng = random.Random()
+        while time.perf_counter() < stop:
+            try:
+                with db.atomic():
+                    Recipe.update(instructions=f'Stir {rng.random()}',
+                                  version=Recipe.version + 1).where(
+                        Recipe.id == rng.randint(1, recipe_count)).execute()
+                count('writes')
+            except OperationalError:
+                count('write_errors')
+        db.close()
+
+    threads = [threading.Thread(target=read) for _ in range(readers)]
+    threads.append(threading.Thread(target=write))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    counts['reads_per_second'] = round(counts['reads'] / seconds, 1)
+    counts['writes_per_second'] = round(counts['writes'] / seconds, 1)
+    return counts
+
+
+def benchmark(recipe_count=5000, readers=4, seconds=5):
+    """Returns a dict of workload results per configuration."""
+    workdir = tempfile.mkdtemp()
+    try:
+        template = os.path.join(workdir, 'template.db')
+        configure_database(template, pragmas=DEFAULT_PRAGMAS)
+        Recipe.initialize()
+        import_recipes(synthetic_recipes(recipe_count), batch_size=1000)
+        db.close()
+
+        results = {}
+        for name, options in CONFIGURATIONS.items():
+            path = os.path.join(workdir, f'{name}.db')
+            shutil.copy(template, path)
+            configure_database(path, **options)
+            db.connect()
+            db.close()
+            results[name] = run_workload(recipe_count, readers, seconds)
+            getattr(db.obj, 'close_all', db.close)()
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--recipes', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.recipes, args.readers, args.seconds), indent=2))
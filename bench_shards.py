@@ -0,0 +1,92 @@
+"""Write throughput of a sharded cookbook by number of shards.
+
+For each shard count, creates empty shards in a scratch directory and
+reports:
+    bulk    - recipes per second added with ShardedCookbook.add_many
+    updates - recipes per second updated one per transaction by writer
+              threads picking recipes at random, for a fixed time
+
+Writes to different shards run at the same time, so throughput grows
+with the shard count until the CPUs or the disk are busy. With the
+default pragmas every commit waits for the disk, which shards overlap.
+
+Usage:
+    python bench_shards.py --shards 1 2 4 8 --recipes 20000 --writers 8
+    python bench_shards.py --pragmas default
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from bench import synthetic_recipes
+from database import DEFAULT_PRAGMAS, TUNED_PRAGMAS
+from shards import ShardedCookbook
+
+
+PRAGMAS = {'tuned': TUNED_PRAGMAS, 'default': DEFAULT_PRAGMAS}
+
+
+def bulk_rate(cookbook, recipe_count, batch_size):
+    recipes = (json.loads(line) for line in synthetic_recipes(recipe_count))
+    start = time.perf_counter()
+    created = cookbook.add_many(recipes, batch_size)
+    return round(created / (time.perf_counter() - start), 1)
+
+
+def update_rate(cookbook, writers, seconds):
+    """Runs writer threads updating random recipes for a number of seconds
+    and returns updates per second."""
+    recipe_ids = [row['id'] for row in cookbook.list_recipes()]
+    counts = [0] * writers
+    stop = time.perf_counter() + seconds
+
+    def write(writer):
+        rng = random.Random(writer)
+        while time.perf_counter() < stop:
+            cookbook.update(rng.choice(recipe_ids), instructions=f'Stir {rng.random()}')
+            counts[writer] += 1
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return round(sum(counts) / seconds, 1)
+
+
+def benchmark(shard_counts, recipe_count=20000, batch_size=500, writers=8, seconds=5,
+              pragmas='tuned'):
+    """Returns a dict of bulk and update rates per shard count."""
+    results = {}
+    for count in shard_counts:
+        workdir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(workdir, f'cookbook-{index}.db') for index in range(count)]
+            with ShardedCookbook(paths, PRAGMAS[pragmas]) as cookbook:
+                results[count] = {
+                    'bulk_recipes_per_second': bulk_rate(cookbook, recipe_count, batch_size),
+                    'updates_per_second': update_rate(cookbook, writers, seconds),
+                }
+        finally:
+            shutil.rmtree(workdir)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--recipes', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='recipes per shard per transaction when bulk adding')
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--pragmas', choices=sorted(PRAGMAS), default='tuned')
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.shards, args.recipes, args.batch_size, args.writers,
+                               args.seconds, args.pragmas), indent=2))
@@ -0,0 +1,150 @@
+"""Memory and read latency of the recipe snapshot against the ORM path.
+
+Loads a synthetic cookbook (see bench.py) and reports:
+    memory - bytes per recipe held by the snapshot, and by the model
+             instances and parsed ingredient lists the recipe cache keeps
+    reads  - median microseconds of a listing page, an ingredient search
+             and an ingredient table, from the database and from the
+             snapshot. Tables from the database are timed both with an
+             empty recipe cache and with a warm one.
+
+Usage:
+    python bench_snapshot.py --size 100k
+"""
+import argparse
+import contextlib
+import gc
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from bench import (SIZES, cookbook_path, ingredient_vocabulary, random_ids, summarize,
+                   time_calls)
+from database import configure_database
+from recipes import *
+
+
+def allocated_bytes(build):
+    """Returns (result of build(), bytes it still holds once built)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def memory_per_recipe(size):
+    def load_models():
+        return [(recipe, json.loads(recipe.ingredient_list)) for recipe in Recipe.select()]
+
+    snapshot, snapshot_bytes = allocated_bytes(Recipe.enable_snapshot)
+    Recipe.disable_snapshot()
+    models, model_bytes = allocated_bytes(load_models)
+    return {
+        'recipes': len(snapshot),
+        'distinct_strings': len(snapshot.strings),
+        'snapshot_bytes_per_recipe': round(snapshot_bytes / len(snapshot)),
+        'orm_bytes_per_recipe': round(model_bytes / len(models)),
+    }
+
+
+def read_latencies(size):
+    rng = random.Random(3)
+    vocabulary = ingredient_vocabulary()[:200]
+    sorts = itertools.cycle(RecipeService.SORTS)
+
+    def list_page(recipe_id):
+        RecipeService.list_recipes(next(sorts), after=recipe_id, limit=Recipe.PAGE_SIZE)
+
+    def search(query):
+        RecipeService.search(query)
+
+    def render(recipe_id):
+        Recipe.print_ingredients(recipe=recipes[recipe_id])
+
+    def render_uncached(recipe_id):
+        Recipe.get_recipe_cache().clear()
+        render(recipe_id)
+
+    recipes = {recipe.id: recipe for recipe in Recipe.select(Recipe.id)}
+    queries = [rng.choice(vocabulary) for _ in range(10000)]
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        for mode in ('orm', 'snapshot'):
+            if mode == 'snapshot':
+                Recipe.enable_snapshot()
+            timings = {
+                'list_page': time_calls(list_page, random_ids(size)),
+                'search_ingredient': time_calls(search, queries),
+            }
+            if mode == 'orm':
+                timings['render_ingredients_uncached'] = time_calls(
+                    render_uncached, random_ids(size))
+                for recipe_id in recipes:
+                    render(recipe_id)
+            timings['render_ingredients'] = time_calls(render, random_ids(size))
+            results[mode] = timings
+            out.seek(0)
+            out.truncate()
+        Recipe.disable_snapshot()
+    return results
+
+
+def refresh_latency(size, changes=100):
+    """Times a snapshot refresh with no changes and after some updates."""
+    snapshot = Recipe.enable_snapshot()
+    idle = time_calls(lambda _: Recipe.fresh_snapshot(), itertools.repeat(None))
+    ids = random_ids(size)
+    with db.atomic():
+        for _ in range(changes):
+            Recipe.update(instructions='Stir.', version=Recipe.version + 1).where(
+                Recipe.id == next(ids)).execute()
+    start = time.perf_counter()
+    Recipe.fresh_snapshot()
+    seconds = time.perf_counter() - start
+    Recipe.disable_snapshot()
+    return {'unchanged': idle, f'after_{changes}_updates': summarize([seconds]),
+            'seq': snapshot.seq}
+
+
+def benchmark(size, cache_dir):
+    template = cookbook_path(size, cache_dir)
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'cookbook.db')
+        shutil.copy(template, path)
+        configure_database(path)
+        Recipe.initialize()
+        results = {
+            'size': size,
+            'memory': memory_per_recipe(size),
+            'reads': read_latencies(size),
+            'refresh': refresh_latency(size),
+        }
+        db.close()
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--size', default='1k',
+                        help=f'cookbook size: {", ".join(SIZES)} or a number (default: 1k)')
+    parser.add_argument('--cache-dir',
+                        default=os.path.join(tempfile.gettempdir(), 'cookbook-bench'),
+                        help='where generated cookbooks are kept between runs')
+    args = parser.parse_args()
+
+    size = SIZES.get(args.size.lower()) or int(args.size)
+    print(json.dumps(benchmark(size, args.cache_dir), indent=2))
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+
+class RecipeCache():
+    """Bounded least-recently-used cache of parsed recipes, keyed by recipe id.
+
+    Entries are weighed by an approximate size in bytes and the least
+    recently used ones are evicted once max_bytes is exceeded.
+
+    Every entry is stored with the recipe's version column as it was when
+    the value was loaded. Callers read the recipe's current version before
+    each lookup, so an entry is only served while nothing, in this process
+    or another, has written the recipe since:
+
+        value = cache.get(recipe_id, current_version)
+        if value is None:
+            value, version = load(recipe_id)
+            cache.put(recipe_id, value, size, version)
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, recipe_id, version):
+        """Returns the cached value for recipe_id if it was loaded at
+        version, or None on a miss. Drops an entry loaded at another one."""
+        entry = self.entries.get(recipe_id)
+        if entry is None or entry[2] != version:
+            if entry is not None:
+                self._discard(recipe_id)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(recipe_id)
+        return entry[0]
+
+    def put(self, recipe_id, value, size, version):
+        """Stores value, loaded when the recipe was at version."""
+        if size > self.max_bytes:
+            return
+        self._discard(recipe_id)
+        self.entries[recipe_id] = (value, size, version)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, recipe_id):
+        """Drops the entry for recipe_id."""
+        self._discard(recipe_id)
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        """Returns a dict of hit/miss counters and current usage."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _discard(self, recipe_id):
+        entry = self.entries.pop(recipe_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
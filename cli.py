@@ -0,0 +1,296 @@
+"""Non-interactive command line for the cookbook, built on RecipeService.
+
+Every command prints its result as JSON, except ingredients, which prints
+a table in the chosen format. Recipes can be given by id or name.
+
+Usage:
+    python -m cli show "garlic bread"
+    python -m cli ingredients "garlic bread" --format markdown
+    python -m cli list --sort name --limit 50 --after 1234
+    python -m cli search garlic
+    python -m cli find "garlc bred"
+    python -m cli search "bean enchiladas" --full-text
+    python -m cli pantry bread butter "garlic salt" --max-missing 1
+    python -m cli filter --with garlic --without anchovy --max-total "30 mins"
+    python -m cli similar "garlic bread" --limit 5
+    python -m cli duplicates --ingredients '[{"ingredient_name": "bread", ...}]'
+    python -m cli add toast --ingredients '[{"ingredient_name": "bread", ...}]'
+    python -m cli update toast --prep-time "1 min" --instructions "Toast it."
+    python -m cli scale "garlic bread" --servings 8 --units metric
+    python -m cli shop "garlic bread:8" "bean enchiladas" --units us
+    python -m cli delete toast
+    python -m cli apply nightly-edits.jsonl
+    python -m cli changes --since 1234 --limit 500
+    python -m cli compact-changes --drop-deletes --through 1234
+
+apply reads operations for RecipeService.apply, one JSON object per line
+(or a single JSON array), and applies all of them in one transaction:
+
+    {"op": "add", "name": "toast", "ingredient_list": []}
+    {"op": "add_ingredient", "recipe": "toast", "ingredient": {"ingredient_name": "bread", ...}}
+    {"op": "update_ingredient", "recipe": "toast", "position": 1, "prep": "sliced"}
+    {"op": "delete", "recipe": "garlic bread"}
+
+Recipes carry a version that every write bumps, shown by show. Giving an
+operation "expected_version" makes the batch fail instead of overwriting
+a recipe that has changed since that version was read.
+
+filter combines ingredient, name and time conditions in one query, and
+--explain shows which index it is driven by and SQLite's query plan.
+
+changes prints the recipes created, updated or deleted after a change
+seq, for keeping a copy in sync (see RecipeService.changes_since).
+compact-changes shrinks the change log; with --drop-deletes, copies that
+have not seen --through yet must be made again.
+"""
+import argparse
+import json
+import sys
+
+from database import configure_database
+from metrics import metrics
+from quantities import SYSTEMS, parse_duration
+from recipes import *
+from table import TableRenderer, terminal_width
+
+
+def read_operations(f):
+    """Reads a JSON array of operations, or one operation per line."""
+    text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def parse_plan(entries):
+    """Returns (recipe_id, servings) pairs for RECIPE[:SERVINGS] strings."""
+    plan = []
+    for entry in entries:
+        key, _, servings = entry.rpartition(':')
+        if not key or not servings.strip().isdigit():
+            key, servings = entry, None
+        plan.append((RecipeService.find(key).id, servings))
+    return plan
+
+
+def duration(text):
+    """Returns the seconds in a duration argument such as '30 mins'."""
+    seconds = parse_duration(text)
+    if seconds is None:
+        raise argparse.ArgumentTypeError(f'not a duration: {text!r}')
+    return seconds
+
+
+def run(args):
+    """Runs the command given by parsed arguments and returns its result."""
+    if args.command == 'show':
+        return RecipeService.to_dict(RecipeService.find(args.recipe))
+    if args.command == 'list':
+        return RecipeService.list_recipes(args.sort, args.descending, args.after, args.limit)
+    if args.command == 'search':
+        if args.full_text:
+            return RecipeService.full_text_search(args.query, args.limit)
+        return RecipeService.search(args.query)
+    if args.command == 'find':
+        return RecipeService.find_similar(args.query, args.limit)
+    if args.command == 'pantry':
+        return RecipeService.pantry_matches(args.ingredients, args.max_missing, args.limit)
+    if args.command == 'filter':
+        conditions = (args.include, args.exclude, args.name, args.max_prep, args.max_cook,
+                      args.max_total, args.limit)
+        if args.explain:
+            return RecipeService.explain_filter(*conditions)
+        return RecipeService.filter_recipes(*conditions)
+    if args.command == 'similar':
+        return RecipeService.similar_recipes(RecipeService.find(args.recipe).id, args.limit,
+                                             args.min_score)
+    if args.command == 'duplicates':
+        return RecipeService.likely_duplicates(json.loads(args.ingredients), args.limit,
+                                               args.min_score)
+    if args.command == 'add':
+        recipe = RecipeService.add(args.name, json.loads(args.ingredients), args.prep_time,
+                                   args.cook_time, args.instructions, args.servings)
+        return RecipeService.to_dict(recipe)
+    if args.command == 'update':
+        fields = {field: getattr(args, field) for field in RecipeService.FIELDS
+                  if getattr(args, field) is not None}
+        if 'ingredient_list' in fields:
+            fields['ingredient_list'] = json.loads(fields['ingredient_list'])
+        recipe_id = RecipeService.find(args.recipe).id
+        return RecipeService.to_dict(RecipeService.update(recipe_id, **fields))
+    if args.command == 'scale':
+        return RecipeService.scale(RecipeService.find(args.recipe).id, args.servings,
+                                   args.factor, args.units)
+    if args.command == 'shop':
+        return RecipeService.shopping_list(parse_plan(args.recipes), args.units)
+    if args.command == 'delete':
+        RecipeService.delete(RecipeService.find(args.recipe).id)
+        return None
+    if args.command == 'apply':
+        if args.path == '-':
+            operations = read_operations(sys.stdin)
+        else:
+            with open(args.path, encoding='utf-8') as f:
+                operations = read_operations(f)
+        return RecipeService.apply(operations)
+    if args.command == 'changes':
+        return {'last_seq': RecipeChange.last_seq(),
+                'changes': list(RecipeService.changes_since(args.since, args.limit))}
+    if args.command == 'compact-changes':
+        removed = RecipeChange.compact(args.through, args.drop_deletes)
+        return {'removed': removed, 'horizon': RecipeChange.horizon()}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='cli', description='Manage recipes without menus.')
+    parser.add_argument('--db', help='database file (default: $COOKBOOK_DB or recipes.db)')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='time the queries run and write the timings to PATH '
+                             '(Prometheus text if it ends in .prom, else JSON)')
+    parser.add_argument('--slow-ms', type=float, default=100,
+                        help='with --profile, log operations slower than this (default: 100)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    show = commands.add_parser('show', help='show one recipe')
+    show.add_argument('recipe', help='recipe id or name')
+
+    ingredients = commands.add_parser('ingredients', help="print a recipe's ingredients table")
+    ingredients.add_argument('recipe', help='recipe id or name')
+    ingredients.add_argument('--format', dest='table_format', default='text',
+                             choices=TableRenderer.FORMATS)
+    ingredients.add_argument('--width', type=int,
+                             help='widest a text table may be (default: terminal width)')
+    ingredients.add_argument('--wrap', action='store_true',
+                             help='wrap long cells instead of truncating them')
+
+    list_ = commands.add_parser('list', help='list recipe ids and names')
+    list_.add_argument('--sort', default='id', choices=RecipeService.SORTS)
+    list_.add_argument('--descending', action='store_true')
+    list_.add_argument('--limit', type=int, help='most recipes to list (default: all)')
+    list_.add_argument('--after', type=int, metavar='ID',
+                       help='start after this recipe, the last one of the previous page')
+
+    search = commands.add_parser('search', help='search recipes')
+    search.add_argument('query')
+    search.add_argument('--full-text', action='store_true',
+                        help='search names, ingredients and instructions')
+    search.add_argument('--limit', type=int, default=20,
+                        help='maximum full-text results (default: 20)')
+
+    find = commands.add_parser('find', help='find recipes by name, allowing for typos')
+    find.add_argument('query')
+    find.add_argument('--limit', type=int, default=5)
+
+    pantry = commands.add_parser('pantry', help='find recipes makeable from ingredients on hand')
+    pantry.add_argument('ingredients', nargs='+')
+    pantry.add_argument('--max-missing', type=int, default=0)
+    pantry.add_argument('--limit', type=int)
+
+    filter_ = commands.add_parser('filter', help='find recipes by ingredients, name and time')
+    filter_.add_argument('--with', dest='include', action='append', default=[],
+                         metavar='INGREDIENT', help='ingredient the recipe must use')
+    filter_.add_argument('--without', dest='exclude', action='append', default=[],
+                         metavar='INGREDIENT', help='ingredient the recipe must not use')
+    filter_.add_argument('--name', help='words the recipe name must contain')
+    filter_.add_argument('--max-prep', type=duration, metavar='TIME')
+    filter_.add_argument('--max-cook', type=duration, metavar='TIME')
+    filter_.add_argument('--max-total', type=duration, metavar='TIME')
+    filter_.add_argument('--limit', type=int)
+    filter_.add_argument('--explain', action='store_true',
+                         help='show the query plan instead of the recipes')
+
+    similar = commands.add_parser('similar', help='find recipes with similar ingredients')
+    similar.add_argument('recipe', help='recipe id or name')
+    similar.add_argument('--limit', type=int, default=10)
+    similar.add_argument('--min-score', type=float, default=0.5,
+                         help='least share of ingredients in common, from 0 to 1 (default: 0.5)')
+
+    duplicates = commands.add_parser(
+        'duplicates', help='find saved recipes with much the same ingredients as a new one')
+    duplicates.add_argument('--ingredients', required=True, help='JSON list of ingredient dicts')
+    duplicates.add_argument('--limit', type=int, default=5)
+    duplicates.add_argument('--min-score', type=float, default=0.8,
+                            help='least share of ingredients in common, from 0 to 1 (default: 0.8)')
+
+    add = commands.add_parser('add', help='add a recipe')
+    add.add_argument('name')
+    add.add_argument('--ingredients', default='[]', help='JSON list of ingredient dicts')
+    add.add_argument('--prep-time')
+    add.add_argument('--cook-time')
+    add.add_argument('--instructions')
+    add.add_argument('--servings', type=int)
+
+    update = commands.add_parser('update', help='update fields of a recipe')
+    update.add_argument('recipe', help='recipe id or name')
+    update.add_argument('--name')
+    update.add_argument('--ingredients', dest='ingredient_list',
+                        help='JSON list of ingredient dicts')
+    update.add_argument('--prep-time')
+    update.add_argument('--cook-time')
+    update.add_argument('--instructions')
+    update.add_argument('--servings', type=int)
+
+    scale = commands.add_parser('scale', help='show a recipe scaled and converted')
+    scale.add_argument('recipe', help='recipe id or name')
+    amount = scale.add_mutually_exclusive_group(required=True)
+    amount.add_argument('--servings', type=int, help='scale to this many servings')
+    amount.add_argument('--factor', type=float, help='multiply amounts by this')
+    scale.add_argument('--units', choices=SYSTEMS, help='convert to US or metric units')
+
+    shop = commands.add_parser('shop', help='make one shopping list for several recipes')
+    shop.add_argument('recipes', nargs='+', metavar='RECIPE[:SERVINGS]',
+                      help='recipe id or name, optionally with the servings to make')
+    shop.add_argument('--units', choices=SYSTEMS, help='convert to US or metric units')
+
+    delete = commands.add_parser('delete', help='delete a recipe')
+    delete.add_argument('recipe', help='recipe id or name')
+
+    apply = commands.add_parser('apply', help='apply a file of operations in one transaction')
+    apply.add_argument('path', help='JSON Lines or JSON array file, or - for stdin')
+
+    changes = commands.add_parser('changes', help='show recipe changes after a change seq')
+    changes.add_argument('--since', type=int, default=0,
+                         help='seq of the last change already seen (default: 0)')
+    changes.add_argument('--limit', type=int, default=1000,
+                         help='most changes shown (default: 1000)')
+
+    compact = commands.add_parser('compact-changes',
+                                  help='remove superseded entries from the change log')
+    compact.add_argument('--through', type=int,
+                         help='only compact changes up to this seq (default: all)')
+    compact.add_argument('--drop-deletes', action='store_true',
+                         help='remove deletes too; older copies must then be made again')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    configure_database(args.db)
+    if args.profile:
+        metrics.enable(db.obj, args.slow_ms / 1000)
+    try:
+        return _run_command(args)
+    finally:
+        if args.profile:
+            metrics.dump(args.profile)
+
+
+def _run_command(args):
+    Recipe.initialize()
+    try:
+        if args.command == 'ingredients':
+            recipe = RecipeService.find(args.recipe)
+            Recipe.render_ingredients(json.loads(recipe.ingredient_list), sys.stdout,
+                                      args.table_format, args.width or terminal_width(),
+                                      args.wrap)
+            return 0
+        result = run(args)
+    except (ValueError, DoesNotExist, IntegrityError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""SQLite connection setup for the cookbook.
+
+All models use the module-level db proxy. configure_database() creates
+the real database and points db at it, so the path and tuning can be
+changed before the first query without touching the models:
+
+    configure_database('other.db', pooled=True)
+    Recipe.initialize()
+
+If nothing configures it, db points itself at the default database the
+first time it is used. The database path defaults to recipes.db, or the
+COOKBOOK_DB environment variable when it is set.
+"""
+import os
+
+from peewee import DatabaseProxy, SqliteDatabase
+
+DB_PATH_ENV = 'COOKBOOK_DB'
+DEFAULT_PATH = 'recipes.db'
+
+# WAL lets readers run alongside a writer instead of blocking on it, and
+# synchronous=normal is safe with WAL (it only syncs on checkpoints).
+TUNED_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,
+}
+
+# SQLite's own defaults, for comparison in benchmarks.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'delete',
+    'synchronous': 'full',
+    'busy_timeout': 5000,
+}
+
+
+class DefaultDatabaseProxy(DatabaseProxy):
+    """DatabaseProxy that calls configure_database() with no arguments the
+    first time it is used unconfigured, instead of raising."""
+
+    def __getattr__(self, attr):
+        if self.obj is None:
+            configure_database()
+        return super().__getattr__(attr)
+
+
+db = DefaultDatabaseProxy()
+
+
+def make_database(path=None, pragmas=None, pooled=False, max_connections=8):
+    """Returns a new, unconnected SqliteDatabase.
+
+    Parameters:
+        path - database file, defaults to $COOKBOOK_DB or recipes.db
+        pragmas - dict of pragmas run on every new connection,
+                  defaults to TUNED_PRAGMAS
+        pooled - hand out connections from a pool shared by all threads
+                 instead of opening one connection per thread
+        max_connections - size of the pool when pooled is true
+    """
+    if path is None:
+        path = os.environ.get(DB_PATH_ENV, DEFAULT_PATH)
+    if pragmas is None:
+        pragmas = TUNED_PRAGMAS
+    timeout = pragmas.get('busy_timeout', 5000) / 1000
+    if pooled:
+        # Imported here since playhouse.pool pulls in the Postgres
+        # extensions too, which would slow every start up.
+        from playhouse.pool import PooledSqliteDatabase
+        # Pooled connections move between threads, though only one
+        # thread uses a connection at a time.
+        return PooledSqliteDatabase(path, pragmas=pragmas, timeout=timeout,
+                                    max_connections=max_connections,
+                                    check_same_thread=False)
+    return SqliteDatabase(path, pragmas=pragmas, timeout=timeout)
+
+
+def configure_database(*args, **kwargs):
+    """Creates a database with make_database and points db at it.
+    Closes the connection to the previous database if one was open.
+    """
+    if db.obj is not None and not db.is_closed():
+        db.close()
+    database = make_database(*args, **kwargs)
+    db.initialize(database)
+    return database
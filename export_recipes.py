@@ -0,0 +1,157 @@
+"""Bulk export of the cookbook to JSON Lines or CSV files.
+
+Writes the same layouts import_recipes.py reads, so an export can be
+imported again. Recipes are read a page at a time with keyset pagination
+(WHERE id > last id), so memory use stays flat however big the database
+is. Paths ending in .gz are gzip compressed.
+
+Usage:
+    python export_recipes.py cookbook.jsonl
+    python export_recipes.py cookbook.csv.gz --ingredient garlic
+    python export_recipes.py dinners.jsonl --search "bean enchiladas"
+"""
+import argparse
+import csv
+import gzip
+import json
+import sys
+
+from database import configure_database
+from import_recipes import RECIPE_FIELDS, guess_format
+from recipes import *
+from search import RecipeSearch
+
+
+INGREDIENT_FIELDS = ('ingredient_name', 'ingredient_amount', 'ingredient_units',
+                     'optional', 'prep')
+CSV_FIELDS = RECIPE_FIELDS + INGREDIENT_FIELDS
+
+
+def filtered_recipes(ingredient=None, search=None):
+    """Returns a query of recipes, optionally restricted by the same criteria
+    as the ingredient search and the full-text search menu options.
+    """
+    recipes = Recipe.select(Recipe.id, Recipe.name, Recipe.prep_time,
+                            Recipe.cook_time, Recipe.instructions,
+                            Recipe.servings, Recipe.ingredient_list)
+    if ingredient:
+        recipes = recipes.where(Recipe.id.in_(
+            Ingredient.search(ingredient).select(Recipe.id)))
+    if search:
+        expression = RecipeSearch.to_match_expression(search)
+        if expression is None:
+            return recipes.where(False)
+        recipes = recipes.where(Recipe.id.in_(
+            RecipeSearch.select(RecipeSearch.rowid)
+            .where(RecipeSearch.match(expression))))
+    return recipes
+
+
+def iter_pages(recipes, page_size=1000):
+    """Yields lists of (id, name, prep_time, cook_time, instructions,
+    servings, ingredient_list) tuples in id order, one page at a time.
+    """
+    last_id = 0
+    while True:
+        page = list(recipes
+                    .where(Recipe.id > last_id)
+                    .order_by(Recipe.id)
+                    .limit(page_size)
+                    .tuples()
+                    .iterator())
+        if not page:
+            return
+        yield page
+        last_id = page[-1][0]
+
+
+def jsonl_lines(page):
+    """Formats a page as JSON Lines. The stored ingredient_list JSON is
+    copied into the line as is, without decoding it.
+    """
+    for _, name, prep_time, cook_time, instructions, servings, ingredient_list in page:
+        fields = json.dumps({
+            'name': name,
+            'prep_time': prep_time,
+            'cook_time': cook_time,
+            'instructions': instructions,
+            'servings': servings,
+        }, default=str)
+        yield f'{fields[:-1]}, "ingredient_list": {ingredient_list}}}\n'
+
+
+def csv_rows(page):
+    """Formats a page as CSV rows, one per ingredient. A recipe without
+    ingredients gets one row with empty ingredient columns.
+    """
+    for _, name, prep_time, cook_time, instructions, servings, ingredient_list in page:
+        recipe = (name, prep_time, cook_time, instructions, servings)
+        ingr_json = json.loads(ingredient_list)
+        if not ingr_json:
+            yield recipe + ('',) * len(INGREDIENT_FIELDS)
+        for item in ingr_json:
+            yield recipe + (
+                item.get('ingredient_name'),
+                item.get('ingredient_amount'),
+                item.get('ingredient_units'),
+                'y' if item.get('optional') else 'n',
+                item.get('prep'),
+            )
+
+
+def export_recipes(out, file_format='jsonl', page_size=1000, ingredient=None, search=None):
+    """Writes recipes to an open text stream and returns how many were written.
+
+    Parameters:
+        out - text stream to write to
+        file_format - 'jsonl' or 'csv'
+        page_size - number of recipes fetched per query
+        ingredient - only export recipes with an ingredient containing this
+        search - only export recipes matching this full-text search
+    """
+    recipes = filtered_recipes(ingredient, search)
+    count = 0
+    if file_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(CSV_FIELDS)
+    for page in iter_pages(recipes, page_size):
+        if file_format == 'csv':
+            writer.writerows(csv_rows(page))
+        else:
+            out.writelines(jsonl_lines(page))
+        count += len(page)
+    return count
+
+
+def open_output(path):
+    if path == '-':
+        return sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', newline='', encoding='utf-8')
+    return open(path, 'w', newline='', encoding='utf-8')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk export recipes.')
+    parser.add_argument('path', help='file to write, or - for stdout')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='file format (default: guessed from the file extension)')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='recipes fetched per query (default: 1000)')
+    parser.add_argument('--ingredient',
+                        help='only export recipes with an ingredient containing this')
+    parser.add_argument('--search',
+                        help='only export recipes matching this full-text search')
+    parser.add_argument('--db', help='database file (default: $COOKBOOK_DB or recipes.db)')
+    args = parser.parse_args()
+
+    configure_database(args.db)
+    Recipe.initialize()
+    out = open_output(args.path)
+    try:
+        count = export_recipes(out, args.format or guess_format(args.path),
+                               args.page_size, args.ingredient, args.search)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f'{count} recipes exported', file=sys.stderr)
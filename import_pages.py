@@ -0,0 +1,265 @@
+"""Imports recipes from web pages and saved HTML files.
+
+Pages are read for schema.org Recipe data (JSON-LD or microdata, see
+schema_org.py), so most recipe sites work without a scraper of their own.
+The import runs as a pipeline with three stages:
+
+    fetch  - a pool of threads downloads URLs and reads files. Each thread
+             keeps one HTTP connection open per host and reuses it.
+    parse  - a pool of processes extracts recipes from the HTML, so parsing
+             is not held back by the GIL.
+    write  - the main thread validates recipes and writes them in batched
+             transactions, as import_recipes.py does.
+
+At most a few pages per fetch thread are in flight at once, so memory use
+does not grow with the number of pages.
+
+Usage:
+    python import_pages.py https://example.com/recipes/garlic-bread saved/*.html
+    python import_pages.py --from urls.txt --fetch-workers 32 --batch-size 1000
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import sys
+import threading
+import zlib
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait)
+from urllib.parse import urljoin, urlsplit
+
+from database import configure_database
+from import_recipes import ImportReport, validate_recipe, write_batch
+from recipes import *
+from schema_org import extract_recipes
+
+
+USER_AGENT = 'cookbook-importer/1.0'
+MAX_REDIRECTS = 5
+MAX_PAGE_BYTES = 10 * 1024 * 1024
+
+
+class PageFetcher():
+    """Reads pages from URLs or files, from any number of threads.
+
+    Each thread keeps its own HTTP connections, one per host, and reuses
+    them for every page it fetches from that host.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def fetch(self, source):
+        """Returns the text of a page, given a URL or a file path."""
+        if not source.startswith(('http://', 'https://')):
+            with open(source, 'rb') as f:
+                return self.decode(f.read(MAX_PAGE_BYTES), None)
+        url = source
+        for _ in range(MAX_REDIRECTS + 1):
+            response, body = self.get(url)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise ValueError(f'HTTP {response.status} {response.reason}')
+            encoding = response.getheader('Content-Encoding', '').lower()
+            if encoding == 'gzip':
+                body = gzip.decompress(body)
+            elif encoding == 'deflate':
+                body = zlib.decompress(body)
+            return self.decode(body, response.getheader('Content-Type'))
+        raise ValueError(f'more than {MAX_REDIRECTS} redirects')
+
+    def get(self, url):
+        """Sends a GET on this thread's connection to the URL's host and
+        returns (response, body). A connection the server has closed since
+        its last use is reopened once."""
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'}
+        for attempt in (1, 2):
+            connection = self.connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read(MAX_PAGE_BYTES + 1)
+            except (http.client.RemoteDisconnected, ConnectionError,
+                    http.client.BadStatusLine):
+                self.close(parts.scheme, parts.netloc)
+                if attempt == 2:
+                    raise
+                continue
+            except Exception:
+                self.close(parts.scheme, parts.netloc)
+                raise
+            if len(body) > MAX_PAGE_BYTES:
+                self.close(parts.scheme, parts.netloc)
+                raise ValueError(f'page is larger than {MAX_PAGE_BYTES} bytes')
+            if response.will_close:
+                self.close(parts.scheme, parts.netloc)
+            return response, body
+
+    def connection(self, scheme, netloc):
+        connections = self.local.__dict__.setdefault('connections', {})
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+        return connection
+
+    def close(self, scheme, netloc):
+        connection = self.local.__dict__.get('connections', {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    @staticmethod
+    def decode(body, content_type):
+        charset = 'utf-8'
+        for parameter in (content_type or '').split(';')[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'charset' and value.strip():
+                charset = value.strip().strip('"\'')
+        try:
+            return body.decode(charset, errors='replace')
+        except LookupError:
+            return body.decode('utf-8', errors='replace')
+
+
+def parse_page(source, page):
+    """Returns (source, recipes) for a page. Runs in a worker process."""
+    return source, extract_recipes(page)
+
+
+def expand_sources(sources):
+    """Yields URLs and file paths, with directories replaced by the HTML
+    files in them."""
+    for source in sources:
+        source = source.strip()
+        if not source:
+            continue
+        if os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                for name in sorted(files):
+                    if name.lower().endswith(('.html', '.htm')):
+                        yield os.path.join(root, name)
+        else:
+            yield source
+
+
+def import_pages(sources, fetch_workers=16, parse_workers=None, batch_size=500,
+                 upsert=True, out=None):
+    """Imports the recipes found in pages.
+
+    Parameters:
+        sources - iterable of URLs and HTML file paths
+        fetch_workers - threads fetching pages
+        parse_workers - processes parsing pages, by default one per CPU
+            but one, which the main thread and fetch threads use. With 0,
+            pages are parsed on the main thread.
+        batch_size - number of recipes written per transaction
+        upsert - update recipes whose name already exists instead of skipping them
+        out - stream to print progress to after each batch, or None
+
+    Returns an ImportReport, where read counts pages.
+    """
+    report = ImportReport(out)
+    fetcher = PageFetcher()
+    sources = iter(sources)
+    max_in_flight = fetch_workers * 4
+    batch = []
+    fetching, parsing = {}, set()
+
+    def save(source, recipes):
+        nonlocal batch
+        if not recipes:
+            report.error(source, 'no schema.org Recipe found')
+        for recipe in recipes:
+            try:
+                batch.append(validate_recipe(recipe))
+            except ValueError as e:
+                report.error(source, e)
+        if len(batch) >= batch_size:
+            write_batch(batch, upsert, report)
+            batch = []
+            report.progress()
+
+    if parse_workers is None:
+        parse_workers = (os.cpu_count() or 1) - 1
+    parse_pool = ProcessPoolExecutor(parse_workers) if parse_workers else None
+    with ThreadPoolExecutor(fetch_workers) as fetch_pool:
+        try:
+            while True:
+                while len(fetching) + len(parsing) < max_in_flight:
+                    source = next(sources, None)
+                    if source is None:
+                        break
+                    fetching[fetch_pool.submit(fetcher.fetch, source)] = source
+                if not fetching and not parsing:
+                    break
+                done, _ = wait(set(fetching) | parsing, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetching:
+                        source = fetching.pop(future)
+                        report.read += 1
+                        try:
+                            page = future.result()
+                        except (OSError, ValueError, http.client.HTTPException) as e:
+                            report.error(source, e)
+                            continue
+                        if parse_pool is None:
+                            save(*parse_page(source, page))
+                        else:
+                            parsing.add(parse_pool.submit(parse_page, source, page))
+                    else:
+                        parsing.remove(future)
+                        save(*future.result())
+        finally:
+            if parse_pool is not None:
+                parse_pool.shutdown(cancel_futures=True)
+    if batch:
+        write_batch(batch, upsert, report)
+    report.progress()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import recipes from web pages and HTML files.')
+    parser.add_argument('sources', nargs='*', help='URLs, HTML files or directories of them')
+    parser.add_argument('--from', dest='source_list',
+                        help='file with one URL or path per line, or - for stdin')
+    parser.add_argument('--fetch-workers', type=int, default=16,
+                        help='threads fetching pages (default: 16)')
+    parser.add_argument('--parse-workers', type=int,
+                        help='processes parsing pages (default: one per CPU but one, '
+                             '0 to parse on the main thread)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='recipes per transaction (default: 500)')
+    parser.add_argument('--no-upsert', dest='upsert', action='store_false',
+                        help='skip recipes whose name already exists instead of updating them')
+    parser.add_argument('--quiet', action='store_true',
+                        help='only print the final report')
+    parser.add_argument('--db', help='database file (default: $COOKBOOK_DB or recipes.db)')
+    args = parser.parse_args()
+    if not args.sources and not args.source_list:
+        parser.error('give at least one URL or file, or --from')
+
+    configure_database(args.db)
+    Recipe.initialize()
+    sources = list(args.sources)
+    if args.source_list == '-':
+        sources.extend(sys.stdin)
+    elif args.source_list:
+        with open(args.source_list, encoding='utf-8') as f:
+            sources.extend(f)
+    report = import_pages(expand_sources(sources), args.fetch_workers, args.parse_workers,
+                          args.batch_size, args.upsert, None if args.quiet else sys.stderr)
+    print(json.dumps(report.as_dict(), indent=2))
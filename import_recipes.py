@@ -0,0 +1,265 @@
+"""Bulk import of recipes from JSON Lines or CSV files.
+
+JSON Lines files hold one recipe per line:
+
+    {"name": "garlic bread", "ingredient_list": [{"ingredient_name": ...}],
+     "prep_time": "5 mins", "cook_time": "3 mins", "instructions": "...",
+     "servings": 4}
+
+CSV files hold one row per ingredient, with the rows of a recipe next to
+each other. The recipe columns are taken from the first row of a recipe:
+
+    name,prep_time,cook_time,instructions,servings,ingredient_name,ingredient_amount,ingredient_units,optional,prep
+
+Files are read as a stream and written with insert_many in one
+transaction per batch, so memory use depends on the batch size, not the
+size of the file. Paths ending in .gz are read as gzip compressed.
+
+Usage:
+    python import_recipes.py catalog.jsonl
+    python import_recipes.py catalog.csv --batch-size 1000 --no-upsert
+"""
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import sys
+import time
+
+from database import configure_database
+from recipes import *
+
+
+RECIPE_FIELDS = ('name', 'prep_time', 'cook_time', 'instructions', 'servings')
+TRUE_STRINGS = ('y', 'yes', 'true', '1')
+
+
+def read_jsonl(lines):
+    """Yields (line number, recipe dict) for each non-blank line.
+    Lines that are not valid JSON are yielded as a ValueError instead.
+    """
+    for line_number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f'could not parse: {e}')
+
+
+def read_csv(lines):
+    """Yields (line number, recipe dict), grouping consecutive rows by name."""
+    reader = csv.DictReader(lines)
+    rows = ((reader.line_num, row) for row in reader)
+    for name, group in itertools.groupby(rows, key=lambda item: item[1].get('name')):
+        group = list(group)
+        line_number, first = group[0]
+        recipe = {field: first.get(field) or None for field in RECIPE_FIELDS}
+        recipe['name'] = name
+        recipe['ingredient_list'] = [
+            {
+                'ingredient_name': row.get('ingredient_name'),
+                'ingredient_amount': row.get('ingredient_amount') or '',
+                'ingredient_units': row.get('ingredient_units') or '',
+                'optional': (row.get('optional') or '').strip().lower() in TRUE_STRINGS,
+                'prep': row.get('prep') or '',
+            }
+            for _, row in group if row.get('ingredient_name')
+        ]
+        yield line_number, recipe
+
+
+READERS = {
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def validate_recipe(recipe):
+    """Returns the recipe as a dict of Recipe columns plus its ingredient list.
+    Raises ValueError if it does not have the expected shape.
+    """
+    if not isinstance(recipe, dict):
+        raise ValueError('recipe must be an object')
+    name = recipe.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name must be a non-empty string')
+    ingr_json = recipe.get('ingredient_list', [])
+    if not isinstance(ingr_json, list):
+        raise ValueError('ingredient_list must be a list')
+    for idx, item in enumerate(ingr_json, 1):
+        try:
+            Recipe.validate_ingredient(item)
+        except ValueError as e:
+            raise ValueError(f'ingredient {idx}: {e}')
+    row = {field: recipe.get(field) for field in RECIPE_FIELDS}
+    row['name'] = name.strip()
+    row['servings'] = RecipeService.check_servings(row['servings'])
+    return row, ingr_json
+
+
+class ImportReport():
+    """Counts what an import did and prints progress as it goes."""
+
+    def __init__(self, out=None, max_errors=10):
+        self.out = out
+        self.max_errors = max_errors
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.errors = []
+        self.start = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.start
+
+    @property
+    def per_second(self):
+        return (self.inserted + self.updated) / self.seconds if self.seconds else 0.0
+
+    def error(self, where, message):
+        """Counts an invalid recipe. where is a line number or, for
+        recipes that do not come from a file, a description such as a URL.
+        """
+        self.invalid += 1
+        if len(self.errors) < self.max_errors:
+            where = f'line {where}' if isinstance(where, int) else where
+            self.errors.append(f'{where}: {message}')
+
+    def progress(self):
+        if self.out:
+            print(f'{self.read} read, {self.inserted} inserted, {self.updated} updated, '
+                  f'{self.invalid} invalid ({self.per_second:.0f} recipes/s)',
+                  file=self.out)
+
+    def as_dict(self):
+        return {
+            'read': self.read,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'invalid': self.invalid,
+            'seconds': round(self.seconds, 3),
+            'recipes_per_second': round(self.per_second, 1),
+            'errors': self.errors,
+        }
+
+
+def write_batch(batch, upsert, report):
+    """Writes one batch of (row, ingr_json) tuples in a single transaction.
+
+    Existing recipes with the same name are updated if upsert is true,
+    and left alone otherwise.
+    """
+    by_name = {}
+    for row, ingr_json in batch:
+        if upsert or row['name'] not in by_name:
+            by_name[row['name']] = (row, ingr_json)
+    report.skipped += len(batch) - len(by_name)
+
+    with db.atomic():
+        existing = dict(Recipe.select(Recipe.name, Recipe.id)
+                        .where(Recipe.name.in_(list(by_name))).tuples())
+        if not upsert:
+            report.skipped += len(existing)
+            for name in existing:
+                del by_name[name]
+        if not by_name:
+            return
+
+        rows = [Recipe.with_durations(dict(row, ingredient_list=json.dumps(ingr_json)))
+                for row, ingr_json in by_name.values()]
+        query = Recipe.insert_many(rows)
+        if upsert:
+            query = query.on_conflict(
+                conflict_target=[Recipe.name],
+                preserve=[Recipe.ingredient_list, Recipe.prep_time, Recipe.cook_time,
+                          Recipe.instructions, Recipe.servings, Recipe.prep_seconds,
+                          Recipe.cook_seconds, Recipe.total_seconds],
+                update={Recipe.version: Recipe.version + 1})
+        query.execute()
+
+        ids = dict(Recipe.select(Recipe.name, Recipe.id)
+                   .where(Recipe.name.in_(list(by_name))).tuples())
+        Ingredient.replace_many(
+            {ids[name]: ingr_json for name, (_, ingr_json) in by_name.items()})
+
+    for name in existing:
+        Recipe.get_recipe_cache().invalidate(existing[name])
+    for name in by_name:
+        if name not in existing:
+            Recipe.notify_name(ids[name], name)
+    report.updated += len(existing) if upsert else 0
+    report.inserted += len(by_name) - (len(existing) if upsert else 0)
+
+
+def import_recipes(lines, file_format='jsonl', batch_size=500, upsert=True, out=None):
+    """Imports recipes from an iterable of text lines.
+
+    Parameters:
+        lines - open file or other iterable of lines
+        file_format - 'jsonl' or 'csv'
+        batch_size - number of recipes written per transaction
+        upsert - update recipes whose name already exists instead of skipping them
+        out - stream to print progress to after each batch, or None
+
+    Returns an ImportReport.
+    """
+    report = ImportReport(out)
+    batch = []
+    for line_number, recipe in READERS[file_format](lines):
+        report.read += 1
+        try:
+            if isinstance(recipe, ValueError):
+                raise recipe
+            batch.append(validate_recipe(recipe))
+        except ValueError as e:
+            report.error(line_number, e)
+            continue
+        if len(batch) >= batch_size:
+            write_batch(batch, upsert, report)
+            batch = []
+            report.progress()
+    if batch:
+        write_batch(batch, upsert, report)
+    report.progress()
+    return report
+
+
+def open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='', encoding='utf-8')
+    return open(path, newline='', encoding='utf-8')
+
+
+def guess_format(path):
+    path = path.lower()
+    if path.endswith('.gz'):
+        path = path[:-3]
+    return 'csv' if path.endswith('.csv') else 'jsonl'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import recipes.')
+    parser.add_argument('path', help='JSON Lines or CSV file to import')
+    parser.add_argument('--format', choices=sorted(READERS),
+                        help='file format (default: guessed from the file extension)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='recipes per transaction (default: 500)')
+    parser.add_argument('--no-upsert', dest='upsert', action='store_false',
+                        help='skip recipes whose name already exists instead of updating them')
+    parser.add_argument('--quiet', action='store_true',
+                        help='only print the final report')
+    parser.add_argument('--db', help='database file (default: $COOKBOOK_DB or recipes.db)')
+    args = parser.parse_args()
+
+    configure_database(args.db)
+    Recipe.initialize()
+    with open_input(args.path) as f:
+        report = import_recipes(
+            f, args.format or guess_format(args.path), args.batch_size,
+            args.upsert, None if args.quiet else sys.stderr)
+    print(json.dumps(report.as_dict(), indent=2))
@@ -0,0 +1,148 @@
+"""Load test for server.py: many concurrent keep-alive clients.
+
+Each client holds one connection open and sends requests back to back
+for a fixed time, mostly ingredient searches and single-recipe reads with
+a share of writes. Prints sustained requests per second, latency
+percentiles and the server's counts (including coalesced searches) as
+JSON.
+
+Usage:
+    python server.py --db /tmp/cookbook.db &
+    python loadtest.py --clients 200 --seconds 10 --writes 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from urllib.parse import quote, urlsplit
+
+from bench import INGREDIENT_NAMES
+
+
+class Client():
+    """A minimal HTTP/1.1 client over one keep-alive connection."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        """Sends a request and returns (status, decoded JSON body or None)."""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        payload = b'' if body is None else json.dumps(body).encode()
+        self.writer.write((f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n'
+                           f'Content-Length: {len(payload)}\r\n\r\n').encode() + payload)
+        head = (await self.reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+        status = int(head.split(' ', 2)[1])
+        length = 0
+        for line in head.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        data = await self.reader.readexactly(length) if length else b''
+        return status, json.loads(data) if data else None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def next_request(rng, max_id, writes, created):
+    """Returns (kind, method, path, body) for one randomly chosen request."""
+    roll = rng.random()
+    if roll < writes and created:
+        recipe_id = rng.choice(created)
+        return 'write', 'PATCH', f'/recipes/{recipe_id}', {'prep_time': f'{rng.randint(1, 60)} mins'}
+    if roll < 0.5:
+        # Searches are skewed towards common ingredients, as real ones are,
+        # so identical searches often overlap and can be coalesced.
+        name = INGREDIENT_NAMES[min(int(rng.expovariate(0.3)), len(INGREDIENT_NAMES) - 1)]
+        return 'search', 'GET', f'/recipes/search?q={quote(name)}', None
+    if roll < 0.6:
+        return 'list', 'GET', f'/recipes?sort=name&limit=20&after={rng.randint(1, max_id)}', None
+    return 'get', 'GET', f'/recipes/{rng.randint(1, max_id)}', None
+
+
+async def run_client(host, port, deadline, max_id, writes, seed, timings, errors):
+    rng = random.Random(seed)
+    client = Client(host, port)
+    created = []
+    try:
+        if writes:
+            status, recipe = await client.request(
+                'POST', '/recipes', {'name': f'load test {seed} {time.time_ns()}'})
+            if status == 201:
+                created.append(recipe['id'])
+        while time.perf_counter() < deadline:
+            kind, method, path, body = next_request(rng, max_id, writes, created)
+            start = time.perf_counter()
+            status, _ = await client.request(method, path, body)
+            timings.setdefault(kind, []).append(time.perf_counter() - start)
+            # Ids picked at random may have been deleted, so 404 is fine.
+            if status >= 400 and status != 404:
+                errors[status] = errors.get(status, 0) + 1
+        for recipe_id in created:
+            await client.request('DELETE', f'/recipes/{recipe_id}')
+    finally:
+        client.close()
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'p50_ms': round(timings[len(timings) // 2] * 1000, 2),
+        'p95_ms': round(timings[int(len(timings) * 0.95)] * 1000, 2),
+        'p99_ms': round(timings[int(len(timings) * 0.99)] * 1000, 2),
+        'mean_ms': round(statistics.fmean(timings) * 1000, 2),
+    }
+
+
+async def load_test(url, clients=100, seconds=10, writes=0.0):
+    """Runs the load test and returns the results as a dict."""
+    url = urlsplit(url)
+    host, port = url.hostname, url.port or 80
+    probe = Client(host, port)
+    _, newest = await probe.request('GET', '/recipes?descending=1&limit=1')
+    _, before = await probe.request('GET', '/stats')
+    max_id = newest[0]['id'] if newest else 1
+
+    timings = {}
+    errors = {}
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        run_client(host, port, start + seconds, max_id, writes, seed, timings, errors)
+        for seed in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    _, after = await probe.request('GET', '/stats')
+    probe.close()
+    total = sum(len(kind_timings) for kind_timings in timings.values())
+    return {
+        'clients': clients,
+        'seconds': round(elapsed, 2),
+        'requests': total,
+        'requests_per_second': round(total / elapsed, 1),
+        'errors': errors,
+        'all': summarize([t for kind_timings in timings.values() for t in kind_timings]),
+        'by_kind': {kind: summarize(kind_timings) for kind, kind_timings in timings.items()},
+        'server': {key: after[key] - before.get(key, 0) for key in after if key != 'workers'},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test a running server.py.')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writes', type=float, default=0.0,
+                        help='share of requests that update a recipe (default: 0)')
+    args = parser.parse_args()
+
+    results = asyncio.run(load_test(args.url, args.clients, args.seconds, args.writes))
+    print(json.dumps(results, indent=2))
@@ -1,6 +1,38 @@
-from recipes import *
+import argparse
+
+from database import configure_database, db
+from metrics import metrics
+from recipes import Recipe
 
 
 if __name__ == '__main__':
-    db.connect()
-    Recipe.menu_loop()
+    parser = argparse.ArgumentParser(description='Manage a database of recipes.')
+    parser.add_argument('--db', help='database file (default: $COOKBOOK_DB or recipes.db)')
+    parser.add_argument('--rebuild-search', action='store_true',
+                        help='rebuild the full-text and ingredient search indexes and exit')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='load the recipes into memory once and serve listings, '
+                             'ingredient searches and ingredient tables from there')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='time queries and menu actions, and write the timings to PATH '
+                             'on exit (Prometheus text if it ends in .prom, else JSON)')
+    parser.add_argument('--slow-ms', type=float, default=100,
+                        help='with --profile, log operations slower than this (default: 100)')
+    args = parser.parse_args()
+
+    configure_database(args.db)
+    if args.profile:
+        metrics.enable(db.obj, args.slow_ms / 1000)
+    try:
+        Recipe.initialize()
+        if args.rebuild_search:
+            from search import IngredientSearch, RecipeSearch
+            RecipeSearch.rebuild_index()
+            IngredientSearch.rebuild_index()
+        else:
+            if args.snapshot:
+                Recipe.enable_snapshot()
+            Recipe.menu_loop()
+    finally:
+        if args.profile:
+            metrics.dump(args.profile)
@@ -1,5 +1,7 @@
 import types
 
+from metrics import metrics
+
 
 class DocStringMenu():
     """Class for looping text-based menu with functions as available options.
@@ -45,7 +47,9 @@ class DocStringMenu():
         if choice == 'q':
             return False
         elif choice in self.menu_dict.keys():
-            self.menu_dict[choice](*args, **kwargs)
+            option = self.menu_dict[choice]
+            with metrics.span('menu.action', getattr(option, '__name__', choice)):
+                option(*args, **kwargs)
         return True
 
     def loop_menu(self, *args, **kwargs):
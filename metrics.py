@@ -0,0 +1,304 @@
+"""Opt-in timing of queries, menu actions and recipe hot paths.
+
+Instrumentation is off until enable() is called. While it is off, span()
+hands back one shared do-nothing context manager and the database is left
+untouched, so instrumented code pays for little more than a function call.
+
+    metrics.enable(db.obj, slow_threshold=0.05)
+    with metrics.span('recipe.render'):
+        ...
+
+    @metrics.timed('service.search')
+    def search(...):
+        ...
+
+    print(metrics.prometheus())
+
+While enabled it records:
+    spans   - a histogram of seconds per span name, and label if given
+    queries - count, total and slowest seconds and rows per SQL statement,
+              timed from execute until SQLite returns the first row
+    slow    - recent spans and queries slower than slow_threshold, which
+              are also written to out as they happen
+
+as_dict() returns everything as JSON-ready data and prometheus() as
+Prometheus text exposition format.
+"""
+import bisect
+import contextlib
+import functools
+import json
+import sys
+import time
+from collections import deque
+
+
+class Histogram():
+    """Counts observations into cumulative buckets, as Prometheus does."""
+
+    # Upper bounds in seconds.
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        """Returns (upper bound, observations at or below it) pairs,
+        ending with ('+Inf', count)."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'max': round(self.max, 6),
+            'buckets': {str(bound): count for bound, count in self.cumulative()},
+        }
+
+
+class Span():
+    """Times a with block and records it in a Metrics when it ends."""
+
+    __slots__ = ('metrics', 'name', 'label', 'start')
+
+    def __init__(self, metrics, name, label):
+        self.metrics = metrics
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.label)
+
+
+class CountingCursor():
+    """Wraps a DB-API cursor to add the rows fetched to a query's stats."""
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.stats['rows'] += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.stats['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.stats['rows'] += len(rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class Metrics():
+    """Registry of spans, query stats and slow operations.
+
+    Parameters:
+        slow_threshold - seconds above which a span or query is logged as slow
+        out - stream slow operations are written to, or None to only keep them
+        max_slow - number of recent slow operations kept
+        max_queries - distinct SQL statements tracked. Any more are counted
+            together under '(other)', since statements such as IN lists of
+            varying length are not bounded.
+    """
+
+    _NULL_SPAN = contextlib.nullcontext()
+
+    def __init__(self, slow_threshold=0.1, out=sys.stderr, max_slow=100, max_queries=500):
+        self.enabled = False
+        self.slow_threshold = slow_threshold
+        self.out = out
+        self.max_queries = max_queries
+        self.spans = {}
+        self.queries = {}
+        self.slow = deque(maxlen=max_slow)
+        self.slow_count = 0
+        self.database = None
+
+    def enable(self, database=None, slow_threshold=None, out=False):
+        """Starts recording, and times every query run on database if given.
+        Leaves slow_threshold and out as they are unless they are given.
+        """
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        if out is not False:
+            self.out = out
+        if database is not None and database is not self.database:
+            self.uninstrument()
+            self.instrument(database)
+        self.enabled = True
+
+    def disable(self):
+        """Stops recording and restores the database. Keeps what was recorded."""
+        self.enabled = False
+        self.uninstrument()
+
+    def reset(self):
+        self.spans.clear()
+        self.queries.clear()
+        self.slow.clear()
+        self.slow_count = 0
+
+    def span(self, name, label=None):
+        """Returns a context manager timing a block under name and label."""
+        if not self.enabled:
+            return self._NULL_SPAN
+        return Span(self, name, label)
+
+    def timed(self, name):
+        """Decorator timing every call of a function as a span."""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Span(self, name, None):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def observe(self, name, seconds, label=None, detail=None):
+        """Records seconds under a span name and label."""
+        histogram = self.spans.get((name, label))
+        if histogram is None:
+            histogram = self.spans[(name, label)] = Histogram()
+        histogram.observe(seconds)
+        if seconds >= self.slow_threshold:
+            self.log_slow(name if label is None else f'{name}[{label}]', seconds, detail)
+
+    def log_slow(self, name, seconds, detail=None):
+        entry = {'name': name, 'ms': round(seconds * 1000, 3), 'at': time.time()}
+        if detail is not None:
+            entry['detail'] = detail
+        self.slow.append(entry)
+        self.slow_count += 1
+        if self.out is not None:
+            message = f'slow {name}: {seconds * 1000:.1f} ms'
+            print(message if detail is None else f'{message}: {detail}', file=self.out)
+
+    def instrument(self, database):
+        """Times every statement run through database.execute_sql, by
+        shadowing the method on the instance so uninstrument() can drop it."""
+        execute_sql = database.execute_sql
+
+        def timed_execute_sql(sql, *args, **kwargs):
+            start = time.perf_counter()
+            cursor = execute_sql(sql, *args, **kwargs)
+            seconds = time.perf_counter() - start
+            if not self.enabled:
+                return cursor
+            stats = self.query_stats(sql)
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if seconds > stats['max_seconds']:
+                stats['max_seconds'] = seconds
+            self.observe('db.query', seconds, detail=sql)
+            if cursor.description is None:
+                stats['rows'] += max(cursor.rowcount, 0)
+                return cursor
+            return CountingCursor(cursor, stats)
+
+        database.execute_sql = timed_execute_sql
+        self.database = database
+
+    def uninstrument(self):
+        if self.database is not None:
+            self.database.__dict__.pop('execute_sql', None)
+            self.database = None
+
+    def query_stats(self, sql):
+        stats = self.queries.get(sql)
+        if stats is None:
+            if len(self.queries) >= self.max_queries:
+                sql = '(other)'
+                stats = self.queries.get(sql)
+            if stats is None:
+                stats = self.queries[sql] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0}
+        return stats
+
+    def as_dict(self):
+        spans = {}
+        for (name, label), histogram in sorted(self.spans.items(), key=lambda item: (
+                item[0][0], item[0][1] or '')):
+            spans.setdefault(name, {})[label or ''] = histogram.as_dict()
+        queries = [dict(stats, sql=sql, seconds=round(stats['seconds'], 6),
+                        max_seconds=round(stats['max_seconds'], 6))
+                   for sql, stats in self.queries.items()]
+        queries.sort(key=lambda stats: stats['seconds'], reverse=True)
+        return {'spans': spans, 'queries': queries, 'slow': list(self.slow)}
+
+    def prometheus(self, prefix='cookbook'):
+        """Returns the spans and query totals in Prometheus text format."""
+        lines = [f'# TYPE {prefix}_span_seconds histogram']
+        for (name, label), histogram in sorted(self.spans.items(), key=lambda item: (
+                item[0][0], item[0][1] or '')):
+            labels = f'span="{_escape(name)}"'
+            if label is not None:
+                labels += f',label="{_escape(label)}"'
+            for bound, count in histogram.cumulative():
+                lines.append(f'{prefix}_span_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{prefix}_span_seconds_sum{{{labels}}} {histogram.sum!r}')
+            lines.append(f'{prefix}_span_seconds_count{{{labels}}} {histogram.count}')
+        totals = {'queries': 0, 'seconds': 0.0, 'rows': 0}
+        for stats in self.queries.values():
+            totals['queries'] += stats['count']
+            totals['seconds'] += stats['seconds']
+            totals['rows'] += stats['rows']
+        lines.append(f'# TYPE {prefix}_db_queries_total counter')
+        lines.append(f'{prefix}_db_queries_total {totals["queries"]}')
+        lines.append(f'# TYPE {prefix}_db_query_seconds_total counter')
+        lines.append(f'{prefix}_db_query_seconds_total {totals["seconds"]!r}')
+        lines.append(f'# TYPE {prefix}_db_rows_total counter')
+        lines.append(f'{prefix}_db_rows_total {totals["rows"]}')
+        lines.append(f'# TYPE {prefix}_slow_operations_total counter')
+        lines.append(f'{prefix}_slow_operations_total {self.slow_count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Writes the metrics to a file, as Prometheus text if the path
+        ends in .prom or .txt and as JSON otherwise."""
+        with open(path, 'w', encoding='utf-8') as f:
+            if path.endswith(('.prom', '.txt')):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.as_dict(), f, indent=2)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The registry the cookbook's modules record into.
+metrics = Metrics()
@@ -0,0 +1,188 @@
+class PantryMatcher():
+    """In-memory inverted index for finding recipes makeable from a pantry.
+
+    Maps each ingredient name to a bitset (a python int) of the recipes
+    that require it. Each recipe owns one bit position. Optional
+    ingredients are left out of the index, since a recipe can be made
+    without them.
+
+    The number of required ingredients per recipe is stored bit-sliced:
+    count_planes[i] holds bit i of every recipe's count. A query adds up
+    the bitsets of the pantry items the same way, subtracts the sums from
+    the required counts, and reads off the recipes missing 0..k
+    ingredients. Every step works on whole bitsets at once, so the cost
+    of a query does not grow with a python loop over the recipes.
+
+    Ingredient names should be normalized by the caller.
+
+        matcher = PantryMatcher()
+        matcher.load(recipe_ids, ingredient_rows)
+        matcher.matches(['bread', 'butter', 'garlic salt'], max_missing=1)
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.recipe_ids = []
+        self.free_slots = []
+        self.live = 0
+        self.required = {}
+        self.recipe_required = {}
+        self.count_planes = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def load(self, recipe_ids, ingredient_rows):
+        """Builds the index from scratch.
+
+        Parameters:
+            recipe_ids - ids of every recipe, including ones without ingredients
+            ingredient_rows - (recipe id, ingredient name, optional) tuples
+        """
+        self.__init__()
+        required = {recipe_id: set() for recipe_id in recipe_ids}
+        for recipe_id, name, optional in ingredient_rows:
+            if not optional:
+                required.setdefault(recipe_id, set()).add(name)
+
+        postings = {}
+        counts = []
+        for slot, (recipe_id, names) in enumerate(required.items()):
+            self.slots[recipe_id] = slot
+            self.recipe_ids.append(recipe_id)
+            self.recipe_required[slot] = frozenset(names)
+            counts.append(len(names))
+            for name in names:
+                postings.setdefault(name, []).append(slot)
+
+        size = len(self.recipe_ids)
+        self.live = (1 << size) - 1
+        self.required = {name: self._bitset(slots, size)
+                         for name, slots in postings.items()}
+        for i in range(max(counts, default=0).bit_length()):
+            self.count_planes.append(self._bitset(
+                (slot for slot, count in enumerate(counts) if (count >> i) & 1),
+                size))
+
+    def add_recipe(self, recipe_id, ingredients):
+        """Adds a recipe to the index, replacing it if already present.
+        Takes an iterable of (ingredient name, optional) tuples.
+        """
+        if recipe_id in self.slots:
+            self.remove_recipe(recipe_id)
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.recipe_ids[slot] = recipe_id
+        else:
+            slot = len(self.recipe_ids)
+            self.recipe_ids.append(recipe_id)
+        self.slots[recipe_id] = slot
+
+        bit = 1 << slot
+        self.live |= bit
+        names = frozenset(name for name, optional in ingredients if not optional)
+        self.recipe_required[slot] = names
+        for name in names:
+            self.required[name] = self.required.get(name, 0) | bit
+        self._set_count(slot, len(names))
+
+    def remove_recipe(self, recipe_id):
+        """Removes a recipe from the index. Does nothing if it is not indexed."""
+        slot = self.slots.pop(recipe_id, None)
+        if slot is None:
+            return
+        bit = 1 << slot
+        for name in self.recipe_required.pop(slot):
+            remaining = self.required[name] & ~bit
+            if remaining:
+                self.required[name] = remaining
+            else:
+                del self.required[name]
+        self._set_count(slot, 0)
+        self.live &= ~bit
+        self.recipe_ids[slot] = None
+        self.free_slots.append(slot)
+
+    def matches(self, pantry, max_missing=0, limit=None):
+        """Returns (recipe id, missing count) tuples for every recipe missing
+        at most max_missing required ingredients, fewest missing first.
+        """
+        missing = self._missing_planes(self._hit_planes(pantry))
+        results = []
+        for missing_count in range(max_missing + 1):
+            for slot in self._iter_bits(self._equal(missing, missing_count)):
+                results.append((self.recipe_ids[slot], missing_count))
+                if limit is not None and len(results) >= limit:
+                    return results
+        return results
+
+    def makeable(self, pantry, limit=None):
+        """Returns the ids of recipes that need nothing outside the pantry."""
+        return [recipe_id for recipe_id, _ in self.matches(pantry, 0, limit)]
+
+    def missing_ingredients(self, recipe_id, pantry):
+        """Returns the sorted required ingredients of a recipe not in the pantry."""
+        slot = self.slots[recipe_id]
+        return sorted(self.recipe_required[slot].difference(pantry))
+
+    def _set_count(self, slot, count):
+        bit = 1 << slot
+        while count.bit_length() > len(self.count_planes):
+            self.count_planes.append(0)
+        for i, plane in enumerate(self.count_planes):
+            if (count >> i) & 1:
+                self.count_planes[i] = plane | bit
+            else:
+                self.count_planes[i] = plane & ~bit
+
+    def _hit_planes(self, pantry):
+        """Bit-sliced count of how many required ingredients of each
+        recipe are in the pantry, added up with a ripple-carry adder."""
+        planes = []
+        for name in set(pantry):
+            carry = self.required.get(name, 0)
+            i = 0
+            while carry:
+                if i == len(planes):
+                    planes.append(carry)
+                    break
+                planes[i], carry = planes[i] ^ carry, planes[i] & carry
+                i += 1
+        return planes
+
+    def _missing_planes(self, hit_planes):
+        """Bit-sliced required count minus hit count, per recipe."""
+        planes = []
+        borrow = 0
+        for i, count in enumerate(self.count_planes):
+            hits = hit_planes[i] if i < len(hit_planes) else 0
+            planes.append(count ^ hits ^ borrow)
+            borrow = (((self.live ^ count) & (hits | borrow))
+                      | (count & hits & borrow))
+        return planes
+
+    def _equal(self, planes, value):
+        """Bitset of recipes whose bit-sliced number equals value."""
+        if value >> len(planes):
+            return 0
+        result = self.live
+        for i, plane in enumerate(planes):
+            result &= plane if (value >> i) & 1 else self.live ^ plane
+            if not result:
+                break
+        return result
+
+    @staticmethod
+    def _bitset(slots, size):
+        bits = bytearray(size // 8 + 1)
+        for slot in slots:
+            bits[slot >> 3] |= 1 << (slot & 7)
+        return int.from_bytes(bits, 'little')
+
+    @staticmethod
+    def _iter_bits(bitset):
+        bits = bin(bitset)[:1:-1]
+        position = bits.find('1')
+        while position != -1:
+            yield position
+            position = bits.find('1', position + 1)
@@ -0,0 +1,460 @@
+"""Parses ingredient amounts and units into numbers, and scales and
+converts them between US and metric units.
+
+Amounts are free text such as '2', '1/2', '1 1/2', '1½', '0.25' or '1-2'.
+A parsed Quantity holds the low and high ends of the amount in the base
+unit of its dimension (millilitres for volume, grams for mass) or, for
+units that cannot be converted like 'slices', in that unit:
+
+    >>> parse_quantity('1 1/2', 'cups')
+    Quantity(low=354.88..., high=354.88..., unit=Unit(name='cup', ...))
+    >>> format_quantity(scale(parse_quantity('1 1/2', 'cups'), 2))
+    ('3', 'cup')
+    >>> format_quantity(parse_quantity('1 1/2', 'cups'), 'metric')
+    ('355', 'ml')
+
+Parsing is cached, since the same few amounts and units make up most of
+a cookbook. QuantityTable holds many quantities as columns of arrays so a
+whole cookbook can be scaled or summed without a Python loop per dict.
+"""
+import itertools
+import json
+import operator
+import re
+from array import array
+from collections import namedtuple
+from fractions import Fraction
+from functools import lru_cache
+
+
+# name is the unit shown, dimension is 'volume', 'mass' or 'count', factor
+# is how many base units (ml or g) one of it is and system is 'us',
+# 'metric' or None for units that belong to neither.
+Unit = namedtuple('Unit', 'name dimension factor system')
+Quantity = namedtuple('Quantity', 'low high unit')
+
+SYSTEMS = ('us', 'metric')
+
+_UNITS = (
+    (('tsp', 'tsps', 'teaspoon', 'teaspoons', 't'), Unit('tsp', 'volume', 4.92892159375, 'us')),
+    (('Tbsp', 'tbsp', 'tbsps', 'tbs', 'tablespoon', 'tablespoons', 'T'),
+     Unit('Tbsp', 'volume', 14.78676478125, 'us')),
+    (('fl oz', 'fluid ounce', 'fluid ounces'), Unit('fl oz', 'volume', 29.5735295625, 'us')),
+    (('cup', 'cups', 'c'), Unit('cup', 'volume', 236.5882365, 'us')),
+    (('pint', 'pints', 'pt'), Unit('pint', 'volume', 473.176473, 'us')),
+    (('quart', 'quarts', 'qt'), Unit('quart', 'volume', 946.352946, 'us')),
+    (('gallon', 'gallons', 'gal'), Unit('gallon', 'volume', 3785.411784, 'us')),
+    (('ml', 'milliliter', 'milliliters', 'millilitre', 'millilitres'),
+     Unit('ml', 'volume', 1.0, 'metric')),
+    (('cl', 'centiliter', 'centiliters', 'centilitre', 'centilitres'),
+     Unit('cl', 'volume', 10.0, 'metric')),
+    (('dl', 'deciliter', 'deciliters', 'decilitre', 'decilitres'),
+     Unit('dl', 'volume', 100.0, 'metric')),
+    (('l', 'liter', 'liters', 'litre', 'litres'), Unit('l', 'volume', 1000.0, 'metric')),
+    (('oz', 'ounce', 'ounces'), Unit('oz', 'mass', 28.349523125, 'us')),
+    (('lb', 'lbs', 'pound', 'pounds'), Unit('lb', 'mass', 453.59237, 'us')),
+    (('mg', 'milligram', 'milligrams'), Unit('mg', 'mass', 0.001, 'metric')),
+    (('g', 'gram', 'grams', 'gramme', 'grammes'), Unit('g', 'mass', 1.0, 'metric')),
+    (('kg', 'kilogram', 'kilograms'), Unit('kg', 'mass', 1000.0, 'metric')),
+)
+UNITS = {alias: unit for aliases, unit in _UNITS for alias in aliases}
+# Lowercase aliases, tried after an exact match so 't' and 'T' stay apart.
+_UNITS_LOWER = {alias.lower(): unit for alias, unit in reversed(list(UNITS.items()))}
+
+# The units amounts are shown in when converting to a system, from the
+# largest down. The first whose amount is at least its threshold is used.
+DISPLAY_UNITS = {
+    ('us', 'volume'): ((UNITS['gallon'], 4), (UNITS['cup'], 0.25), (UNITS['Tbsp'], 1),
+                       (UNITS['tsp'], 0)),
+    ('us', 'mass'): ((UNITS['lb'], 1), (UNITS['oz'], 0)),
+    ('metric', 'volume'): ((UNITS['l'], 1), (UNITS['ml'], 0)),
+    ('metric', 'mass'): ((UNITS['kg'], 1), (UNITS['g'], 0)),
+}
+
+VULGAR_FRACTIONS = {
+    '½': '1/2', '⅓': '1/3', '⅔': '2/3', '¼': '1/4', '¾': '3/4', '⅕': '1/5',
+    '⅖': '2/5', '⅗': '3/5', '⅘': '4/5', '⅙': '1/6', '⅚': '5/6', '⅛': '1/8',
+    '⅜': '3/8', '⅝': '5/8', '⅞': '7/8',
+}
+_VULGAR_RE = re.compile('([0-9]?)([' + ''.join(VULGAR_FRACTIONS) + '])')
+_NUMBER = r'(?:\d+\s+\d+\s*/\s*\d+|\d+\s*/\s*\d+|\d*\.\d+|\d+)'
+_AMOUNT_RE = re.compile(
+    rf'^\s*(?P<low>{_NUMBER})(?:\s*(?:-|–|to)\s*(?P<high>{_NUMBER}))?\s*(?P<rest>.*?)\s*$')
+
+# Amounts in US units are rounded to the nearest eighth or third.
+US_DENOMINATORS = (8, 3)
+
+
+def _number(text):
+    whole, _, fraction = text.strip().rpartition(' ')
+    if '/' in fraction:
+        numerator, denominator = fraction.split('/')
+        value = int(numerator) / int(denominator)
+    else:
+        whole, value = '', float(fraction)
+    return value + (int(whole) if whole.strip() else 0)
+
+
+def parse_amount(amount):
+    """Returns (low, high, rest) for an amount, where rest is any text after
+    the numbers, or None if the amount does not start with a number.
+    """
+    if isinstance(amount, bool):
+        return None
+    if isinstance(amount, (int, float)):
+        return float(amount), float(amount), ''
+    text = _VULGAR_RE.sub(
+        lambda match: f'{match.group(1)} {VULGAR_FRACTIONS[match.group(2)]}', str(amount))
+    match = _AMOUNT_RE.match(text)
+    if match is None:
+        return None
+    try:
+        low = _number(match.group('low').replace(' /', '/').replace('/ ', '/'))
+        high = match.group('high')
+        high = low if high is None else _number(high.replace(' /', '/').replace('/ ', '/'))
+    except ZeroDivisionError:
+        return None
+    return low, high, match.group('rest')
+
+
+# Seconds per unit of a duration, by lowercased name. The one-letter
+# names cover ISO 8601 durations such as 'PT1H30M'.
+DURATION_UNITS = {
+    **dict.fromkeys(('s', 'sec', 'secs', 'second', 'seconds'), 1),
+    **dict.fromkeys(('m', 'min', 'mins', 'minute', 'minutes'), 60),
+    **dict.fromkeys(('h', 'hr', 'hrs', 'hour', 'hours'), 3600),
+    **dict.fromkeys(('d', 'day', 'days'), 86400),
+}
+_DURATION_PART_RE = re.compile(
+    rf'(?P<low>{_NUMBER})(?:\s*(?:-|–|to)\s*(?P<high>{_NUMBER}))?\s*(?P<unit>[a-z]*)',
+    re.IGNORECASE)
+_CLOCK_RE = re.compile(r'^\s*(\d+):(\d{2})(?::(\d{2})(?:\.\d+)?)?\s*$')
+
+
+def parse_duration(text):
+    """Returns the number of seconds in a duration such as '5 mins',
+    '1 hr 30 mins', '1 1/2 hours', 'PT20M' or '1:30' (hours and minutes),
+    or None if it does not give one. A range such as '5-10 mins' counts
+    as its upper end, and a number without a unit as minutes.
+    """
+    if text is None:
+        return None
+    text = _VULGAR_RE.sub(
+        lambda match: f'{match.group(1)} {VULGAR_FRACTIONS[match.group(2)]}', str(text))
+    match = _CLOCK_RE.match(text)
+    if match is not None:
+        hours, minutes, seconds = match.groups()
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds or 0)
+    total = None
+    for match in _DURATION_PART_RE.finditer(text):
+        unit = match.group('unit').lower()
+        if unit and unit not in DURATION_UNITS:
+            continue
+        try:
+            value = _number((match.group('high') or match.group('low'))
+                            .replace(' /', '/').replace('/ ', '/'))
+        except ZeroDivisionError:
+            continue
+        total = (total or 0) + value * DURATION_UNITS.get(unit, 60)
+    return None if total is None else round(total)
+
+
+def find_unit(units):
+    """Returns the Unit for a units string. Units that are not known are
+    returned as a count of that unit, like 'slices' or 'cloves'.
+    """
+    units = ' '.join(str(units or '').split()).rstrip('.')
+    unit = UNITS.get(units) or _UNITS_LOWER.get(units.lower())
+    if unit is None:
+        return Unit(units, 'count', 1.0, None)
+    return unit
+
+
+@lru_cache(maxsize=4096, typed=True)
+def parse_quantity(amount, units):
+    """Returns the Quantity for an ingredient amount and units, or None if
+    the amount is not a number. If units is empty, units written after the
+    number in the amount (as in '2 cups') are used.
+    """
+    parsed = parse_amount(amount)
+    if parsed is None:
+        return None
+    low, high, rest = parsed
+    unit = find_unit(units if units or not rest else rest)
+    return Quantity(low * unit.factor, high * unit.factor, unit)
+
+
+# Words taken as the units of an ingredient line though they cannot be
+# converted, as in '2 cloves garlic'.
+COUNT_UNITS = frozenset((
+    'bunch', 'bunches', 'can', 'cans', 'clove', 'cloves', 'dash', 'dashes', 'drop',
+    'drops', 'handful', 'handfuls', 'head', 'heads', 'jar', 'jars', 'package',
+    'packages', 'packet', 'packets', 'piece', 'pieces', 'pinch', 'pinches', 'slice',
+    'slices', 'sprig', 'sprigs', 'stalk', 'stalks', 'stick', 'sticks',
+))
+_OPTIONAL_RE = re.compile(r'\s*(?:\(\s*optional\s*\)|,?\s*\boptional\b)\s*', re.IGNORECASE)
+
+
+def _line_unit(rest):
+    """Returns (units, rest after them) for the text after an amount."""
+    words = rest.split(None, 2)
+    if len(words) >= 2 and ' '.join(words[:2]).lower() in _UNITS_LOWER:
+        return ' '.join(words[:2]), ' '.join(words[2:])
+    if words:
+        word = words[0].rstrip('.')
+        if word in UNITS or word.lower() in _UNITS_LOWER or word.lower() in COUNT_UNITS:
+            return word, rest.split(None, 1)[1] if len(words) > 1 else ''
+    return '', rest
+
+
+def parse_ingredient_line(line):
+    """Splits a written ingredient such as '2 1/2 cups flour, sifted' into
+    an ingredient dict like the ones the recipe menus build. Text after the
+    first comma is the prep, and '(optional)' marks it optional.
+    """
+    line = ' '.join(str(line).split())
+    optional = _OPTIONAL_RE.search(line) is not None
+    line = _OPTIONAL_RE.sub(' ', line).strip(' ,:;')
+    amount, units, prep = '', '', []
+    parsed = parse_amount(line)
+    if parsed is not None:
+        rest = parsed[2]
+        amount = _VULGAR_RE.sub(
+            lambda match: f'{match.group(1)} {VULGAR_FRACTIONS[match.group(2)]}', line)
+        amount = ' '.join(amount[:len(amount) - len(rest)].split())
+        # A size in brackets, as in '1 (14 oz) can tomatoes', is kept as prep.
+        if rest.startswith('(') and ')' in rest:
+            size, _, rest = rest[1:].partition(')')
+            prep.append(size.strip())
+        units, line = _line_unit(rest.strip())
+    name, _, after = line.partition(',')
+    if after.strip():
+        prep.append(after.strip())
+    return {
+        'ingredient_name': name.strip() or line.strip(),
+        'ingredient_amount': amount,
+        'ingredient_units': units,
+        'optional': optional,
+        'prep': ', '.join(prep),
+    }
+
+
+@lru_cache(maxsize=1024)
+def parse_ingredient_list(ingredient_list):
+    """Returns a tuple with the Quantity of each ingredient in an
+    ingredient_list JSON string (or None where there is none). Cached by
+    the string, so a recipe is parsed again only when its list changes.
+    """
+    return tuple(parse_quantity(_hashable(item.get('ingredient_amount')),
+                                item.get('ingredient_units'))
+                 for item in json.loads(ingredient_list))
+
+
+def _hashable(amount):
+    return amount if isinstance(amount, (str, int, float)) or amount is None else str(amount)
+
+
+def scale(quantity, factor):
+    return Quantity(quantity.low * factor, quantity.high * factor, quantity.unit)
+
+
+def display_unit(quantity, system=None):
+    """Returns the unit a quantity is best shown in. With no system, that
+    is the unit it was written in.
+    """
+    unit = quantity.unit
+    if system is None or unit.dimension == 'count':
+        return unit
+    if system not in SYSTEMS:
+        raise ValueError(f'unknown unit system {system!r}')
+    for candidate, threshold in DISPLAY_UNITS[system, unit.dimension]:
+        if quantity.low / candidate.factor >= threshold:
+            return candidate
+    return candidate
+
+
+def format_number(value, unit):
+    """Formats an amount for a unit: US and count units as whole numbers
+    and eighths or thirds ('1 1/2'), metric units as decimals.
+    """
+    if unit.system == 'metric':
+        if value >= 100:
+            return str(round(value))
+        return f'{value:.3g}' if value >= 1 else f'{value:.2g}'
+    fraction = min((Fraction(round(value * denominator), denominator)
+                    for denominator in US_DENOMINATORS),
+                   key=lambda fraction: abs(fraction - value))
+    if fraction == 0 and value > 0:
+        fraction = Fraction(1, US_DENOMINATORS[0])
+    whole, part = divmod(fraction, 1)
+    if not part:
+        return str(whole)
+    part = f'{part.numerator}/{part.denominator}'
+    return f'{whole} {part}' if whole else part
+
+
+def format_quantity(quantity, system=None):
+    """Returns (amount, units) text for a quantity, in its own unit or
+    converted to the 'us' or 'metric' system."""
+    unit = display_unit(quantity, system)
+    low = format_number(quantity.low / unit.factor, unit)
+    high = format_number(quantity.high / unit.factor, unit)
+    return (low if low == high else f'{low}-{high}'), unit.name
+
+
+def scale_ingredients(ingr_json, quantities, factor=1, system=None):
+    """Returns copies of ingredient dicts with amounts multiplied by factor
+    and, if system is given, converted to it. Ingredients whose amount is
+    not a number are copied unchanged.
+
+    Parameters:
+        ingr_json - list of ingredient dicts
+        quantities - the Quantity of each, as from parse_ingredient_list
+        factor - number to multiply amounts by
+        system - 'us', 'metric' or None to keep the units as written
+    """
+    scaled = []
+    for item, quantity in zip(ingr_json, quantities):
+        item = dict(item)
+        if quantity is not None and (factor != 1 or system is not None):
+            item['ingredient_amount'], item['ingredient_units'] = format_quantity(
+                scale(quantity, factor), system)
+        scaled.append(item)
+    return scaled
+
+
+class QuantityTable():
+    """Quantities of many ingredients held as columns, for scaling or
+    summing a whole cookbook at once.
+
+    Quantities that could not be parsed are left out. lows and highs are
+    arrays of doubles in base units; the arithmetic on them runs through
+    map() and operator functions rather than a loop per ingredient.
+    """
+
+    def __init__(self, recipe_ids=(), names=(), lows=(), highs=(), units=()):
+        self.recipe_ids = array('q', recipe_ids)
+        self.names = list(names)
+        self.lows = array('d', lows)
+        self.highs = array('d', highs)
+        self.units = list(units)
+
+    def __len__(self):
+        return len(self.recipe_ids)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds a table from (recipe_id, name, amount, units) rows."""
+        table = cls()
+        for recipe_id, name, amount, units in rows:
+            quantity = parse_quantity(amount, units)
+            if quantity is not None:
+                table.recipe_ids.append(recipe_id)
+                table.names.append(name)
+                table.lows.append(quantity.low)
+                table.highs.append(quantity.high)
+                table.units.append(quantity.unit)
+        return table
+
+    def scaled(self, factors, default=1.0):
+        """Returns a new table with each recipe's quantities multiplied.
+
+        Parameters:
+            factors - dict of recipe id to factor
+            default - factor for recipes not in factors
+        """
+        column = array('d', map(factors.get, self.recipe_ids, itertools.repeat(default)))
+        return QuantityTable(self.recipe_ids, self.names,
+                             map(operator.mul, self.lows, column),
+                             map(operator.mul, self.highs, column), self.units)
+
+    def totals(self):
+        """Returns a dict of (name, dimension or count unit name) to the summed
+        Quantity. Volumes and masses written in different units are added
+        together; units that cannot be converted are only added to the same unit.
+        """
+        totals = {}
+        for name, low, high, unit in zip(self.names, self.lows, self.highs, self.units):
+            key = (name, unit.name if unit.dimension == 'count' else unit.dimension)
+            total = totals.get(key)
+            if total is None:
+                totals[key] = Quantity(low, high, unit)
+            else:
+                # Keep the larger unit, so teaspoons and cups add up to cups.
+                totals[key] = Quantity(total.low + low, total.high + high,
+                                       max(total.unit, unit, key=operator.attrgetter('factor')))
+        return totals
+
+    def formatted(self, system=None):
+        """Yields (recipe_id, name, amount, units) text for each quantity."""
+        for recipe_id, name, low, high, unit in zip(
+                self.recipe_ids, self.names, self.lows, self.highs, self.units):
+            yield (recipe_id, name) + format_quantity(Quantity(low, high, unit), system)
+
+
+def combine_ingredients(recipes, system=None):
+    """Merges the ingredients of several recipes into one shopping list.
+
+    Ingredients with the same name are merged when their quantities can be
+    added: volumes with volumes and masses with masses, whatever units they
+    were written in, and other units only with the same unit. Optional
+    ingredients are kept apart from required ones. Amounts that are not
+    numbers, like 'to taste', are listed as written.
+
+    Parameters:
+        recipes - iterable of (recipe_id, factor, ingr_json, quantities),
+            where quantities is as from parse_ingredient_list
+        system - 'us', 'metric' or None to show sums in the largest unit
+            they were written in
+
+    Returns a list of ingredient dicts, required ingredients first, each
+    with a 'recipes' list of the ids of the recipes that use it.
+    """
+    merged = {}
+    for recipe_id, factor, ingr_json, quantities in recipes:
+        for item, quantity in zip(ingr_json, quantities):
+            name = ' '.join(str(item.get('ingredient_name') or '').split())
+            optional = bool(item.get('optional'))
+            if quantity is None:
+                unit_key = None
+            elif quantity.unit.dimension == 'count':
+                unit_key = quantity.unit.name
+            else:
+                unit_key = quantity.unit.dimension
+            key = (optional, name.lower(), unit_key)
+            entry = merged.get(key)
+            if entry is None:
+                entry = merged[key] = {'name': name, 'low': 0.0, 'high': 0.0, 'unit': None,
+                                       'amounts': [], 'preps': [], 'recipes': []}
+            if quantity is None:
+                amount = str(item.get('ingredient_amount') or '').strip()
+                if amount and amount not in entry['amounts']:
+                    entry['amounts'].append(amount)
+            else:
+                entry['low'] += quantity.low * factor
+                entry['high'] += quantity.high * factor
+                if entry['unit'] is None or quantity.unit.factor > entry['unit'].factor:
+                    entry['unit'] = quantity.unit
+            prep = str(item.get('prep') or '').strip()
+            if prep and prep not in entry['preps']:
+                entry['preps'].append(prep)
+            if recipe_id not in entry['recipes']:
+                entry['recipes'].append(recipe_id)
+
+    items = []
+    for (optional, _, _), entry in sorted(merged.items(),
+                                         key=lambda item: (item[0][:2], item[0][2] or '')):
+        if entry['unit'] is None:
+            amount, units = ' + '.join(entry['amounts']), ''
+        else:
+            amount, units = format_quantity(
+                Quantity(entry['low'], entry['high'], entry['unit']), system)
+        items.append({
+            'ingredient_name': entry['name'],
+            'ingredient_amount': amount,
+            'ingredient_units': units,
+            'optional': optional,
+            'prep': '; '.join(entry['preps']),
+            'recipes': entry['recipes'],
+        })
+    return items
@@ -1,11 +1,23 @@
+from database import db
 from menu import DocStringMenu, RecipeMenu
+from metrics import metrics
+import copy
 import datetime
+import itertools
 import json
+import operator
+import os
+import sys
 
 from collections import OrderedDict
+from functools import reduce
 from peewee import *
 
-db = SqliteDatabase('recipes.db')
+# cache, fuzzy, pantry, quantities, similarity, snapshot, table and search
+# (which loads playhouse.sqlite_ext) are imported where they are first
+# used. Most runs need few of them, and each adds to the start up time
+# of every run. db opens the default database on first use, see
+# database.py.
 
 
 class Recipe(Model):
@@ -15,31 +27,149 @@ class Recipe(Model):
     prep_time = TimeField(null=True)
     cook_time = TimeField(null=True)
     instructions = TextField(null=True)
+    version = IntegerField(default=1)
+    servings = IntegerField(null=True)
+    # prep_time and cook_time as parsed by parse_duration, so recipes can be
+    # filtered by time with an index. total_seconds sums the known ones.
+    prep_seconds = IntegerField(null=True, index=True)
+    cook_seconds = IntegerField(null=True, index=True)
+    total_seconds = IntegerField(null=True, index=True)
 
     class Meta:
         database = db
         db_table = 'recipes'
 
-    IDX_HEADER_WIDTH = 7
-    INGR_HEADER_WIDTH = 40
-    AMT_HEADER_WIDTH = 10
-    UNIT_HEADER_WIDTH = 10
-    PREP_HEADER_WIDTH = 30
-    OPT_HEADER_WIDTH = 10
+    # Columns added after databases were first created, with the SQL
+    # used to add them to an existing recipes table.
+    ADDED_COLUMNS = (
+        ('version', 'INTEGER NOT NULL DEFAULT 1'),
+        ('servings', 'INTEGER'),
+        ('prep_seconds', 'INTEGER'),
+        ('cook_seconds', 'INTEGER'),
+        ('total_seconds', 'INTEGER'),
+    )
 
-    idx_header_str = 'Index'.center(IDX_HEADER_WIDTH)
-    ingr_header_str = 'Ingredient'.center(INGR_HEADER_WIDTH)
-    amt_header_str = 'Amount'.center(AMT_HEADER_WIDTH)
-    unit_header_str = 'Unit'.center(UNIT_HEADER_WIDTH)
-    prep_header_str = 'Prep'.center(PREP_HEADER_WIDTH)
-    opt_header_str = 'Optional'.center(OPT_HEADER_WIDTH)
+    # Text columns and the duration columns parsed from them.
+    DURATION_COLUMNS = {'prep_time': 'prep_seconds', 'cook_time': 'cook_seconds'}
 
-    ING_HEADER_STR = f'|{idx_header_str}|{ingr_header_str}|{amt_header_str}|{unit_header_str}|{prep_header_str}|{opt_header_str}|\n'
+    # Columns of the ingredients table printed by render_ingredients, as
+    # TableColumn arguments.
+    INGREDIENT_COLUMNS = (
+        ('index', 'Index', '>'),
+        ('ingredient_name', 'Ingredient'),
+        ('ingredient_amount', 'Amount'),
+        ('ingredient_units', 'Unit'),
+        ('prep', 'Prep'),
+        ('optional', 'Optional', '^', lambda optional: 'y' if optional else 'n'),
+    )
+
+    # Recipe names listed per page by view_recipes.
+    PAGE_SIZE = 20
+
+    INGREDIENT_KEYS = frozenset((
+        'ingredient_name', 'ingredient_amount', 'ingredient_units', 'optional', 'prep'))
+
+    pantry_matcher = None
+    name_index = None
+    snapshot = None
+    recipe_cache = None
+    _version_sql = None
+
+    # Callables run as listener(recipe_id, name) whenever a recipe is
+    # created or renamed, or with name=None when it is deleted.
+    name_listeners = []
+
+    # Stored in the database's user_version once its tables, columns,
+    # indexes and triggers are up to date. Bump it whenever any of them
+    # change so that initialize() upgrades existing databases.
+    SCHEMA_VERSION = 6
 
     @staticmethod
     def initialize():
-        db.connect()
-        db.create_tables([Recipe], safe=True)
+        """Creates or upgrades the tables, indexes and triggers. Databases
+        already at SCHEMA_VERSION are left alone, so this costs a single
+        query on every run after the first."""
+        if db.pragma('user_version') == Recipe.SCHEMA_VERSION:
+            return
+        from search import IngredientSearch, RecipeSearch
+        migrate_ingredients = not Ingredient.table_exists()
+        build_search = not RecipeSearch.table_exists()
+        build_ingredient_search = not IngredientSearch.table_exists()
+        if Recipe.table_exists():
+            # create_tables also creates the indexes on added columns,
+            # so an older table needs the columns first.
+            Recipe.add_missing_columns()
+        if RecipeChange.table_exists():
+            RecipeChange.migrate_to_log()
+        db.create_tables([Recipe, Ingredient, RecipeSearch, IngredientSearch, RecipeChange,
+                          RecipeChangeCompaction, RecipeSignature, RecipeBand], safe=True)
+        RecipeSearch.create_triggers()
+        IngredientSearch.create_triggers()
+        RecipeChange.create_triggers()
+        RecipeSignature.create_triggers()
+        if migrate_ingredients:
+            Ingredient.migrate_from_json()
+        if build_search:
+            RecipeSearch.rebuild_index()
+        if build_ingredient_search:
+            IngredientSearch.rebuild_index()
+        Recipe.backfill_durations()
+        db.pragma('user_version', Recipe.SCHEMA_VERSION)
+
+    @classmethod
+    def add_missing_columns(cls):
+        """Adds columns from ADDED_COLUMNS that an older recipes table lacks."""
+        existing = {column.name for column in db.get_columns(cls._meta.table_name)}
+        for column, definition in cls.ADDED_COLUMNS:
+            if column not in existing:
+                db.execute_sql(
+                    f'ALTER TABLE {cls._meta.table_name} ADD COLUMN {column} {definition}')
+
+    @staticmethod
+    def total_seconds_of(prep_seconds, cook_seconds):
+        if prep_seconds is None and cook_seconds is None:
+            return None
+        return (prep_seconds or 0) + (cook_seconds or 0)
+
+    @classmethod
+    def with_durations(cls, values):
+        """Returns a dict of column values with the duration columns added
+        for any prep_time or cook_time in it. If only one of the two is
+        given, as in an update, total_seconds is an SQL expression over
+        the other's current value.
+        """
+        from quantities import parse_duration
+        values = dict(values)
+        for field, column in cls.DURATION_COLUMNS.items():
+            if field in values:
+                values[column] = parse_duration(values[field])
+        if 'prep_seconds' in values and 'cook_seconds' in values:
+            values['total_seconds'] = cls.total_seconds_of(
+                values['prep_seconds'], values['cook_seconds'])
+        elif 'prep_seconds' in values or 'cook_seconds' in values:
+            prep, cook = (Value(values[column]) if column in values else getattr(cls, column)
+                          for column in ('prep_seconds', 'cook_seconds'))
+            values['total_seconds'] = fn.coalesce(prep + cook, prep, cook)
+        return values
+
+    @classmethod
+    def backfill_durations(cls):
+        """Fills in the duration columns of recipes that have a prep or
+        cook time but no parsed duration, as after the columns are added."""
+        from quantities import parse_duration
+        rows = db.execute_sql(
+            'SELECT id, prep_time, cook_time FROM recipes '
+            'WHERE (prep_time IS NOT NULL AND prep_seconds IS NULL) '
+            'OR (cook_time IS NOT NULL AND cook_seconds IS NULL)').fetchall()
+        params = []
+        for recipe_id, prep_time, cook_time in rows:
+            prep_seconds, cook_seconds = parse_duration(prep_time), parse_duration(cook_time)
+            params.append((prep_seconds, cook_seconds,
+                           cls.total_seconds_of(prep_seconds, cook_seconds), recipe_id))
+        with db.atomic():
+            db.cursor().executemany(
+                'UPDATE recipes SET prep_seconds = ?, cook_seconds = ?, total_seconds = ? '
+                'WHERE id = ?', params)
 
     @classmethod
     def menu_loop(cls):
@@ -47,8 +177,13 @@ class Recipe(Model):
         main_menu_options = (
             cls.view_recipes,
             cls.search_recipes,
+            cls.full_text_search,
+            cls.what_can_i_cook,
+            cls.similar_recipes,
             cls.print_ingredients,
             cls.show_whole_recipe,
+            cls.scale_recipe,
+            cls.shopping_list,
             cls.add_recipe,
             cls.modify_recipe,
             cls.delete_recipe,
@@ -61,51 +196,61 @@ class Recipe(Model):
     def modify_recipe(cls, *args, **kwargs):
         """Modify recipe.
         Menu to select options for modifying a single recipe.
+
+        Changes are made to an edit session and saved together, in one
+        transaction, when leaving the menu or choosing to save.
         """
         modify_recipe_options = (
             cls.update_name,
             cls.modify_ingredients,
             cls.update_prep_time,
             cls.update_cook_time,
+            cls.update_servings,
             cls.update_instructions,
+            cls.undo_change,
+            cls.discard_changes,
+            cls.save_changes,
         )
-        recipe = cls.select_recipe()
+        session = RecipeEditSession(cls.select_recipe())
         mod_recipe_menu = RecipeMenu(
             modify_recipe_options)
 
         loop_dict = {
-            'kwargs_to_refresh': {'recipe': recipe},
+            'kwargs_to_refresh': {'session': session},
             'run_before': cls.show_whole_recipe,
-            'run_after': cls.refresh_recipe,
-
         }
         mod_recipe_menu.loop_menu(**loop_dict)
+        if session.changed:
+            if input(f'Save changes to {session.values["name"]}? [Y/n]:  ').lower() != 'n':
+                cls.save_changes(session=session)
+            else:
+                print(f'{session.values["name"]} not updated')
 
     @classmethod
     def modify_ingredients(cls, *args, **kwargs):
         """Add, delete, or modify ingredients.
         Menu for modifying the ingredients of a recipe
 
-        Required parameter: 'recipe' in kwargs
+        Required parameter: 'session' in kwargs
         """
-        recipe = kwargs.get('recipe')
+        session = kwargs.get('session')
         modify_ingredients_options = (
             cls.add_ingredient,
             cls.delete_ingredient,
             cls.modify_ingredient,
+            cls.undo_change,
         )
 
         mod_ingr_menu = RecipeMenu(
             modify_ingredients_options)
         loop_dict = {
-            'kwargs_to_refresh': {'recipe': recipe},
+            'kwargs_to_refresh': {'session': session},
             'run_before': cls.print_ingredients,
-            'run_after': cls.refresh_recipe,
         }
         mod_ingr_menu.loop_menu(**loop_dict)
 
     @classmethod
-    def mod_one_ingr_menu_loop(cls, recipe, ingr_json, idx):
+    def mod_one_ingr_menu_loop(cls, session, idx):
         """Menu to decide what part of an ingredient to modify."""
         mod_one_ingr_options = (
             cls.mod_ingr_name,
@@ -117,14 +262,10 @@ class Recipe(Model):
         mod_one_ingr_menu = RecipeMenu(
             mod_one_ingr_options)
 
-        ingr_name = ingr_json[idx].get('ingredient_name')
-
         loop_dict = {
-            'kwargs_to_refresh': {'recipe': recipe,
-                                  'ingr_json': ingr_json,
+            'kwargs_to_refresh': {'session': session,
                                   'idx': idx},
             'run_before': cls.print_ingredients,
-            'run_after': cls.refresh_ingr,
         }
         mod_one_ingr_menu.loop_menu(**loop_dict)
 
@@ -136,17 +277,31 @@ class Recipe(Model):
             recipe_name = input(
                 '\n\nWhich recipe? Enter recipe id or recipe name:  ')
             try:
-                recipe = Recipe.get(Recipe.id == recipe_name)
+                with metrics.span('recipe.find'):
+                    recipe = RecipeService.find(recipe_name)
             except DoesNotExist:
-                try:
-                    recipe = Recipe.get(Recipe.name == recipe_name)
-                except (DoesNotExist, NameError):
-                    cls.view_recipes()
-                    print('\nThis recipe does not exist. Try again.')
+                recipe = cls.suggest_recipes(recipe_name)
         return recipe
 
     @staticmethod
-    def view_recipes(search_query=None):
+    def suggest_recipes(recipe_name):
+        """Returns the recipe recipe_name names apart from case, or prints
+        the closest recipe names and returns None.
+        """
+        suggestions = RecipeService.find_similar(recipe_name)
+        exact = [suggestion for suggestion in suggestions if suggestion['score'] == 1.0]
+        if len(exact) == 1:
+            return Recipe.get_by_id(exact[0]['id'])
+        if not suggestions:
+            print('\nThis recipe does not exist. Try again.')
+            return None
+        print('\nThis recipe does not exist. Did you mean:')
+        for suggestion in suggestions:
+            print(f'{str(suggestion["id"]).rjust(3)} - {suggestion["name"]}')
+        return None
+
+    @classmethod
+    def view_recipes(cls, search_query=None):
         """Show recipe names.
         Prints recipe names with their respective ids
 
@@ -154,14 +309,32 @@ class Recipe(Model):
                     pass in string as input to only display
                     recipes that contain that string in the
                     ingredients list.
+                    Without it, every recipe is listed a page at a time.
         """
-        recipes = Recipe.select()
-        if search_query:
-            recipes = recipes.where(
-                Recipe.ingredient_list.contains(search_query))
+        if not search_query:
+            cls.page_recipes()
+            return
+        recipes = RecipeService.search(search_query)
         print('\n\n id - name')
         for recipe in recipes:
-            print(f'{str(recipe.id).rjust(3)} - {recipe.name}')
+            print(f'{str(recipe["id"]).rjust(3)} - {recipe["name"]}')
+        print('\r\r')
+
+    @classmethod
+    def page_recipes(cls):
+        """Prints recipe names PAGE_SIZE at a time in the chosen order,
+        fetching each page only when asked for it."""
+        sort = input(f'Sort by {", ".join(RecipeService.SORTS)}? [id]:  ').strip().lower() or 'id'
+        if sort not in RecipeService.SORTS:
+            print('\nUnknown sort order!')
+            return
+        print('\n\n id - name')
+        for page in RecipeService.recipe_pages(sort, page_size=cls.PAGE_SIZE):
+            for recipe in page:
+                print(f'{str(recipe["id"]).rjust(3)} - {recipe["name"]}')
+            if len(page) == cls.PAGE_SIZE and input(
+                    '\nPress Enter for more, or q to stop:  ').strip().lower() == 'q':
+                break
         print('\r\r')
 
     @staticmethod
@@ -189,109 +362,237 @@ class Recipe(Model):
 
         return ingredient_dict
 
-    @staticmethod
-    def refresh_recipe(*args, **kwargs):
-        """Updates recipe for displaying new changes."""
-        recipe = kwargs.get('recipe')
-        return {'recipe': Recipe.get_by_id(recipe.id)}
+    @classmethod
+    def validate_ingredient(cls, ingredient_dict, partial=False):
+        """Raises ValueError unless ingredient_dict has the shape
+        produced by set_ingredient_details.
+
+        With partial=True, ingredient_dict may hold only some of the keys,
+        as when changing part of an existing ingredient.
+        """
+        if not isinstance(ingredient_dict, dict):
+            raise ValueError(f'ingredient must be a dict, not {ingredient_dict!r}')
+        keys = set(ingredient_dict)
+        if partial and keys - cls.INGREDIENT_KEYS:
+            extra = ', '.join(sorted(keys - cls.INGREDIENT_KEYS))
+            raise ValueError(f'unexpected ingredient keys: {extra}')
+        if keys != cls.INGREDIENT_KEYS and not partial:
+            missing = ', '.join(sorted(cls.INGREDIENT_KEYS - keys))
+            extra = ', '.join(sorted(keys - cls.INGREDIENT_KEYS))
+            raise ValueError(
+                f'ingredient keys do not match (missing: {missing or "none"}, '
+                f'unexpected: {extra or "none"})')
+        if 'ingredient_name' in keys:
+            name = ingredient_dict['ingredient_name']
+            if not isinstance(name, str) or not name.strip():
+                raise ValueError('ingredient_name must be a non-empty string')
+        if 'optional' in keys and not isinstance(ingredient_dict['optional'], bool):
+            raise ValueError('optional must be true or false')
+        for key in keys & {'ingredient_amount', 'ingredient_units', 'prep'}:
+            value = ingredient_dict[key]
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise ValueError(f'{key} must be a string or number')
+
+    @classmethod
+    def get_cached(cls, recipe_id):
+        """Returns (recipe, ingr_json) for a recipe id from the recipe cache,
+        loading and parsing it only if it is not cached or has been
+        written since, by this process or another.
+
+        A cached recipe still costs one lookup of its version column.
+        The returned recipe and ingredient list are shared with the cache
+        and must not be modified in place.
+        """
+        if cls._version_sql is None:
+            cls._version_sql, _ = Recipe.select(Recipe.version).where(Recipe.id == 0).sql()
+        row = db.execute_sql(cls._version_sql, (recipe_id,)).fetchone()
+        if row is None:
+            raise Recipe.DoesNotExist(f'no recipe with id {recipe_id!r}')
+        cache = cls.get_recipe_cache()
+        cached = cache.get(recipe_id, row[0])
+        if cached is not None:
+            return cached
+        with metrics.span('recipe.load'):
+            recipe = Recipe.get_by_id(recipe_id)
+        with metrics.span('recipe.parse_ingredients'):
+            ingr_json = json.loads(recipe.ingredient_list)
+        size = (len(recipe.name) + len(recipe.ingredient_list)
+                + len(recipe.instructions or ''))
+        cache.put(recipe_id, (recipe, ingr_json), size, recipe.version)
+        return recipe, ingr_json
 
     @classmethod
-    def refresh_ingr(cls, *args, **kwargs):
-        """Updates recipe and preserves kwargs for displaying new changes to ingredients."""
-        recipe = cls.refresh_recipe(**kwargs).get('recipe')
-        kwargs['recipe'] = recipe
-        return kwargs
+    def get_recipe_cache(cls):
+        """Returns the shared RecipeCache, creating it on first use."""
+        if cls.recipe_cache is None:
+            from cache import RecipeCache
+            cls.recipe_cache = RecipeCache()
+        return cls.recipe_cache
 
     @staticmethod
-    def update_field(recipe, field, updated_field=None):
-        """Modifies one field of a recipe in the database. 
+    def update_field(session, field):
+        """Changes one field of the recipe in an edit session.
 
         Parameters:
-            recipe - recipe to modify
+            session - RecipeEditSession of the recipe to modify
             field - string representing what field to modify. Choose from:
                 'name'
-                'ingredient list'
                 'prep time'
                 'cook time'
+                'servings'
                 'instructions'
-            updated field - new value to update to. Only needed for modifying ingredients.
-        """
-        if field != 'ingredient list':
-            updated_field = input(
-                f'\n\nEnter the new {field}:  ')
-
-        choices = {
-            'name': (recipe.name, recipe.update(name=updated_field).where(Recipe.name == recipe.name)),
-            'ingredient list': (recipe.ingredient_list, recipe.update(ingredient_list=json.dumps(updated_field)).where(Recipe.name == recipe.name)),
-            'prep time': (recipe.prep_time, recipe.update(prep_time=updated_field).where(Recipe.name == recipe.name)),
-            'cook time': (recipe.cook_time, recipe.update(cook_time=updated_field).where(Recipe.name == recipe.name)),
-            'instructions': (recipe.instructions, recipe.update(instructions=updated_field).where(Recipe.name == recipe.name)),
-        }
-
-        original_value = choices.get(field)[0]
+        """
+        column = field.replace(' ', '_')
+        name = session.values['name']
+        original_value = session.values[column]
+        updated_field = input(
+            f'\n\nEnter the new {field}:  ')
 
         if input(f'Change {field} from {original_value} to {updated_field}? [y/N]:  ').lower() == 'y':
-            choices.get(field)[1].execute()
-            print(f'{recipe.name} updated successfully')
+            try:
+                session.set(column, updated_field)
+            except ValueError as e:
+                print(f'{name} not changed: {e}')
         else:
-            print(f'{recipe.name} not updated')
+            print(f'{name} not changed')
 
     @classmethod
     def update_name(cls, *args, **kwargs):
         """Update recipe name."""
-        recipe = kwargs.get('recipe')
-        cls.update_field(recipe, field='name')
+        session = kwargs.get('session')
+        cls.update_field(session, field='name')
+
+    @classmethod
+    def undo_change(cls, *args, **kwargs):
+        """Undo last change."""
+        session = kwargs.get('session')
+        description = session.undo()
+        print('\nNothing to undo' if description is None else f'\nUndid {description}')
+
+    @classmethod
+    def discard_changes(cls, *args, **kwargs):
+        """Discard changes.
+        Drops every change not yet saved, after asking for confirmation.
+        """
+        session = kwargs.get('session')
+        if not session.changed:
+            print('\nNo changes to discard')
+        elif input('Discard all unsaved changes? [y/N]:  ').lower() == 'y':
+            session.discard()
+            print('\nChanges discarded')
+
+    @classmethod
+    def save_changes(cls, *args, **kwargs):
+        """Save changes.
+        Saves the changes in an edit session in one transaction. If
+        someone else changed the same fields meanwhile, asks whether to
+        overwrite their changes.
+
+        Parameter required: 'session' in kwargs
+        """
+        session = kwargs.get('session')
+        name = session.values['name']
+        if not session.changed:
+            print('\nNo changes to save')
+            return
+        try:
+            try:
+                session.commit()
+            except EditConflict as e:
+                print(f'\n{e}')
+                if input('Overwrite their changes with yours? [y/N]:  ').lower() != 'y':
+                    print(f'{name} not updated. Discard your changes to start from theirs.')
+                    return
+                session.commit(force=True)
+        except Recipe.DoesNotExist:
+            print(f'\n{name} not updated: it has been deleted')
+        except (ValueError, IntegrityError) as e:
+            print(f'\n{name} not updated: {e}')
+        else:
+            print(f'\n{name} updated successfully')
 
     @classmethod
     def print_ingredients(cls, print_ingr=True, *args, **kwargs):
         """Show ingredients.
-        Prints formatted table of all ingredients with ingredient details."""
+        Prints formatted table of all ingredients with ingredient details.
+
+        Returns the parsed ingredient list. The list comes from the
+        recipe cache, so copy it before modifying it. When the table is
+        printed from the snapshot, nothing is parsed and None is returned.
+        Given a 'session' in kwargs, shows and returns its working copy.
+        """
+        from table import terminal_width
+        session = kwargs.get('session')
+        if session is not None:
+            ingr_json = session.values['ingredient_list']
+            if print_ingr:
+                sys.stdout.write('\n')
+                cls.render_ingredients(ingr_json, sys.stdout, max_width=terminal_width())
+                sys.stdout.write('\n')
+            return ingr_json
         recipe = kwargs.get('recipe')
         if recipe is None:
             recipe = cls.select_recipe()
-        ingr_json = json.loads(recipe.ingredient_list)
-
-        ingr_str = cls.ING_HEADER_STR
-        ingr_str += '=' * (len(cls.ING_HEADER_STR) - 1) + '\n'
-        for idx, item in enumerate(ingr_json, 1):
-            ingr_str += cls.show_ingr(item, idx)
+        if print_ingr and cls.snapshot is not None:
+            record = cls.fresh_snapshot().get(recipe.id)
+            if record is not None:
+                rows = [(idx, name, amount, units, prep, optional)
+                        for idx, (name, _, amount, units, prep, optional)
+                        in enumerate(record.ingredients, 1)]
+                sys.stdout.write('\n')
+                cls.write_ingredient_rows(rows, sys.stdout, max_width=terminal_width())
+                sys.stdout.write('\n')
+                return None
+        _, ingr_json = cls.get_cached(recipe.id)
         if print_ingr:
-            print(f'\n{ingr_str}')
-        return ingr_str, ingr_json
+            sys.stdout.write('\n')
+            cls.render_ingredients(ingr_json, sys.stdout, max_width=terminal_width())
+            sys.stdout.write('\n')
+        return ingr_json
 
     @classmethod
-    def show_ingr(cls, ingr_to_print, idx, *args, **kwargs):
-        """Returns formatted table of one ingredient with detals.
-        Takes dict for single ingredient.
+    def render_ingredients(cls, ingr_json, out, table_format='text', max_width=None,
+                           wrap=False):
+        """Writes a table of ingredient dicts to a stream.
+
+        Parameters:
+            ingr_json - list of ingredient dicts
+            out - text stream to write to
+            table_format - one of TableRenderer.FORMATS in table.py
+            max_width - widest a text table may be, or None for no limit
+            wrap - wrap long cells instead of truncating them
         """
-        idx_str = str(idx).rjust(cls.IDX_HEADER_WIDTH-1)
-        name_str = str(ingr_to_print.get('ingredient_name')
-                       ).center(cls.INGR_HEADER_WIDTH)
-        amt_str = str(ingr_to_print.get('ingredient_amount')
-                      ).center(cls.AMT_HEADER_WIDTH)
-        unit_str = str(ingr_to_print.get('ingredient_units')
-                       ).center(cls.UNIT_HEADER_WIDTH)
-        prep_str = str(ingr_to_print.get('prep')).center(cls.PREP_HEADER_WIDTH)
-        opt_str = ('y'.center(cls.OPT_HEADER_WIDTH) if ingr_to_print.get(
-            'optional') else 'n'.center(cls.OPT_HEADER_WIDTH))
-        ingr_str = f'|{idx_str} |{name_str}|{amt_str}|{unit_str}|{prep_str}|{opt_str}|\n'
-        return ingr_str
+        rows = [(idx, item.get('ingredient_name'), item.get('ingredient_amount'),
+                 item.get('ingredient_units'), item.get('prep'), item.get('optional'))
+                for idx, item in enumerate(ingr_json, 1)]
+        cls.write_ingredient_rows(rows, out, table_format, max_width, wrap)
+
+    @classmethod
+    def write_ingredient_rows(cls, rows, out, table_format='text', max_width=None,
+                              wrap=False):
+        """Writes a table of rows with one value per INGREDIENT_COLUMNS
+        column, taking the same options as render_ingredients."""
+        from table import TableColumn, TableRenderer
+        with metrics.span('recipe.render_ingredients', table_format):
+            columns = [TableColumn(*column) for column in cls.INGREDIENT_COLUMNS]
+            renderer = TableRenderer(columns, max_width, wrap)
+            renderer.write(rows, out, table_format)
 
     @classmethod
     def add_ingredient(cls, *args, **kwargs):
         """Add ingredient.
         Adds an ingredient to a recipe.
 
-        Parameters required: 'recipe' in kwargs
+        Parameters required: 'session' in kwargs
         """
 
-        recipe = kwargs.get('recipe')
-        _, ingr_json = cls.print_ingredients(print_ingr=False, *args, **kwargs)
+        session = kwargs.get('session')
         new_ingr = cls.set_ingredient_details()
         if input(f'Add {new_ingr.get("ingredient_name")}? [Y/n]:  ') != 'n':
-            ingr_json.append(new_ingr)
-            Recipe.update(ingredient_list=json.dumps(ingr_json)).where(
-                Recipe.name == recipe.name).execute()
+            try:
+                session.add_ingredient(new_ingr)
+            except ValueError as e:
+                print(f'\nIngredient not added: {e}')
 
     @classmethod
     def delete_ingredient(cls, *args, **kwargs):
@@ -299,92 +600,115 @@ class Recipe(Model):
         Deletes one ingredient from a recipe.
         Asks for confirmation before executing.
 
-        Parameter required: 'recipe' in kwargs
+        Parameter required: 'session' in kwargs
         """
 
-        recipe = kwargs.get('recipe')
-        _, ingr_json = cls.print_ingredients(print_ingr=False, *args, **kwargs)
+        session = kwargs.get('session')
+        ingr_json = cls.print_ingredients(print_ingr=False, *args, **kwargs)
         ingr_to_del = input(
             'What is the index of the ingredient to delete?:  ')
         try:
-            idx_to_del = int(ingr_to_del) - 1
-            ingr_to_del = ingr_json.pop(idx_to_del).get('ingredient_name')
+            position = int(ingr_to_del)
+            if not 1 <= position <= len(ingr_json):
+                raise IndexError
+            ingr_to_del = ingr_json[position - 1].get('ingredient_name')
         except (ValueError, IndexError):
             print('\nEnter a valid number!')
         else:
-            if input(f'Delete {ingr_to_del}? [y/N]:  '):
-                Recipe.update(ingredient_list=json.dumps(ingr_json)).where(
-                    Recipe.name == recipe.name).execute()
+            if input(f'Delete {ingr_to_del}? [y/N]:  ').lower() == 'y':
+                session.delete_ingredient(position)
 
     @classmethod
     def modify_ingredient(cls, *args, **kwargs):
         """Modify ingredient.
         Select an ingredient, then start a menu to choose how to modify it.
         """
-        recipe = kwargs.get('recipe')
-        _, ingr_json = _, ingr_json = cls.print_ingredients(
+        session = kwargs.get('session')
+        ingr_json = cls.print_ingredients(
             print_ingr=False, *args, **kwargs)
         ingr_to_del = input(
             'What is the index of the ingredient to modify?:  ')
         try:
             idx_to_mod = int(ingr_to_del) - 1
-            cls.mod_one_ingr_menu_loop(recipe, ingr_json, idx_to_mod)
+            if not 0 <= idx_to_mod < len(ingr_json):
+                raise IndexError
+            cls.mod_one_ingr_menu_loop(session, idx_to_mod)
         except (ValueError, IndexError):
             print('\nNeed to enter a number in range!')
 
+    @staticmethod
+    def ingr_name(session, idx):
+        return session.values['ingredient_list'][idx].get('ingredient_name')
+
+    @classmethod
+    def update_ingr(cls, session, idx, **changes):
+        """Changes one ingredient in an edit session after asking for
+        confirmation."""
+        ingr_name = cls.ingr_name(session, idx)
+        change_str = ', '.join(f'{key} to {value}' for key, value in changes.items())
+        if input(f'Change {ingr_name}: {change_str}? [y/N]:  ').lower() != 'y':
+            print(f'{ingr_name} not changed')
+            return
+        try:
+            session.update_ingredient(idx + 1, **changes)
+        except ValueError as e:
+            print(f'{ingr_name} not changed: {e}')
+
     @classmethod
-    def mod_ingr_name(cls, recipe, ingr_json, idx):
+    def mod_ingr_name(cls, session, idx):
         """Change ingredient name."""
         new_name = input(
-            f'Enter new name for {ingr_json[idx].get("ingredient_name")}:  ')
-        ingr_json[idx].update({'ingredient_name': new_name})
-        cls.update_field(recipe, 'ingredient list', ingr_json)
+            f'Enter new name for {cls.ingr_name(session, idx)}:  ')
+        cls.update_ingr(session, idx, ingredient_name=new_name)
 
     @classmethod
-    def mod_ingr_amount(cls, recipe, ingr_json, idx):
+    def mod_ingr_amount(cls, session, idx):
         """Change ingredient amount and unit."""
         new_amount = input(
-            f'Enter new amount for {ingr_json[idx].get("ingredient_name")}:  ')
+            f'Enter new amount for {cls.ingr_name(session, idx)}:  ')
         new_unit = input(
-            f'Enter new units for {ingr_json[idx].get("ingredient_name")}:  ')
-        ingr_json[idx].update({'ingredient_amount': new_amount})
-        ingr_json[idx].update({'ingredient_units': new_unit})
-        cls.update_field(recipe, 'ingredient list', ingr_json)
+            f'Enter new units for {cls.ingr_name(session, idx)}:  ')
+        cls.update_ingr(session, idx,
+                        ingredient_amount=new_amount, ingredient_units=new_unit)
 
     @classmethod
-    def mod_ingr_prep(cls, recipe, ingr_json, idx):
+    def mod_ingr_prep(cls, session, idx):
         """Change ingredient prep."""
         new_prep = input(
-            f'Enter new prep for {ingr_json[idx].get("ingredient_name")}:  ')
-        ingr_json[idx].update({'prep': new_prep})
-        cls.update_field(recipe, 'ingredient list', ingr_json)
+            f'Enter new prep for {cls.ingr_name(session, idx)}:  ')
+        cls.update_ingr(session, idx, prep=new_prep)
 
     @classmethod
-    def mod_ingr_opt(cls, recipe, ingr_json, idx):
+    def mod_ingr_opt(cls, session, idx):
         """Change if ingredient is optional."""
         new_opt = False
-        if input(f'Is {ingr_json[idx].get("ingredient_name")} optional? [y/N]:  ') == 'y':
+        if input(f'Is {cls.ingr_name(session, idx)} optional? [y/N]:  ') == 'y':
             new_opt = True
-        ingr_json[idx].update({'optional': new_opt})
-        cls.update_field(recipe, 'ingredient list', ingr_json)
+        cls.update_ingr(session, idx, optional=new_opt)
 
     @classmethod
     def update_prep_time(cls, *args, **kwargs):
         """Update recipe prep time."""
-        recipe = kwargs.get('recipe')
-        cls.update_field(recipe, field='prep time')
+        session = kwargs.get('session')
+        cls.update_field(session, field='prep time')
 
     @classmethod
     def update_cook_time(cls, *args, **kwargs):
         """Update recipe cook time."""
-        recipe = kwargs.get('recipe')
-        cls.update_field(recipe, field='cook time')
+        session = kwargs.get('session')
+        cls.update_field(session, field='cook time')
+
+    @classmethod
+    def update_servings(cls, *args, **kwargs):
+        """Update number of servings."""
+        session = kwargs.get('session')
+        cls.update_field(session, field='servings')
 
     @classmethod
     def update_instructions(cls, *args, **kwargs):
         """Update recipe instructions."""
-        recipe = kwargs.get('recipe')
-        cls.update_field(recipe, field='instructions')
+        session = kwargs.get('session')
+        cls.update_field(session, field='instructions')
 
     @classmethod
     def show_whole_recipe(cls, *args, **kwargs):
@@ -392,17 +716,81 @@ class Recipe(Model):
         Prints the recipe name, prep time, and cook time,
         followed by a formatted table of all the ingredients,
         followed by the instructions for the recipe.
+        Given a 'session' in kwargs, shows its working copy.
         """
-        recipe = kwargs.get('recipe')
+        session = kwargs.get('session')
+        recipe = kwargs.get('recipe') if session is None else session.recipe
         if recipe == None:
             recipe = cls.select_recipe()
         print(f'\nRecipe: {recipe.name}')
         print(f'Prep Time: {recipe.prep_time}')
-        print(f'Cook Time: {recipe.cook_time}\n')
+        print(f'Cook Time: {recipe.cook_time}')
+        print(f'Servings: {recipe.servings}\n')
         print(f'Ingredients:')
-        cls.print_ingredients(recipe=recipe)
+        cls.print_ingredients(recipe=recipe, session=session)
         print(f'Instructions: {recipe.instructions}\n')
 
+    @classmethod
+    def scale_recipe(cls):
+        """Scale a recipe.
+        Prints a recipe's ingredients scaled to a number of servings
+        or by a factor, optionally converted to US or metric units.
+        """
+        from quantities import SYSTEMS, parse_amount
+        from table import terminal_width
+        recipe = cls.select_recipe()
+        if recipe.servings:
+            answer = input(f'How many servings? (makes {recipe.servings}):  ')
+        else:
+            answer = input('Scale by how much? (like 2 or 1/2):  ')
+        system = input(f'Convert units to {" or ".join(SYSTEMS)}? [N]:  ').strip().lower()
+        try:
+            if recipe.servings:
+                scaled = RecipeService.scale(recipe.id, servings=answer,
+                                             system=system if system in SYSTEMS else None)
+            else:
+                factor = parse_amount(answer)
+                if factor is None:
+                    raise ValueError('enter a number like 2 or 1/2')
+                scaled = RecipeService.scale(recipe.id, factor=factor[0],
+                                             system=system if system in SYSTEMS else None)
+        except ValueError as e:
+            print(f'\n{recipe.name} not scaled: {e}')
+            return
+        sys.stdout.write('\n')
+        cls.render_ingredients(scaled['ingredient_list'], sys.stdout, max_width=terminal_width())
+        sys.stdout.write('\n')
+
+    @classmethod
+    def shopping_list(cls):
+        """Make a shopping list.
+        Asks for the recipes of a meal plan and prints one list of
+        everything needed to make them, with optional ingredients apart.
+        """
+        from quantities import SYSTEMS
+        from table import terminal_width
+        plan = []
+        while not plan or input('Add another recipe? [y/N]:  ').lower() == 'y':
+            recipe = cls.select_recipe()
+            servings = None
+            if recipe.servings:
+                servings = input(f'How many servings? (makes {recipe.servings}):  ').strip()
+            plan.append((recipe.id, servings or None))
+        system = input(f'Convert units to {" or ".join(SYSTEMS)}? [N]:  ').strip().lower()
+        try:
+            shopping = RecipeService.shopping_list(plan, system if system in SYSTEMS else None)
+        except ValueError as e:
+            print(f'\nShopping list not made: {e}')
+            return
+        required = [item for item in shopping['items'] if not item['optional']]
+        optional = [item for item in shopping['items'] if item['optional']]
+        print(f'\nShopping list for {", ".join(r["name"] for r in shopping["recipes"])}:\n')
+        cls.render_ingredients(required, sys.stdout, max_width=terminal_width())
+        if optional:
+            print('\nOptional:\n')
+            cls.render_ingredients(optional, sys.stdout, max_width=terminal_width())
+        print()
+
     @classmethod
     def add_recipe(cls):
         """Add new recipe.
@@ -420,9 +808,17 @@ class Recipe(Model):
             else:
                 run = False
 
+        if ingredient_list:
+            duplicates = RecipeService.likely_duplicates(ingredient_list)
+            if duplicates:
+                print('\nRecipes with much the same ingredients:')
+                for recipe in duplicates:
+                    print(f'{str(recipe["id"]).rjust(3)} - {recipe["name"]}')
         if input(f'Save {name} recipe? [Y/n]:  ').lower() != 'n':
-            Recipe.create(
-                name=name, ingredient_list=json.dumps(ingredient_list))
+            try:
+                RecipeService.add(name, ingredient_list)
+            except (ValueError, IntegrityError) as e:
+                print(f'\n{name} not saved: {e}')
 
     @classmethod
     def delete_recipe(cls):
@@ -430,17 +826,1712 @@ class Recipe(Model):
         recipe = cls.select_recipe()
         if recipe is not None:
             if input(f'Delete {recipe.name}? [y/N]:  ').lower() == 'y':
-                recipe.delete_instance()
+                RecipeService.delete(recipe.id)
                 print("recipe deleted")
 
     @staticmethod
     def add_test_recipes():
-        Recipe.create(name='garlic bread', ingredient_list=json.dumps(
-            test_recipes.garlic_bread_ingredients))
-        Recipe.create(name='black bean enchiladas', ingredient_list=json.dumps(
-            test_recipes.black_bean_enchiladas_ingredients))
+        import test_recipes
+        test_data = (
+            ('garlic bread', test_recipes.garlic_bread_ingredients),
+            ('black bean enchiladas', test_recipes.black_bean_enchiladas_ingredients),
+        )
+        with db.atomic():
+            for name, ingredient_list in test_data:
+                RecipeService.add(name, ingredient_list)
 
     @classmethod
     def search_recipes(cls):
         """Search recipes by ingredient."""
         cls.view_recipes(input('Search ingredients:  '))
+
+    @classmethod
+    def get_pantry_matcher(cls):
+        """Returns the shared PantryMatcher, building it on first use.
+        Once built, it is kept up to date by ingredient writes.
+        """
+        if cls.pantry_matcher is None:
+            from pantry import PantryMatcher
+            matcher = PantryMatcher()
+            recipe_ids = Recipe.select(Recipe.id).tuples()
+            ingredient_rows = Ingredient.select(
+                Ingredient.recipe, Ingredient.normalized_name,
+                Ingredient.optional).tuples()
+            matcher.load((row[0] for row in recipe_ids), ingredient_rows)
+            Ingredient.listeners.append(cls._update_pantry_matcher)
+            cls.pantry_matcher = matcher
+        return cls.pantry_matcher
+
+    @classmethod
+    def reset_pantry_matcher(cls):
+        """Drops the shared PantryMatcher so it is rebuilt on next use."""
+        if cls.pantry_matcher is not None:
+            Ingredient.listeners.remove(cls._update_pantry_matcher)
+            cls.pantry_matcher = None
+
+    @classmethod
+    def _update_pantry_matcher(cls, recipe_id, rows):
+        if rows is None:
+            cls.pantry_matcher.remove_recipe(recipe_id)
+        else:
+            cls.pantry_matcher.add_recipe(
+                recipe_id, [(row['normalized_name'], row['optional']) for row in rows])
+
+    @classmethod
+    def notify_name(cls, recipe_id, name):
+        """Runs the name listeners for one recipe."""
+        for listener in cls.name_listeners:
+            listener(recipe_id, name)
+
+    @classmethod
+    def get_name_index(cls):
+        """Returns the shared NameIndex, building it on first use.
+        Once built, it is kept up to date by recipe writes.
+        """
+        if cls.name_index is None:
+            from fuzzy import NameIndex
+            index = NameIndex()
+            index.load(Recipe.select(Recipe.id, Recipe.name).tuples())
+            cls.name_listeners.append(cls._update_name_index)
+            cls.name_index = index
+        return cls.name_index
+
+    @classmethod
+    def reset_name_index(cls):
+        """Drops the shared NameIndex so it is rebuilt on next use."""
+        if cls.name_index is not None:
+            cls.name_listeners.remove(cls._update_name_index)
+            cls.name_index = None
+
+    @classmethod
+    def _update_name_index(cls, recipe_id, name):
+        if name is None:
+            cls.name_index.remove(recipe_id)
+        else:
+            cls.name_index.add(recipe_id, name)
+
+    @classmethod
+    def enable_snapshot(cls):
+        """Loads every recipe into a RecipeSnapshot, which then serves
+        recipe listings, ingredient searches and ingredient tables.
+        Returns the snapshot.
+        """
+        from snapshot import RecipeSnapshot
+        snapshot = RecipeSnapshot()
+        # Read the sequence number first: a change committed while the
+        # recipes load is then replayed on the next refresh, even if the
+        # load already saw it.
+        seq = RecipeChange.last_seq()
+        snapshot.load(cls._snapshot_rows(cls._snapshot_query()), seq)
+        cls.snapshot = snapshot
+        return snapshot
+
+    @classmethod
+    def disable_snapshot(cls):
+        """Drops the snapshot so reads go to the database again."""
+        cls.snapshot = None
+
+    @classmethod
+    def fresh_snapshot(cls):
+        """Returns the snapshot after replaying the recipe changes committed
+        since its last refresh, or None if snapshots are not enabled.
+        Checking for changes costs one query on the recipe_changes index.
+        """
+        snapshot = cls.snapshot
+        if snapshot is None:
+            return None
+        try:
+            changes = RecipeChange.changes_since(snapshot.seq)
+        except ChangesCompacted:
+            return cls.enable_snapshot()
+        if not changes:
+            return snapshot
+        recipe_ids = list(dict.fromkeys(recipe_id for _, recipe_id in changes))
+        rows = {}
+        for ids in chunked(recipe_ids, 500):
+            query = cls._snapshot_query().where(Recipe.id.in_(ids))
+            rows.update((row[0], row) for row in cls._snapshot_rows(query))
+        for recipe_id in recipe_ids:
+            if recipe_id in rows:
+                snapshot.put(*rows[recipe_id])
+            else:
+                snapshot.remove(recipe_id)
+        snapshot.seq = changes[-1][0]
+        return snapshot
+
+    @staticmethod
+    def _snapshot_query():
+        return Recipe.select(Recipe.id, Recipe.name, Recipe.date_created,
+                             Recipe.ingredient_list)
+
+    @staticmethod
+    def _snapshot_rows(query):
+        """Yields recipes as RecipeSnapshot.put takes them."""
+        for recipe_id, name, date_created, ingredient_list in query.tuples().iterator():
+            ingredients = [(item.get('ingredient_name'),
+                            Ingredient.normalize(item.get('ingredient_name') or ''),
+                            item.get('ingredient_amount'), item.get('ingredient_units'),
+                            item.get('prep'), item.get('optional'))
+                           for item in json.loads(ingredient_list or '[]')]
+            yield recipe_id, name, date_created, ingredients
+
+    @classmethod
+    def what_can_i_cook(cls):
+        """Search by ingredients on hand.
+        Prints recipes that can be made from the ingredients entered,
+        followed by recipes missing only a few of them.
+        """
+        pantry = input(
+            'Enter ingredients on hand, separated by commas:  ').split(',')
+        try:
+            max_missing = int(input(
+                'How many ingredients can be missing? [0]:  ') or 0)
+        except ValueError:
+            print('\nEnter a valid number!')
+            return
+
+        print('\n\n id - name')
+        for recipe in RecipeService.pantry_matches(pantry, max_missing):
+            line = f'{str(recipe["id"]).rjust(3)} - {recipe["name"]}'
+            if recipe['missing']:
+                line += f' (missing: {", ".join(recipe["missing"])})'
+            print(line)
+        print('\r\r')
+
+    @classmethod
+    def similar_recipes(cls):
+        """Find recipes with similar ingredients.
+        Prints the recipes sharing most ingredients with a selected recipe.
+        """
+        recipe = cls.select_recipe()
+        if recipe is None:
+            return
+        print('\n\n id - name (share of ingredients in common)')
+        for similar in RecipeService.similar_recipes(recipe.id):
+            print(f'{str(similar["id"]).rjust(3)} - {similar["name"]} ({similar["score"]:.0%})')
+        print('\r\r')
+
+    @staticmethod
+    def full_text_search():
+        """Search recipe names, ingredients, and instructions.
+        Prints matching recipes, best match first.
+        """
+        recipes = RecipeService.full_text_search(input('Search recipes:  '))
+        print('\n\n id - name')
+        for recipe in recipes:
+            print(f'{str(recipe["id"]).rjust(3)} - {recipe["name"]}')
+        print('\r\r')
+
+
+
+# Existing databases already have this unique index under this name.
+Recipe.add_index(Recipe.index(Recipe.name, unique=True, name='recipe_name'))
+# Lets recipe listings sorted by date seek to a page instead of sorting.
+Recipe.add_index(Recipe.index(Recipe.date_created, name='recipe_date_created'))
+
+
+class Ingredient(Model):
+    """One row per ingredient of a recipe.
+
+    Mirrors the dicts stored in Recipe.ingredient_list so ingredient
+    searches can use an index instead of scanning the JSON text of every
+    recipe: the trigram index IngredientSearch in search.py, or the index
+    on normalized_name for queries too short for it.
+    """
+    recipe = ForeignKeyField(Recipe, backref='ingredients')
+    position = IntegerField()
+    name = TextField()
+    normalized_name = TextField(index=True)
+    amount = TextField(null=True)
+    units = TextField(null=True)
+    prep = TextField(null=True)
+    optional = BooleanField(default=False)
+
+    class Meta:
+        database = db
+        table_name = 'ingredients'
+        indexes = (
+            (('recipe', 'position'), True),
+        )
+
+    MIGRATE_BATCH_SIZE = 500
+
+    # Shortest search the trigram index can look up. Shorter ones match
+    # names starting with the search instead of containing it.
+    SUBSTRING_MIN_LENGTH = 3
+
+    # Callables run as listener(recipe_id, rows) whenever a recipe's
+    # ingredients are replaced, or with rows=None when they are deleted.
+    listeners = []
+
+    _recipe_rows_sql = None
+
+    @staticmethod
+    def normalize(name):
+        """Lowercases a name and collapses whitespace so lookups match."""
+        return ' '.join(str(name).lower().split())
+
+    @classmethod
+    def rows_for(cls, recipe_id, ingr_json):
+        """Returns insertable row dicts for a recipe's ingredient dicts."""
+        rows = []
+        for position, item in enumerate(ingr_json, 1):
+            name = item.get('ingredient_name') or ''
+            rows.append({
+                'recipe': recipe_id,
+                'position': position,
+                'name': name,
+                'normalized_name': cls.normalize(name),
+                'amount': str(item.get('ingredient_amount', '')),
+                'units': item.get('ingredient_units'),
+                'prep': item.get('prep'),
+                'optional': bool(item.get('optional')),
+            })
+        return rows
+
+    @classmethod
+    def replace_for(cls, recipe_id, ingr_json):
+        """Replaces the ingredient rows of one recipe.
+        Should be called in the same transaction that writes
+        Recipe.ingredient_list so the two stay in sync.
+        """
+        cls.delete().where(cls.recipe == recipe_id).execute()
+        rows = cls.rows_for(recipe_id, ingr_json)
+        if rows:
+            cls.insert_many(rows).execute()
+        for listener in cls.listeners:
+            listener(recipe_id, rows)
+
+    @classmethod
+    def replace_many(cls, ingr_json_by_recipe, batch_size=100):
+        """Replaces the ingredient rows of many recipes with batched deletes
+        and one bulk insert. Takes a dict of recipe id to ingredient dicts.
+        """
+        recipe_ids = list(ingr_json_by_recipe)
+        rows_by_recipe = {recipe_id: cls.rows_for(recipe_id, ingr_json)
+                          for recipe_id, ingr_json in ingr_json_by_recipe.items()}
+        for ids in chunked(recipe_ids, batch_size):
+            cls.delete().where(cls.recipe.in_(ids)).execute()
+        cls.insert_rows(
+            row for recipe_rows in rows_by_recipe.values() for row in recipe_rows)
+        for listener in cls.listeners:
+            for recipe_id, recipe_rows in rows_by_recipe.items():
+                listener(recipe_id, recipe_rows)
+
+    # Keys of an ingredient dict and the column each is stored in.
+    COLUMNS_BY_KEY = {
+        'ingredient_name': 'name',
+        'ingredient_amount': 'amount',
+        'ingredient_units': 'units',
+        'prep': 'prep',
+        'optional': 'optional',
+    }
+
+    @classmethod
+    def append_row(cls, recipe_id, ingredient):
+        """Adds the row for an ingredient appended to a recipe's list."""
+        position = cls.select().where(cls.recipe == recipe_id).count() + 1
+        row = cls.rows_for(recipe_id, [ingredient])[0]
+        row['position'] = position
+        cls.insert(row).execute()
+        cls.notify(recipe_id)
+
+    @classmethod
+    def remove_row(cls, recipe_id, position):
+        """Deletes the row at a 1-based position and closes the gap."""
+        cls.delete().where(
+            (cls.recipe == recipe_id) & (cls.position == position)).execute()
+        # Shift through negative positions so the unique (recipe, position)
+        # index never sees two rows at the same position mid-update.
+        cls.update(position=1 - cls.position).where(
+            (cls.recipe == recipe_id) & (cls.position > position)).execute()
+        cls.update(position=0 - cls.position).where(
+            (cls.recipe == recipe_id) & (cls.position < 0)).execute()
+        cls.notify(recipe_id)
+
+    @classmethod
+    def update_row(cls, recipe_id, position, changes):
+        """Applies changed ingredient dict keys to the row at a position."""
+        values = {}
+        for key, value in changes.items():
+            column = cls.COLUMNS_BY_KEY[key]
+            if key == 'ingredient_name':
+                values['normalized_name'] = cls.normalize(value)
+            elif key == 'ingredient_amount':
+                value = str(value)
+            values[column] = value
+        cls.update(**values).where(
+            (cls.recipe == recipe_id) & (cls.position == position)).execute()
+        cls.notify(recipe_id)
+
+    @classmethod
+    def notify(cls, recipe_id):
+        """Runs the listeners with the current rows of one recipe."""
+        if not cls.listeners:
+            return
+        # Building the query with peewee costs more than running it, so
+        # it is compiled once and its rows made into dicts here.
+        if cls._recipe_rows_sql is None:
+            cls._recipe_rows_sql, _ = (cls.select().where(cls.recipe == 0)
+                                       .order_by(cls.position).sql())
+        fields = cls._meta.sorted_fields
+        rows = [{field.name: field.python_value(value) for field, value in zip(fields, row)}
+                for row in db.execute_sql(cls._recipe_rows_sql, (recipe_id,))]
+        for listener in cls.listeners:
+            listener(recipe_id, rows)
+
+    @classmethod
+    def delete_for(cls, recipe_id):
+        """Deletes the ingredient rows of a recipe that is being deleted."""
+        cls.delete().where(cls.recipe == recipe_id).execute()
+        for listener in cls.listeners:
+            listener(recipe_id, None)
+
+    @classmethod
+    def migrate_from_json(cls):
+        """Fills the ingredients table from existing ingredient_list JSON.
+        Run once, when the ingredients table is first created.
+        """
+        rows = []
+        recipes = Recipe.select(Recipe.id, Recipe.ingredient_list).tuples()
+        with db.atomic():
+            for recipe_id, ingredient_list in recipes.iterator():
+                rows.extend(cls.rows_for(
+                    recipe_id, json.loads(ingredient_list or '[]')))
+                if len(rows) >= cls.MIGRATE_BATCH_SIZE:
+                    cls.insert_rows(rows)
+                    rows = []
+            cls.insert_rows(rows)
+
+    # Rows written by each statement of insert_rows. FTS5 flushes the
+    # terms the ingredient_search triggers add at the end of every
+    # statement, which makes one row per statement several times slower.
+    ROWS_PER_INSERT = 100
+
+    @classmethod
+    def insert_rows(cls, rows, database=None):
+        """Bulk inserts row dicts from rows_for, into database if given.
+
+        Compiles an INSERT of ROWS_PER_INSERT rows once and runs it with
+        executemany, which skips building SQL for every value as
+        insert_many does. Use inside a transaction.
+        """
+        columns = ('recipe', 'position', 'name', 'normalized_name',
+                   'amount', 'units', 'prep', 'optional')
+        sql, _ = cls.insert({getattr(cls, column): None for column in columns}).sql()
+        head, row_values = sql.split(' VALUES ')
+        values = [tuple(row[column] for column in columns) for row in rows]
+        size = cls.ROWS_PER_INSERT
+        whole = len(values) - len(values) % size
+        cursor = (db if database is None else database).cursor()
+        if whole:
+            cursor.executemany(
+                f'{head} VALUES {", ".join([row_values] * size)}',
+                (tuple(itertools.chain.from_iterable(values[start:start + size]))
+                 for start in range(0, whole, size)))
+        if whole < len(values):
+            cursor.execute(
+                f'{head} VALUES {", ".join([row_values] * (len(values) - whole))}',
+                tuple(itertools.chain.from_iterable(values[whole:])))
+
+    @classmethod
+    def name_lookup(cls, normalized):
+        """Returns a condition selecting the ingredients whose normalized
+        name contains normalized, a search as normalize() returns it, by
+        looking them up in an index.
+
+        Searches of SUBSTRING_MIN_LENGTH characters or more are looked up
+        in the trigram index. Shorter ones match names starting with the
+        search, with a range on the normalized_name index.
+        """
+        if len(normalized) < cls.SUBSTRING_MIN_LENGTH:
+            return cls._prefix_range(normalized)
+        from search import IngredientSearch
+        return cls.id.in_(IngredientSearch.ingredient_ids(normalized))
+
+    @classmethod
+    def name_check(cls, normalized):
+        """Returns the condition name_lookup() selects by, checked on each
+        row rather than looked up. Use it on rows found through another
+        index, such as the ingredients of one recipe."""
+        if len(normalized) < cls.SUBSTRING_MIN_LENGTH:
+            return cls._prefix_range(normalized)
+        return fn.instr(cls.normalized_name, normalized) > 0
+
+    @classmethod
+    def _prefix_range(cls, prefix):
+        return ((cls.normalized_name >= prefix) &
+                (cls.normalized_name < prefix + '\U0010ffff'))
+
+    @classmethod
+    def search(cls, search_query):
+        """Returns a query of recipe ids and names with an ingredient
+        whose normalized name contains search_query, or starts with it
+        if it is shorter than SUBSTRING_MIN_LENGTH.
+
+        Looks the ingredients up with name_lookup() rather than LIKE,
+        so the lookup does not read the ingredient_list JSON.
+        """
+        return (Recipe
+                .select(Recipe.id, Recipe.name)
+                .join(cls)
+                .where(cls.name_lookup(cls.normalize(search_query)))
+                .distinct()
+                .order_by(Recipe.id))
+
+
+class ChangesCompacted(ValueError):
+    """Raised when changes after a seq were compacted away, so a copy
+    kept in sync from that seq has to be made again from scratch."""
+
+
+class RecipeChange(Model):
+    """Append-only log of changes to recipes, numbered in commit order.
+
+    Triggers on recipes add an entry whenever one is created, updated or
+    deleted, so the entries after a reader's last seen seq name every
+    recipe changed since, deleted ones included, and keeping a copy in
+    sync costs time in proportion to the changes. seq never goes back,
+    since AUTOINCREMENT does not reuse numbers.
+
+    The log grows with every write until compact() removes entries
+    superseded by later ones. changed_at is local time, like
+    Recipe.date_created, and None for entries from before it was kept.
+    """
+    seq = AutoField(constraints=[SQL('AUTOINCREMENT')])
+    recipe_id = IntegerField(index=True)
+    operation = TextField()
+    changed_at = DateTimeField(null=True)
+
+    class Meta:
+        database = db
+        table_name = 'recipe_changes'
+
+    OPERATIONS = ('create', 'update', 'delete')
+
+    @staticmethod
+    def create_triggers():
+        """Creates the triggers that record changes to recipes."""
+        for suffix, event, row, operation in (('ai', 'INSERT', 'new', 'create'),
+                                              ('au', 'UPDATE', 'new', 'update'),
+                                              ('ad', 'DELETE', 'old', 'delete')):
+            db.execute_sql(
+                f'CREATE TRIGGER IF NOT EXISTS recipes_change_{suffix} AFTER {event} ON recipes '
+                f'BEGIN INSERT INTO recipe_changes(recipe_id, operation, changed_at) '
+                f"VALUES ({row}.id, '{operation}', "
+                f"strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')); END;")
+
+    @classmethod
+    def migrate_to_log(cls):
+        """Turns the table of each recipe's latest change, which databases
+        before schema version 5 keep, into a log, keeping its seqs. Whether
+        those changes created or updated a recipe was not recorded, so
+        they are logged as updates. Run before create_tables."""
+        indexes = db.get_indexes(cls._meta.table_name)
+        if not any(index.unique and index.columns == ['recipe_id'] for index in indexes):
+            return
+        with db.atomic():
+            for suffix in ('ai', 'au', 'ad'):
+                db.execute_sql(f'DROP TRIGGER IF EXISTS recipes_change_{suffix}')
+            for index in indexes:
+                db.execute_sql(f'DROP INDEX "{index.name}"')
+            db.execute_sql('ALTER TABLE recipe_changes RENAME TO recipe_changes_old')
+            cls.create_table()
+            db.execute_sql(
+                'INSERT INTO recipe_changes(seq, recipe_id, operation) '
+                'SELECT seq, recipe_id, CASE WHEN EXISTS (SELECT 1 FROM recipes '
+                "WHERE recipes.id = old.recipe_id) THEN 'update' ELSE 'delete' END "
+                'FROM recipe_changes_old AS old ORDER BY seq')
+            db.execute_sql('DROP TABLE recipe_changes_old')
+
+    @staticmethod
+    def last_seq():
+        return db.execute_sql('SELECT max(seq) FROM recipe_changes').fetchone()[0] or 0
+
+    @classmethod
+    def changes_since(cls, seq):
+        """Returns (seq, recipe id) pairs for the changes after seq, in order.
+        A recipe changed more than once is in it more than once."""
+        cls.check_horizon(seq)
+        return db.execute_sql(
+            'SELECT seq, recipe_id FROM recipe_changes WHERE seq > ? ORDER BY seq',
+            (seq,)).fetchall()
+
+    @classmethod
+    def pages(cls, seq, page_size=1000, limit=None):
+        """Yields lists of up to page_size changes after seq, oldest first,
+        as dicts of seq, recipe_id, operation and changed_at. Stops after
+        limit changes if it is given."""
+        cls.check_horizon(seq)
+        query = cls.select().order_by(cls.seq)
+        while limit is None or limit > 0:
+            size = page_size if limit is None else min(page_size, limit)
+            page = list(query.where(cls.seq > seq).limit(size).dicts())
+            if not page:
+                return
+            yield page
+            if len(page) < size:
+                return
+            seq = page[-1]['seq']
+            if limit is not None:
+                limit -= len(page)
+
+    @staticmethod
+    def horizon():
+        """Returns the seq that readers must have seen for the log to still
+        hold every delete after it, 0 unless deletes were compacted away."""
+        return db.execute_sql(
+            'SELECT max(through) FROM recipe_change_compactions WHERE deletes_dropped'
+        ).fetchone()[0] or 0
+
+    @classmethod
+    def check_horizon(cls, seq):
+        horizon = cls.horizon()
+        if seq < horizon:
+            raise ChangesCompacted(
+                f'changes up to seq {horizon} have been compacted, so changes since '
+                f'seq {seq} are incomplete; copy all recipes again')
+
+    @classmethod
+    def compact(cls, through=None, drop_deletes=False):
+        """Removes entries up to seq through, or all of them, that a later
+        entry for the same recipe supersedes, and returns how many went.
+
+        Every recipe changed after any seq keeps its latest entry, so
+        readers still find what changed, only not each step. With
+        drop_deletes, deletes up to through go too, and readers that have
+        not yet seen through get ChangesCompacted instead of changes.
+        """
+        with db.atomic():
+            if through is None:
+                through = cls.last_seq()
+            removed = db.execute_sql(
+                'DELETE FROM recipe_changes WHERE seq <= ? AND EXISTS ('
+                'SELECT 1 FROM recipe_changes AS later '
+                'WHERE later.recipe_id = recipe_changes.recipe_id '
+                'AND later.seq > recipe_changes.seq)', (through,)).rowcount
+            if drop_deletes:
+                removed += db.execute_sql(
+                    "DELETE FROM recipe_changes WHERE seq <= ? AND operation = 'delete'",
+                    (through,)).rowcount
+            RecipeChangeCompaction.create(through=through, deletes_dropped=drop_deletes,
+                                          removed=removed)
+        return removed
+
+
+class RecipeChangeCompaction(Model):
+    """One run of RecipeChange.compact, kept to know which readers of the
+    change log have fallen too far behind to carry on."""
+    through = IntegerField()
+    deletes_dropped = BooleanField()
+    removed = IntegerField()
+    compacted_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = db
+        table_name = 'recipe_change_compactions'
+
+
+class RecipeSignature(Model):
+    """MinHash signature of each recipe's normalized ingredient names,
+    used to find recipes with similar ingredients (see similarity.py).
+
+    Each signature's band keys are stored in RecipeBand, so the recipes
+    sharing a band with a signature are found through an index rather
+    than by comparing it with every recipe. Ingredient writes save the
+    new signature and bands of the recipe they change, in the same
+    transaction. Triggers on recipes delete them whenever a recipe's
+    ingredient list changes or it is deleted, whoever writes it, so what
+    is stored is never stale. build_missing computes any that are
+    missing, for recipes saved before this table existed.
+
+    Changing MinHasher's parameters needs both tables emptied.
+    """
+    recipe_id = IntegerField(primary_key=True)
+    signature = BlobField()
+
+    class Meta:
+        database = db
+        table_name = 'recipe_signatures'
+
+    BATCH_SIZE = 5000
+
+    hasher = None
+
+    # Whether build_missing has run in this process. Signatures are kept
+    # up to date from then on, so it only needs to run once.
+    complete = False
+
+    @classmethod
+    def get_hasher(cls):
+        """Returns the shared MinHasher, creating it on first use."""
+        if cls.hasher is None:
+            from similarity import MinHasher
+            cls.hasher = MinHasher()
+        return cls.hasher
+
+    @staticmethod
+    def create_triggers():
+        """Creates the triggers that drop signatures when recipes change."""
+        for suffix, event, row in (('au', 'UPDATE OF ingredient_list', 'new'),
+                                   ('ad', 'DELETE', 'old')):
+            db.execute_sql(
+                f'CREATE TRIGGER IF NOT EXISTS recipes_signature_{suffix} AFTER {event} '
+                f'ON recipes BEGIN '
+                f'DELETE FROM recipe_signatures WHERE recipe_id = {row}.id; '
+                f'DELETE FROM recipe_bands WHERE recipe_id = {row}.id; END;')
+
+    @classmethod
+    def ingredients_changed(cls, recipe_id, rows):
+        """Ingredient listener saving the signature of a recipe's new
+        ingredients. The triggers have already deleted the old one."""
+        if rows is not None:
+            hasher = cls.get_hasher()
+            signature = hasher.signature(row['normalized_name'] for row in rows)
+            cls._insert([(recipe_id, signature, hasher.band_keys(signature))])
+
+    @classmethod
+    def of_recipe(cls, recipe_id):
+        """Returns the signature of a saved recipe."""
+        signature = (cls.select(cls.signature).where(cls.recipe_id == recipe_id)
+                     .tuples().first())
+        if signature is not None:
+            return bytes(signature[0])
+        if not Recipe.select().where(Recipe.id == recipe_id).exists():
+            raise Recipe.DoesNotExist(f'no recipe with id {recipe_id}')
+        return cls.get_hasher().signature(
+            name for name, in Ingredient.select(Ingredient.normalized_name)
+            .where(Ingredient.recipe == recipe_id).tuples())
+
+    @classmethod
+    def search(cls, signature, limit=10, min_score=0.5, exclude=None):
+        """Returns up to limit (id, score) pairs for the recipes most
+        similar to a signature, best first, leaving out the id exclude.
+        Only recipes sharing a band with the signature are scored.
+        """
+        from similarity import similarity
+        if not cls.complete:
+            cls.build_missing()
+        keys = cls.get_hasher().band_keys(signature)
+        if not keys:
+            return []
+        candidates = db.execute_sql(
+            f'SELECT recipe_id, signature FROM recipe_signatures WHERE recipe_id IN '
+            f'(SELECT recipe_id FROM recipe_bands WHERE band_key IN '
+            f'({", ".join("?" * len(keys))}))', keys)
+        scored = []
+        for recipe_id, other in candidates:
+            if recipe_id != exclude:
+                score = similarity(signature, other)
+                if score >= min_score:
+                    scored.append((score, -recipe_id))
+        scored.sort(reverse=True)
+        return [(-negative_id, score) for score, negative_id in scored[:limit]]
+
+    @classmethod
+    @metrics.timed('recipe.build_signatures')
+    def build_missing(cls, workers=None):
+        """Computes and saves the signatures that recipes lack, in batches
+        of BATCH_SIZE recipes spread over a pool of processes. Returns how
+        many were saved.
+
+        Parameters:
+            workers - processes computing signatures, by default one per
+                CPU but one. With 0, they are computed in this process.
+        """
+        from similarity import signatures
+        missing = [row[0] for row in db.execute_sql(
+            'SELECT id FROM recipes WHERE id NOT IN (SELECT recipe_id FROM recipe_signatures) '
+            'ORDER BY id')]
+        cls.complete = True
+        if not missing:
+            return 0
+        if workers is None:
+            workers = (os.cpu_count() or 1) - 1
+        batches = (cls._batch(ids) for ids in chunked(missing, cls.BATCH_SIZE))
+        saved = 0
+        if not workers:
+            for seq, batch in batches:
+                saved += cls._save(seq, signatures(batch))
+            return saved
+        from concurrent.futures import ProcessPoolExecutor
+        # A few batches per process are in flight at a time, so the
+        # ingredient names of the whole cookbook are never held at once.
+        pending = []
+        with ProcessPoolExecutor(workers) as pool:
+            for seq, batch in batches:
+                pending.append((seq, pool.submit(signatures, batch)))
+                if len(pending) >= workers * 2:
+                    seq, future = pending.pop(0)
+                    saved += cls._save(seq, future.result())
+            for seq, future in pending:
+                saved += cls._save(seq, future.result())
+        return saved
+
+    @staticmethod
+    def _batch(recipe_ids):
+        """Returns the last change seq and the (id, normalized ingredient
+        names) pairs of some recipes."""
+        seq = RecipeChange.last_seq()
+        names = {recipe_id: [] for recipe_id in recipe_ids}
+        rows = db.execute_sql(
+            f'SELECT recipe_id, normalized_name FROM ingredients WHERE recipe_id IN '
+            f'({", ".join("?" * len(recipe_ids))})', recipe_ids)
+        for recipe_id, name in rows:
+            names[recipe_id].append(name)
+        return seq, list(names.items())
+
+    @classmethod
+    def _save(cls, seq, rows):
+        """Saves (id, signature, band keys) rows computed from ingredients
+        read at change seq, skipping those of recipes changed since.
+        Returns how many were saved."""
+        with db.atomic():
+            try:
+                changed = {recipe_id for _, recipe_id in RecipeChange.changes_since(seq)}
+            except ChangesCompacted:
+                # Which recipes changed is unknown, so leave them all to
+                # the next build.
+                cls.complete = False
+                return 0
+            rows = [row for row in rows if row[0] not in changed]
+            cls._insert(rows)
+        return len(rows)
+
+    @staticmethod
+    def _insert(rows):
+        """Inserts (id, signature, band keys) rows. Use inside a transaction."""
+        cursor = db.cursor()
+        cursor.executemany(
+            'INSERT OR REPLACE INTO recipe_signatures (recipe_id, signature) VALUES (?, ?)',
+            [row[:2] for row in rows])
+        # Inserting in key order touches each page of the index once.
+        cursor.executemany(
+            'INSERT OR IGNORE INTO recipe_bands (band_key, recipe_id) VALUES (?, ?)',
+            sorted((key, recipe_id) for recipe_id, _, keys in rows for key in keys))
+
+
+class RecipeBand(Model):
+    """The band keys of each recipe's signature, looked up by key."""
+    band_key = IntegerField()
+    recipe_id = IntegerField(index=True)
+
+    class Meta:
+        database = db
+        table_name = 'recipe_bands'
+        primary_key = CompositeKey('band_key', 'recipe_id')
+        without_rowid = True
+
+
+Ingredient.listeners.append(RecipeSignature.ingredients_changed)
+
+
+class RecipeFilter():
+    """Finds the recipes meeting several conditions with one SQL query.
+
+    Parameters:
+        include - ingredient names the recipe must use, matched against
+            normalized names as in RecipeService.search
+        exclude - ingredient names the recipe must not use, matched the same way
+        name - words that must each prefix-match a word of the recipe name
+        max_prep, max_cook, max_total - most seconds of prep, cook and
+            total time. Recipes whose time is unknown do not match.
+
+    Every condition but exclude can be looked up in an index: an
+    ingredient name index (see Ingredient.name_lookup), the name column of the full-text
+    index or an index on a duration column. plan() estimates how many rows
+    each would yield by counting at most ESTIMATE_LIMIT index entries, and
+    the query looks up recipes by the ids the one yielding fewest finds.
+    The other conditions are only checked on those recipes: ingredients
+    through the index on recipe, names against the full-text matches and
+    durations on the row. Only a filter made of exclusions alone has to
+    scan the recipes table.
+    """
+
+    ESTIMATE_LIMIT = 5000
+    DURATION_BOUNDS = {'max_prep': 'prep_seconds', 'max_cook': 'cook_seconds',
+                       'max_total': 'total_seconds'}
+
+    def __init__(self, include=(), exclude=(), name=None, max_prep=None, max_cook=None,
+                 max_total=None):
+        from search import RecipeSearch
+        self.include = [Ingredient.normalize(item) for item in include]
+        self.exclude = [Ingredient.normalize(item) for item in exclude]
+        self.name = RecipeSearch.to_match_expression(name) if name else None
+        self.bounds = {}
+        for bound, value in (('max_prep', max_prep), ('max_cook', max_cook),
+                             ('max_total', max_total)):
+            if value is not None:
+                if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                    raise ValueError(f'{bound} must be a whole number of seconds, not {value!r}')
+                self.bounds[self.DURATION_BOUNDS[bound]] = value
+        if name and self.name is None:
+            raise ValueError(f'name has no words to search for: {name!r}')
+
+    def candidates(self):
+        """Returns the conditions an index can look up, as (kind, value)
+        pairs: ('ingredient', normalized name), ('name', FTS expression) or
+        ('duration', column name)."""
+        candidates = [('ingredient', ingredient) for ingredient in self.include]
+        if self.name is not None:
+            candidates.append(('name', self.name))
+        candidates.extend(('duration', column) for column in self.bounds)
+        return candidates
+
+    def _name_match(self):
+        from search import RecipeSearch
+        return RecipeSearch.match(f'name : ({self.name})')
+
+    def estimate(self, candidate):
+        """Returns how many index entries a candidate yields, counting no
+        further than ESTIMATE_LIMIT."""
+        from search import RecipeSearch
+        kind, value = candidate
+        if kind == 'ingredient':
+            query = Ingredient.select(SQL('1')).where(Ingredient.name_lookup(value))
+        elif kind == 'name':
+            query = RecipeSearch.select(SQL('1')).where(self._name_match())
+        else:
+            column = getattr(Recipe, value)
+            query = Recipe.select(SQL('1')).where(column <= self.bounds[value])
+        return query.limit(self.ESTIMATE_LIMIT).count()
+
+    def plan(self):
+        """Returns (driving candidate or None, {candidate: estimate}).
+        Ties go to the earlier candidate: ingredients, then name, then times.
+        """
+        estimates = {candidate: self.estimate(candidate) for candidate in self.candidates()}
+        if not estimates:
+            return None, estimates
+        driver = min(estimates, key=estimates.get)
+        return driver, estimates
+
+    def query(self, driver=None, limit=None):
+        """Returns the query of matching recipes' ids, names and durations
+        in id order, driven by the given candidate or else by plan()'s."""
+        if driver is None:
+            driver, _ = self.plan()
+        conditions = []
+        for candidate in self.candidates():
+            kind, value = candidate
+            if candidate == driver:
+                # SQLite looks recipes up by the ids this yields. The other
+                # conditions are written so it cannot use them instead.
+                conditions.append(Recipe.id.in_(self._recipe_ids(candidate)))
+            elif kind == 'ingredient':
+                conditions.append(fn.EXISTS(self._recipe_ingredients(value)))
+            elif kind == 'name':
+                # Adding 0 makes the id an expression, which SQLite only
+                # checks against the matches rather than looking them up.
+                conditions.append((Recipe.id + 0).in_(self._recipe_ids(candidate)))
+            else:
+                conditions.append(getattr(Recipe, value) + 0 <= self.bounds[value])
+        for ingredient in self.exclude:
+            conditions.append(~fn.EXISTS(self._recipe_ingredients(ingredient)))
+        query = Recipe.select(Recipe.id, Recipe.name, Recipe.prep_seconds,
+                              Recipe.cook_seconds, Recipe.total_seconds)
+        if conditions:
+            query = query.where(reduce(operator.and_, conditions))
+        query = query.order_by(Recipe.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def _recipe_ids(self, candidate):
+        """Returns a subquery of the recipe ids a candidate's index yields."""
+        from search import RecipeSearch
+        kind, value = candidate
+        if kind == 'ingredient':
+            return Ingredient.select(Ingredient.recipe).where(Ingredient.name_lookup(value))
+        if kind == 'name':
+            return RecipeSearch.select(RecipeSearch.rowid).where(self._name_match())
+        durations = Recipe.alias()
+        return durations.select(durations.id).where(
+            getattr(durations, value) <= self.bounds[value])
+
+    def _recipe_ingredients(self, ingredient):
+        return Ingredient.select(SQL('1')).where(
+            (Ingredient.recipe == Recipe.id) & Ingredient.name_check(ingredient))
+
+    def explain(self, limit=None):
+        """Returns the plan as a dict: the driving candidate, the estimates
+        and SQLite's EXPLAIN QUERY PLAN lines for the query."""
+        driver, estimates = self.plan()
+        sql, params = self.query(driver, limit).sql()
+        lines = [row[3] for row in db.execute_sql(f'EXPLAIN QUERY PLAN {sql}', params)]
+        return {
+            'driver': None if driver is None else list(driver),
+            'estimates': [[kind, value, count] for (kind, value), count in estimates.items()],
+            'plan': lines,
+            'full_scans': self.full_scans(lines),
+        }
+
+    @staticmethod
+    def full_scans(lines):
+        """Returns the EXPLAIN QUERY PLAN lines that read a whole table or
+        index. A full-text lookup shows as a scan of a virtual table, which
+        it is not."""
+        return [line for line in lines
+                if line.startswith('SCAN ') and 'VIRTUAL TABLE' not in line]
+
+
+class VersionConflict(ValueError):
+    """Raised when a recipe changed since the version an edit was based on."""
+
+
+class EditConflict(VersionConflict):
+    """Raised when an edit session changed fields that were also changed
+    and saved by someone else since. fields names them."""
+
+    def __init__(self, message, fields):
+        super().__init__(message)
+        self.fields = fields
+
+
+class RecipeService():
+    """Recipe operations that take arguments and return data,
+    without input() or print().
+
+    The text menus in Recipe and the command line in cli.py are both
+    built on it. Methods that change a recipe write in one transaction,
+    keep the ingredients table in sync and invalidate the recipe cache.
+    Missing recipes raise Recipe.DoesNotExist and invalid arguments
+    raise ValueError.
+
+    Writes are keyed by recipe id and bump the recipe's version. Methods
+    that change a recipe take an optional expected_version, and raise
+    VersionConflict instead of writing if the recipe has moved on since.
+    Ingredient edits change the stored JSON list in SQL with json_insert,
+    json_remove and json_set rather than rewriting the whole list.
+    """
+
+    FIELDS = ('name', 'ingredient_list', 'prep_time', 'cook_time', 'instructions', 'servings')
+
+    @staticmethod
+    def find(key):
+        """Returns the recipe whose id or, failing that, name is key."""
+        if str(key).strip().isdigit():
+            recipe = Recipe.get_or_none(Recipe.id == int(key))
+            if recipe is not None:
+                return recipe
+        recipe = Recipe.get_or_none(Recipe.name == key)
+        if recipe is None:
+            raise Recipe.DoesNotExist(f'no recipe with id or name {key!r}')
+        return recipe
+
+    @staticmethod
+    def to_dict(recipe):
+        """Returns a recipe as a JSON-serializable dict."""
+        return {
+            'id': recipe.id,
+            'name': recipe.name,
+            'date_created': str(recipe.date_created),
+            'prep_time': None if recipe.prep_time is None else str(recipe.prep_time),
+            'cook_time': None if recipe.cook_time is None else str(recipe.cook_time),
+            'instructions': recipe.instructions,
+            'servings': recipe.servings,
+            'prep_seconds': recipe.prep_seconds,
+            'cook_seconds': recipe.cook_seconds,
+            'total_seconds': recipe.total_seconds,
+            'ingredient_list': json.loads(recipe.ingredient_list),
+            'version': recipe.version,
+        }
+
+    SORTS = ('id', 'name', 'date_created')
+
+    @classmethod
+    def list_recipes(cls, sort='id', descending=False, after=None, limit=None):
+        """Returns the id and name of recipes in sort order, one page at a time.
+
+        Parameters:
+            sort - one of SORTS. Sorting by date_created adds it to each dict.
+            descending - sort in reverse order
+            after - id of the last recipe of the previous page, or None
+                to start at the beginning
+            limit - most recipes returned, or None for all of them
+        """
+        if after is None:
+            return cls._recipe_page(sort, descending, None, limit)
+        field = cls._sort_field(sort)
+        snapshot = Recipe.fresh_snapshot()
+        if snapshot is not None:
+            key = snapshot.sort_key(after, sort)
+        else:
+            last = Recipe.select(field).where(Recipe.id == after).scalar()
+            key = None if last is None else (last, after)
+        if key is None:
+            raise Recipe.DoesNotExist(f'no recipe with id {after!r}')
+        return cls._recipe_page(sort, descending, key, limit)
+
+    @classmethod
+    def recipe_pages(cls, sort='id', descending=False, page_size=20):
+        """Yields lists of up to page_size recipe dicts as list_recipes
+        returns them, running one query per page as it is asked for.
+        """
+        key = None
+        while True:
+            page = cls._recipe_page(sort, descending, key, page_size)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            key = (page[-1][sort], page[-1]['id'])
+
+    @classmethod
+    def changes_since(cls, seq=0, limit=None, page_size=500):
+        """Yields the recipe changes committed after seq, oldest first, as
+        dicts of seq, recipe_id, operation ('create', 'update' or 'delete'),
+        changed_at and recipe. recipe is the recipe as to_dict returns it
+        now, or None for deletes and recipes deleted since.
+
+        Applying the changes in order, saving recipes and deleting the
+        ones that are None, brings a copy up to date; carry on from the
+        seq of the last one applied. Reads page_size changes per query,
+        up to limit changes in all if it is given.
+
+        Raises ChangesCompacted if changes after seq have been compacted
+        away. Read RecipeChange.last_seq(), copy every recipe, and carry
+        on from that seq instead.
+        """
+        for page in RecipeChange.pages(seq, page_size, limit):
+            recipe_ids = {change['recipe_id'] for change in page
+                          if change['operation'] != 'delete'}
+            recipes = {recipe.id: recipe
+                       for recipe in Recipe.select().where(Recipe.id.in_(list(recipe_ids)))}
+            for change in page:
+                recipe = recipes.get(change['recipe_id'])
+                if recipe is not None and change['operation'] != 'delete':
+                    change['recipe'] = cls.to_dict(recipe)
+                else:
+                    change['recipe'] = None
+                yield change
+
+    @classmethod
+    def _sort_field(cls, sort):
+        if sort not in cls.SORTS:
+            raise ValueError(f'sort must be one of {", ".join(cls.SORTS)}, not {sort!r}')
+        return getattr(Recipe, sort)
+
+    @classmethod
+    @metrics.timed('service.list_recipes')
+    def _recipe_page(cls, sort, descending, key, limit):
+        """Returns the page of recipes after key, a (sort value, id) pair.
+
+        Pages are found by keyset rather than offset: the query seeks past
+        the last row of the previous page in an index on the sort column,
+        and reads only id and name, so any page costs the same to fetch.
+        """
+        snapshot = Recipe.fresh_snapshot()
+        if snapshot is not None:
+            cls._sort_field(sort)
+            return snapshot.page(sort, descending, key, limit)
+        return list(cls._page_query(sort, descending, key, limit).dicts())
+
+    @classmethod
+    def _page_query(cls, sort, descending, key, limit):
+        """Returns the query _recipe_page runs when there is no snapshot."""
+        field = cls._sort_field(sort)
+        columns = [Recipe.id, Recipe.name]
+        order = [Recipe.id]
+        if field is not Recipe.id:
+            order.insert(0, field)
+            if field is not Recipe.name:
+                columns.append(field)
+        query = Recipe.select(*columns)
+        if key is not None:
+            if field is Recipe.id:
+                position, last = Recipe.id, key[1]
+            else:
+                position, last = Tuple(field, Recipe.id), Tuple(*key)
+            query = query.where(position < last if descending else position > last)
+        query = query.order_by(*[column.desc() if descending else column for column in order])
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @staticmethod
+    @metrics.timed('service.search')
+    def search(search_query, limit=None):
+        """Returns the id and name of recipes with an ingredient
+        containing search_query, up to limit of them if it is given.
+        Searches shorter than Ingredient.SUBSTRING_MIN_LENGTH match the
+        start of ingredient names only."""
+        snapshot = Recipe.fresh_snapshot()
+        if snapshot is not None:
+            normalized = Ingredient.normalize(search_query)
+            return snapshot.search(
+                normalized, limit,
+                substring=len(normalized) >= Ingredient.SUBSTRING_MIN_LENGTH)
+        query = Ingredient.search(search_query)
+        if limit is not None:
+            query = query.limit(limit)
+        return list(query.dicts())
+
+    @staticmethod
+    @metrics.timed('service.full_text_search')
+    def full_text_search(search_query, limit=20):
+        """Returns the id, name and score of the best matching recipes."""
+        from search import RecipeSearch
+        return list(RecipeSearch.search(search_query, limit).dicts())
+
+    @staticmethod
+    @metrics.timed('service.find_similar')
+    def find_similar(query, limit=5):
+        """Returns the id, name and score of up to limit recipes with names
+        like query, best first. Tolerates typos and ignores case; a score
+        of 1.0 means the name matches apart from case and spacing.
+        """
+        index = Recipe.get_name_index()
+        return [{'id': recipe_id, 'name': index.names[recipe_id], 'score': score}
+                for recipe_id, score in index.search(query, limit)]
+
+    @staticmethod
+    @metrics.timed('service.similar_recipes')
+    def similar_recipes(recipe_id, limit=10, min_score=0.5):
+        """Returns the id, name and score of up to limit recipes whose
+        ingredients are most like a recipe's, best first. The score
+        estimates the share of ingredients in common, from 0 to 1.
+        """
+        signature = RecipeSignature.of_recipe(recipe_id)
+        return RecipeService._with_names(
+            RecipeSignature.search(signature, limit, min_score, exclude=recipe_id))
+
+    @classmethod
+    @metrics.timed('service.likely_duplicates')
+    def likely_duplicates(cls, ingredient_list, limit=5, min_score=0.8):
+        """Returns the id, name and score of up to limit saved recipes with
+        much the same ingredients as an ingredient list, say of a recipe
+        about to be added, best first. Scores are as in similar_recipes.
+        """
+        ingredient_list = cls._validate_ingredients(ingredient_list)
+        signature = RecipeSignature.get_hasher().signature(
+            Ingredient.normalize(item.get('ingredient_name') or '') for item in ingredient_list)
+        return cls._with_names(RecipeSignature.search(signature, limit, min_score))
+
+    @staticmethod
+    def _with_names(matches):
+        """Returns (id, score) pairs as dicts with the recipes' names."""
+        names = dict(Recipe.select(Recipe.id, Recipe.name).where(
+            Recipe.id.in_([recipe_id for recipe_id, _ in matches])).tuples())
+        return [{'id': recipe_id, 'name': names.get(recipe_id), 'score': score}
+                for recipe_id, score in matches]
+
+    @staticmethod
+    @metrics.timed('service.pantry_matches')
+    def pantry_matches(pantry, max_missing=0, limit=None):
+        """Returns the id, name and missing ingredients of recipes makeable
+        from the pantry, allowing up to max_missing missing ingredients.
+        """
+        pantry = [Ingredient.normalize(name) for name in pantry]
+        matcher = Recipe.get_pantry_matcher()
+        matches = matcher.matches(pantry, max_missing, limit)
+        names = dict(Recipe.select(Recipe.id, Recipe.name).where(
+            Recipe.id.in_([recipe_id for recipe_id, _ in matches])).tuples())
+        return [{
+            'id': recipe_id,
+            'name': names.get(recipe_id),
+            'missing': matcher.missing_ingredients(recipe_id, pantry) if missing_count else [],
+        } for recipe_id, missing_count in matches]
+
+    @staticmethod
+    @metrics.timed('service.filter_recipes')
+    def filter_recipes(include=(), exclude=(), name=None, max_prep=None, max_cook=None,
+                       max_total=None, limit=None):
+        """Returns the id, name and durations in seconds of recipes meeting
+        every given condition, in id order. See RecipeFilter for the
+        conditions and how the query is planned."""
+        recipe_filter = RecipeFilter(include, exclude, name, max_prep, max_cook, max_total)
+        return list(recipe_filter.query(limit=limit).dicts())
+
+    @staticmethod
+    def explain_filter(include=(), exclude=(), name=None, max_prep=None, max_cook=None,
+                       max_total=None, limit=None):
+        """Returns how filter_recipes would run, as RecipeFilter.explain does."""
+        recipe_filter = RecipeFilter(include, exclude, name, max_prep, max_cook, max_total)
+        return recipe_filter.explain(limit)
+
+    @staticmethod
+    def _validate_ingredients(ingredient_list):
+        if not isinstance(ingredient_list, (list, tuple)):
+            raise ValueError('ingredient_list must be a list')
+        for idx, item in enumerate(ingredient_list, 1):
+            try:
+                Recipe.validate_ingredient(item)
+            except ValueError as e:
+                raise ValueError(f'ingredient {idx}: {e}')
+        return list(ingredient_list)
+
+    @staticmethod
+    def check_servings(servings):
+        """Returns servings as a positive int, or None if it is empty."""
+        if servings is None or servings == '':
+            return None
+        if isinstance(servings, str) and servings.strip().isdigit():
+            servings = int(servings)
+        if isinstance(servings, bool) or not isinstance(servings, int) or servings < 1:
+            raise ValueError(f'servings must be a whole number from 1, not {servings!r}')
+        return servings
+
+    @classmethod
+    def add(cls, name, ingredient_list=(), prep_time=None, cook_time=None, instructions=None,
+            servings=None):
+        """Creates a recipe and returns it."""
+        values, ingredient_list = cls._new_values(
+            name, ingredient_list, prep_time, cook_time, instructions, servings)
+        with db.atomic():
+            recipe = Recipe.create(**values)
+            Ingredient.replace_for(recipe.id, ingredient_list)
+        Recipe.notify_name(recipe.id, recipe.name)
+        return recipe
+
+    @classmethod
+    def _new_values(cls, name, ingredient_list=(), prep_time=None, cook_time=None,
+                    instructions=None, servings=None):
+        """Checks a new recipe and returns (column values, ingredient list)."""
+        name = (name or '').strip()
+        if not name:
+            raise ValueError('name must not be empty')
+        ingredient_list = cls._validate_ingredients(ingredient_list)
+        servings = cls.check_servings(servings)
+        values = Recipe.with_durations(dict(
+            name=name, ingredient_list=json.dumps(ingredient_list),
+            prep_time=prep_time, cook_time=cook_time, instructions=instructions,
+            servings=servings))
+        return values, ingredient_list
+
+    @classmethod
+    def update(cls, recipe_id, expected_version=None, **fields):
+        """Updates the given fields of a recipe and returns it.
+        Takes any of name, ingredient_list, prep_time, cook_time, instructions
+        and servings.
+        """
+        values, ingredient_list = cls._update_values(fields)
+        with db.atomic():
+            cls._write(recipe_id, expected_version, **values)
+            if ingredient_list is not None:
+                Ingredient.replace_for(recipe_id, ingredient_list)
+            Recipe.get_recipe_cache().invalidate(recipe_id)
+        recipe = Recipe.get_by_id(recipe_id)
+        if 'name' in fields:
+            Recipe.notify_name(recipe_id, recipe.name)
+        return recipe
+
+    @classmethod
+    def _update_values(cls, fields):
+        """Checks the fields of an update and returns (column values,
+        ingredient list, or None if it is not being changed)."""
+        unknown = set(fields) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f'unknown fields: {", ".join(sorted(unknown))}')
+        fields = dict(fields)
+        if 'name' in fields and not (fields['name'] or '').strip():
+            raise ValueError('name must not be empty')
+        if 'servings' in fields:
+            fields['servings'] = cls.check_servings(fields['servings'])
+        values = Recipe.with_durations(fields)
+        ingredient_list = None
+        if 'ingredient_list' in fields:
+            ingredient_list = cls._validate_ingredients(fields['ingredient_list'])
+            values['ingredient_list'] = json.dumps(ingredient_list)
+        return values, ingredient_list
+
+    @classmethod
+    def delete(cls, recipe_id, expected_version=None):
+        """Deletes a recipe and its ingredients."""
+        query = Recipe.delete().where(Recipe.id == recipe_id)
+        if expected_version is not None:
+            query = query.where(Recipe.version == expected_version)
+        with db.atomic():
+            if not query.execute():
+                cls._raise_not_written(recipe_id, expected_version)
+            Ingredient.delete_for(recipe_id)
+            Recipe.get_recipe_cache().invalidate(recipe_id)
+        Recipe.notify_name(recipe_id, None)
+
+    @staticmethod
+    def _check_position(position):
+        if isinstance(position, bool) or not isinstance(position, int) or position < 1:
+            raise ValueError(f'position must be a number from 1, not {position!r}')
+
+    @classmethod
+    def _write(cls, recipe_id, expected_version=None, position=None, database=None,
+               **values):
+        """Updates one recipe row by id in a single statement and bumps
+        its version.
+
+        Parameters:
+            recipe_id - id of the recipe to update
+            expected_version - only update if the recipe is still at this
+                version, or None to update whatever the version
+            position - only update if the ingredient list has an
+                ingredient at this 1-based position
+            database - database to update in, defaults to db
+            values - columns to set, as values or SQL expressions
+        """
+        query = Recipe.update(version=Recipe.version + 1, **values).where(
+            Recipe.id == recipe_id)
+        if expected_version is not None:
+            query = query.where(Recipe.version == expected_version)
+        if position is not None:
+            query = query.where(fn.json_array_length(Recipe.ingredient_list) >= position)
+        if not query.execute(database):
+            cls._raise_not_written(recipe_id, expected_version, position, database)
+
+    @staticmethod
+    def _raise_not_written(recipe_id, expected_version=None, position=None, database=None):
+        """Raises the error explaining why a write keyed by id changed nothing."""
+        current = (Recipe
+                   .select(Recipe.version, fn.json_array_length(Recipe.ingredient_list))
+                   .where(Recipe.id == recipe_id)
+                   .tuples()
+                   .first(database))
+        if current is None:
+            raise Recipe.DoesNotExist(f'no recipe with id {recipe_id}')
+        version, length = current
+        if expected_version is not None and version != expected_version:
+            raise VersionConflict(
+                f'recipe {recipe_id} was changed by someone else '
+                f'(version {version}, expected {expected_version})')
+        raise ValueError(f'no ingredient at position {position} (recipe has {length})')
+
+    @classmethod
+    def add_ingredient(cls, recipe_id, ingredient, expected_version=None):
+        """Appends an ingredient dict to a recipe and returns the recipe."""
+        Recipe.validate_ingredient(ingredient)
+        with db.atomic():
+            cls._write(recipe_id, expected_version, ingredient_list=fn.json_insert(
+                Recipe.ingredient_list, '$[#]', fn.json(json.dumps(ingredient))))
+            Ingredient.append_row(recipe_id, ingredient)
+            Recipe.get_recipe_cache().invalidate(recipe_id)
+        return Recipe.get_by_id(recipe_id)
+
+    @classmethod
+    def delete_ingredient(cls, recipe_id, position, expected_version=None):
+        """Deletes the ingredient at a 1-based position and returns it."""
+        cls._check_position(position)
+        path = f'$[{position - 1}]'
+        with db.atomic():
+            removed = (Recipe
+                       .select(fn.json_extract(Recipe.ingredient_list, path))
+                       .where(Recipe.id == recipe_id)
+                       .scalar())
+            cls._write(recipe_id, expected_version, position,
+                       ingredient_list=fn.json_remove(Recipe.ingredient_list, path))
+            Ingredient.remove_row(recipe_id, position)
+            Recipe.get_recipe_cache().invalidate(recipe_id)
+        return json.loads(removed)
+
+    @classmethod
+    def update_ingredient(cls, recipe_id, position, expected_version=None, **changes):
+        """Changes keys of the ingredient at a 1-based position and
+        returns the recipe."""
+        cls._check_position(position)
+        Recipe.validate_ingredient(changes, partial=True)
+        if not changes:
+            raise ValueError('no ingredient changes given')
+        arguments = []
+        for key, value in changes.items():
+            # json() keeps true/false and numbers as JSON values, not strings.
+            arguments += [f'$[{position - 1}].{key}', fn.json(json.dumps(value))]
+        with db.atomic():
+            cls._write(recipe_id, expected_version, position,
+                       ingredient_list=fn.json_set(Recipe.ingredient_list, *arguments))
+            Ingredient.update_row(recipe_id, position, changes)
+            Recipe.get_recipe_cache().invalidate(recipe_id)
+        return Recipe.get_by_id(recipe_id)
+
+    @classmethod
+    @metrics.timed('service.scale')
+    def scale(cls, recipe_id, servings=None, factor=None, system=None):
+        """Returns a recipe as a dict with its ingredient amounts scaled
+        and, if system is 'us' or 'metric', converted to those units.
+
+        Give either servings, which needs the recipe's servings to be set,
+        or a factor to multiply amounts by. Amounts that are not numbers,
+        like 'to taste', are left as they are.
+        """
+        from quantities import SYSTEMS, parse_ingredient_list, scale_ingredients
+        recipe, ingr_json = Recipe.get_cached(recipe_id)
+        if (servings is None) == (factor is None):
+            raise ValueError('give either servings or a factor')
+        if servings is not None:
+            servings = cls.check_servings(servings)
+            if servings is None or not recipe.servings:
+                raise ValueError(f'{recipe.name} has no servings set; scale it by a factor')
+            factor = servings / recipe.servings
+        if isinstance(factor, bool) or not isinstance(factor, (int, float)) or factor <= 0:
+            raise ValueError(f'factor must be a number above 0, not {factor!r}')
+        if system is not None and system not in SYSTEMS:
+            raise ValueError(f'units must be one of {", ".join(SYSTEMS)}, not {system!r}')
+        if servings is None and recipe.servings:
+            servings = recipe.servings * factor
+        scaled = cls.to_dict(recipe)
+        scaled['servings'] = servings
+        scaled['ingredient_list'] = scale_ingredients(
+            ingr_json, parse_ingredient_list(recipe.ingredient_list), factor, system)
+        return scaled
+
+    @classmethod
+    @metrics.timed('service.shopping_list')
+    def shopping_list(cls, plan, system=None):
+        """Returns a shopping list for a meal plan as a dict of the planned
+        'recipes' and the merged ingredient 'items'.
+
+        Parameters:
+            plan - list of (recipe_id, servings) pairs. servings may be None
+                to make a recipe as written, and a recipe may be planned
+                more than once.
+            system - 'us', 'metric' or None to keep the units as written
+
+        The recipes are read with a single query. Items are ingredient
+        dicts, optional ones last, with the ids of the recipes using them.
+        """
+        from quantities import SYSTEMS, combine_ingredients, parse_ingredient_list
+        if system is not None and system not in SYSTEMS:
+            raise ValueError(f'units must be one of {", ".join(SYSTEMS)}, not {system!r}')
+        plan = [(recipe_id, cls.check_servings(servings)) for recipe_id, servings in plan]
+        recipes = {recipe.id: recipe for recipe in Recipe
+                   .select(Recipe.id, Recipe.name, Recipe.servings, Recipe.ingredient_list)
+                   .where(Recipe.id.in_({recipe_id for recipe_id, _ in plan}))}
+        factors = {}
+        for recipe_id, servings in plan:
+            recipe = recipes.get(recipe_id)
+            if recipe is None:
+                raise Recipe.DoesNotExist(f'no recipe with id {recipe_id}')
+            if servings is not None and not recipe.servings:
+                raise ValueError(f'{recipe.name} has no servings set, so it cannot '
+                                 f'be scaled to {servings}')
+            factor = servings / recipe.servings if servings is not None else 1
+            factors[recipe_id] = factors.get(recipe_id, 0) + factor
+        items = combine_ingredients(
+            ((recipe_id, factor, json.loads(recipes[recipe_id].ingredient_list),
+              parse_ingredient_list(recipes[recipe_id].ingredient_list))
+             for recipe_id, factor in factors.items()),
+            system)
+        return {
+            'recipes': [{
+                'id': recipe_id,
+                'name': recipes[recipe_id].name,
+                'factor': factor,
+            } for recipe_id, factor in factors.items()],
+            'items': items,
+        }
+
+    @staticmethod
+    def quantity_table(recipe_ids=None):
+        """Returns a QuantityTable of the ingredients of the given recipes,
+        or of every recipe, read with one query on the ingredients table.
+        """
+        from quantities import QuantityTable
+        rows = (Ingredient
+                .select(Ingredient.recipe, Ingredient.normalized_name,
+                        Ingredient.amount, Ingredient.units)
+                .order_by(Ingredient.recipe, Ingredient.position))
+        if recipe_ids is not None:
+            rows = rows.where(Ingredient.recipe.in_(list(recipe_ids)))
+        return QuantityTable.from_rows(rows.tuples().iterator())
+
+    OPERATIONS = ('add', 'update', 'delete', 'add_ingredient',
+                  'delete_ingredient', 'update_ingredient')
+
+    @classmethod
+    @metrics.timed('service.apply')
+    def apply(cls, operations):
+        """Applies a batch of operations in a single transaction and
+        returns a list with the result of each one.
+
+        Each operation is a dict with an 'op' key naming a method in
+        OPERATIONS and that method's arguments. Instead of recipe_id, a
+        'recipe' key may give a recipe id or name:
+
+            {'op': 'update', 'recipe': 'garlic bread', 'prep_time': '5 mins'}
+
+        If any operation fails, none of them are applied and ValueError
+        is raised saying which one failed.
+        """
+        results = []
+        try:
+            with db.atomic():
+                for number, operation in enumerate(operations, 1):
+                    try:
+                        results.append(cls._apply_one(operation))
+                    except (ValueError, TypeError, DoesNotExist, IntegrityError) as e:
+                        raise ValueError(f'operation {number}: {e}') from e
+        except Exception:
+            # In-memory state may include changes that were rolled back.
+            Recipe.get_recipe_cache().clear()
+            Recipe.reset_pantry_matcher()
+            Recipe.reset_name_index()
+            raise
+        return results
+
+    @classmethod
+    def _apply_one(cls, operation):
+        operation = dict(operation)
+        op = operation.pop('op', None)
+        if op not in cls.OPERATIONS:
+            raise ValueError(f'unknown op {op!r}')
+        if 'recipe' in operation:
+            operation['recipe_id'] = cls.find(operation.pop('recipe')).id
+        result = getattr(cls, op)(**operation)
+        if isinstance(result, Recipe):
+            return cls.to_dict(result)
+        return result
+
+
+class RecipeEditSession():
+    """Buffers changes to one recipe and saves them in one transaction.
+
+    The menus edit values, a working copy of the recipe's fields with the
+    ingredient list parsed, and render from it, so an edit costs no query
+    however many are made. commit() writes every changed field with one
+    RecipeService.update. Each change can be undone, and discard() drops
+    them all.
+
+        session = RecipeEditSession(recipe)
+        session.set('prep_time', '5 mins')
+        session.update_ingredient(1, prep='sliced')
+        session.undo()
+        session.commit()
+
+    If the recipe was saved by someone else since the session began,
+    commit() keeps their changes to fields the session did not change
+    and applies the session's on top. It raises EditConflict if they
+    changed a field the session changed too, unless forced.
+
+    Parameters:
+        recipe - the Recipe to edit, as last read
+    """
+
+    # Times commit() re-reads the recipe after a conflict before giving up.
+    MAX_RETRIES = 3
+
+    def __init__(self, recipe):
+        self.recipe_id = recipe.id
+        self._begin(recipe)
+
+    def _begin(self, recipe):
+        self.version = recipe.version
+        self.original = self.values_of(recipe)
+        self.values = copy.deepcopy(self.original)
+        # (description, values before the change) pairs, latest last.
+        self.history = []
+
+    @staticmethod
+    def values_of(recipe):
+        values = {field: getattr(recipe, field) for field in RecipeService.FIELDS}
+        values['ingredient_list'] = json.loads(recipe.ingredient_list or '[]')
+        return values
+
+    @property
+    def recipe(self):
+        """An unsaved Recipe holding the working copy, for display."""
+        values = dict(self.values, ingredient_list=json.dumps(self.values['ingredient_list']))
+        return Recipe(id=self.recipe_id, version=self.version, **values)
+
+    def changes(self):
+        """Returns the fields that differ from the recipe as last read."""
+        return {field: value for field, value in self.values.items()
+                if value != self.original[field]}
+
+    @property
+    def changed(self):
+        return self.values != self.original
+
+    def _change(self, description):
+        self.history.append((description, copy.deepcopy(self.values)))
+
+    def set(self, field, value):
+        """Changes one of RecipeService.FIELDS other than ingredient_list."""
+        if field not in RecipeService.FIELDS or field == 'ingredient_list':
+            raise ValueError(f'unknown field {field!r}')
+        if field == 'name':
+            value = (value or '').strip()
+            if not value:
+                raise ValueError('name must not be empty')
+        elif field == 'servings':
+            value = RecipeService.check_servings(value)
+        self._change(f'{field.replace("_", " ")} to {value}')
+        self.values[field] = value
+
+    def add_ingredient(self, ingredient):
+        """Appends an ingredient dict."""
+        Recipe.validate_ingredient(ingredient)
+        self._change(f'add {ingredient["ingredient_name"]}')
+        self.values['ingredient_list'].append(dict(ingredient))
+
+    def delete_ingredient(self, position):
+        """Deletes the ingredient at a 1-based position and returns it."""
+        item = self._ingredient(position)
+        self._change(f'delete {item["ingredient_name"]}')
+        return self.values['ingredient_list'].pop(position - 1)
+
+    def update_ingredient(self, position, **changes):
+        """Changes keys of the ingredient at a 1-based position."""
+        item = self._ingredient(position)
+        Recipe.validate_ingredient(changes, partial=True)
+        if not changes:
+            raise ValueError('no ingredient changes given')
+        self._change(', '.join(f'{item["ingredient_name"]} {key} to {value}'
+                               for key, value in changes.items()))
+        item.update(changes)
+
+    def _ingredient(self, position):
+        RecipeService._check_position(position)
+        ingredients = self.values['ingredient_list']
+        if position > len(ingredients):
+            raise ValueError(f'no ingredient at position {position} (recipe has {len(ingredients)})')
+        return ingredients[position - 1]
+
+    def undo(self):
+        """Reverts the latest change and returns its description, or None
+        if there is nothing to undo."""
+        if not self.history:
+            return None
+        description, self.values = self.history.pop()
+        return description
+
+    def discard(self):
+        """Reverts every change since the session began or last committed."""
+        self.values = copy.deepcopy(self.original)
+        self.history = []
+
+    def commit(self, force=False):
+        """Saves the changes in one transaction. Returns the saved Recipe,
+        or None if nothing changed. The session then carries on from it.
+
+        Raises EditConflict if someone else has saved a change to a field
+        this session changed, unless force is true, and Recipe.DoesNotExist
+        if the recipe has been deleted.
+        """
+        changes = self.changes()
+        if not changes:
+            return None
+        for _ in range(self.MAX_RETRIES):
+            try:
+                recipe = RecipeService.update(
+                    self.recipe_id, expected_version=None if force else self.version,
+                    **changes)
+            except VersionConflict:
+                self._rebase(Recipe.get_by_id(self.recipe_id), changes)
+                continue
+            self._begin(recipe)
+            return recipe
+        raise VersionConflict(f'recipe {self.recipe_id} keeps changing; try again')
+
+    def _rebase(self, current, changes):
+        """Takes on the fields someone else saved, or raises EditConflict
+        if any of them is one the session changed."""
+        theirs = self.values_of(current)
+        clashes = [field for field in changes if theirs[field] != self.original[field]]
+        if clashes:
+            raise EditConflict(
+                f'{current.name} was changed by someone else since you began, '
+                f'in fields you changed too: '
+                f'{", ".join(field.replace("_", " ") for field in clashes)}', clashes)
+        for field, value in theirs.items():
+            if field not in changes:
+                self.values[field] = value
+        self.original = theirs
+        self.version = current.version
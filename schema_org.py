@@ -0,0 +1,261 @@
+"""Extracts schema.org Recipe data from HTML pages.
+
+Recipe sites describe their recipes for search engines either as JSON-LD
+(<script type="application/ld+json">) or as microdata (itemscope,
+itemtype and itemprop attributes). Both are read with one pass of the
+standard library's HTMLParser and turned into recipe dicts in the layout
+import_recipes.py reads:
+
+    >>> extract_recipes(html)
+    [{'name': 'Garlic Bread', 'ingredient_list': [{'ingredient_name': 'bread',
+      ...}], 'prep_time': '5 mins', 'cook_time': '3 mins',
+      'instructions': '...', 'servings': 4}]
+
+Ingredient lines are split into amount, units, name and prep with
+quantities.parse_ingredient_line. Nothing here touches the database, so
+pages can be parsed in worker processes.
+"""
+import html
+import json
+import re
+from html.parser import HTMLParser
+
+from quantities import parse_ingredient_line
+
+
+VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                       'link', 'meta', 'param', 'source', 'track', 'wbr'))
+# Tags that start a new line in an itemprop's text.
+BLOCK_TAGS = frozenset(('br', 'div', 'p', 'li', 'tr', 'dt', 'dd', 'h1', 'h2', 'h3', 'h4',
+                        'h5', 'h6', 'section', 'article', 'ul', 'ol', 'table'))
+# Open tags that a start tag closes, as in a list of <li> with no </li>.
+IMPLIED_END_TAGS = {
+    'li': ('li',), 'p': ('p',), 'dt': ('dt', 'dd'), 'dd': ('dt', 'dd'),
+    'tr': ('tr', 'td', 'th'), 'td': ('td', 'th'), 'th': ('td', 'th'), 'option': ('option',),
+}
+# Attributes that hold an itemprop's value instead of the element's text.
+VALUE_ATTRIBUTES = {'meta': 'content', 'link': 'href', 'a': 'href', 'img': 'src',
+                    'time': 'datetime', 'data': 'value', 'meter': 'value'}
+
+_DURATION_RE = re.compile(r'^P(?:(?P<days>\d+)D)?'
+                          r'(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+)S)?)?$',
+                          re.IGNORECASE)
+_JSON_LD_RE = re.compile(
+    r'<script\b[^>]*\btype\s*=\s*["\']?application/ld\+json["\']?[^>]*>(.*?)</script\s*>',
+    re.IGNORECASE | re.DOTALL)
+
+
+class RecipePageParser(HTMLParser):
+    """Collects the JSON-LD blocks and the microdata items of a page.
+
+    After feed(), json_ld holds the text of each JSON-LD script and items
+    holds each top-level microdata item as a dict with '@type' and a list
+    of values per property.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.json_ld = []
+        self.items = []
+        self._script = None
+        self._tags = []
+        # Open microdata items and itemprops being read, with the depth of
+        # the tag each belongs to.
+        self._scopes = []
+        self._props = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self._tags and self._tags[-1] in IMPLIED_END_TAGS.get(tag, ()):
+            self.handle_endtag(self._tags[-1])
+        if tag in BLOCK_TAGS:
+            for _, _, text in self._props:
+                text.append('\n')
+        if tag == 'script' and (attrs.get('type') or '').lower() == 'application/ld+json':
+            self._script = []
+        depth = len(self._tags)
+        prop = attrs.get('itemprop')
+        if 'itemscope' in attrs:
+            item = {'@type': attrs.get('itemtype') or ''}
+            if prop and self._scopes:
+                self._add_value(prop, item)
+            elif not self._scopes:
+                self.items.append(item)
+            self._scopes.append((depth, item))
+        elif prop and self._scopes:
+            attribute = VALUE_ATTRIBUTES.get(tag)
+            if attribute and attrs.get(attribute) is not None:
+                self._add_value(prop, attrs[attribute])
+            elif tag not in VOID_TAGS:
+                self._props.append((depth, prop, []))
+        if tag not in VOID_TAGS:
+            self._tags.append(tag)
+        elif 'itemscope' in attrs:
+            self._scopes.pop()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag == 'script' and self._script is not None:
+            self.json_ld.append(''.join(self._script))
+            self._script = None
+        if tag not in self._tags:
+            return
+        # Close any tags left open inside this one, as browsers do.
+        while self._tags:
+            depth = len(self._tags) - 1
+            open_tag = self._tags.pop()
+            while self._props and self._props[-1][0] == depth:
+                _, prop, text = self._props.pop()
+                lines = (' '.join(line.split()) for line in ''.join(text).split('\n'))
+                self._add_value(prop, '\n'.join(line for line in lines if line))
+            while self._scopes and self._scopes[-1][0] == depth:
+                self._scopes.pop()
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self._script is not None:
+            self._script.append(data)
+        for _, _, text in self._props:
+            text.append(data)
+
+    def _add_value(self, prop, value):
+        item = self._scopes[-1][1]
+        for name in prop.split():
+            item.setdefault(name, []).append(value)
+
+
+def _types(node):
+    types = node.get('@type') or []
+    types = [types] if isinstance(types, str) else types
+    return {str(t).rsplit('/', 1)[-1] for t in types}
+
+
+def _find_json_ld_recipes(node):
+    """Yields the Recipe objects in a decoded JSON-LD value."""
+    if isinstance(node, list):
+        for value in node:
+            yield from _find_json_ld_recipes(value)
+    elif isinstance(node, dict):
+        if 'Recipe' in _types(node):
+            yield node
+            return
+        for key in ('@graph', 'mainEntity', 'mainEntityOfPage', 'itemListElement', 'item'):
+            if key in node:
+                yield from _find_json_ld_recipes(node[key])
+
+
+def _find_microdata_recipes(items):
+    for item in items:
+        if 'Recipe' in _types(item):
+            yield item
+        for values in item.values():
+            if isinstance(values, list):
+                yield from _find_microdata_recipes(v for v in values if isinstance(v, dict))
+
+
+def _first(value):
+    """Returns the first value of a property that may be a list."""
+    while isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+def _text(value):
+    value = _first(value)
+    if isinstance(value, dict):
+        value = value.get('text') or value.get('name')
+        value = _first(value)
+    if value is None:
+        return ''
+    return ' '.join(html.unescape(str(value)).split())
+
+
+def _lines(value):
+    """Returns a property's values as a flat list of non-empty strings."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [_text(line) for line in value.splitlines() if line.strip()]
+    if isinstance(value, dict):
+        # HowToSection holds its steps in itemListElement.
+        if 'itemListElement' in value:
+            return _lines(value['itemListElement'])
+        text = _text(value)
+        return [text] if text else []
+    if isinstance(value, list):
+        return [line for v in value for line in _lines(v)]
+    return [_text(value)]
+
+
+def format_duration(value):
+    """Returns an ISO 8601 duration such as 'PT1H30M' as '1 hr 30 mins'.
+    Values that are not durations are returned as they are, or None.
+    """
+    value = _text(value)
+    match = _DURATION_RE.match(value)
+    if not value or match is None or not any(match.groupdict().values()):
+        return value or None
+    parts = match.groupdict()
+    minutes = (int(parts['days'] or 0) * 24 * 60 + int(parts['hours'] or 0) * 60 +
+               int(parts['minutes'] or 0) + round(int(parts['seconds'] or 0) / 60))
+    hours, minutes = divmod(minutes, 60)
+    words = []
+    if hours:
+        words.append(f'{hours} hr' + ('s' if hours > 1 else ''))
+    if minutes or not hours:
+        words.append(f'{minutes} min' + ('s' if minutes != 1 else ''))
+    return ' '.join(words)
+
+
+def parse_servings(value):
+    """Returns the number of servings in a recipeYield such as '4 servings',
+    or None if it does not give one."""
+    for line in _lines(value if isinstance(value, list) else [value]):
+        match = re.search(r'\d+', line)
+        if match and int(match.group()) > 0:
+            return int(match.group())
+    return None
+
+
+def to_recipe(node):
+    """Returns a JSON-LD or microdata Recipe as a recipe dict."""
+    ingredients = node.get('recipeIngredient') or node.get('ingredients')
+    return {
+        'name': _text(node.get('name')),
+        'ingredient_list': [parse_ingredient_line(line) for line in _lines(ingredients)],
+        'prep_time': format_duration(node.get('prepTime')),
+        'cook_time': format_duration(node.get('cookTime')),
+        'instructions': '\n'.join(_lines(node.get('recipeInstructions'))) or None,
+        'servings': parse_servings(node.get('recipeYield')),
+    }
+
+
+def _json_ld_recipes(blocks):
+    nodes = []
+    for block in blocks:
+        try:
+            nodes.extend(_find_json_ld_recipes(json.loads(block)))
+        except ValueError:
+            continue
+    return nodes
+
+
+def extract_recipes(page):
+    """Returns a recipe dict for each schema.org Recipe in an HTML page.
+    JSON-LD is used when a page has it, and microdata otherwise.
+    """
+    # Tokenizing a whole page with HTMLParser costs far more than finding
+    # its JSON-LD scripts with a regular expression, so pages are only
+    # parsed in full when they have no JSON-LD recipe.
+    nodes = _json_ld_recipes(match.group(1) for match in _JSON_LD_RE.finditer(page))
+    if not nodes and 'itemscope' in page:
+        parser = RecipePageParser()
+        parser.feed(page)
+        parser.close()
+        nodes = _json_ld_recipes(parser.json_ld) or list(_find_microdata_recipes(parser.items))
+    return [recipe for recipe in map(to_recipe, nodes) if recipe['name']]
@@ -0,0 +1,158 @@
+"""Full-text search indexes over the cookbook.
+
+RecipeSearch and IngredientSearch are FTS5 tables built with
+playhouse.sqlite_ext, which takes a while to import. recipes.py imports
+this module only where it searches or creates the tables, so runs that
+never search skip it.
+"""
+import re
+
+from playhouse.sqlite_ext import FTS5Model, SearchField
+
+from database import db
+from recipes import Recipe
+
+
+class RecipeSearch(FTS5Model):
+    """FTS5 index over recipe names, ingredient names and instructions.
+
+    Rows share their rowid with the recipes table and are kept in sync
+    by triggers on recipes, so every write path (including raw update
+    queries) updates the index. Ingredient names are pulled out of the
+    ingredient_list JSON inside the trigger with json_each.
+    """
+    name = SearchField()
+    ingredients = SearchField()
+    instructions = SearchField()
+
+    class Meta:
+        database = db
+        table_name = 'recipe_search'
+        options = {'prefix': '2 3', 'tokenize': 'porter unicode61'}
+
+    # bm25 weights for name, ingredients and instructions.
+    WEIGHTS = (10.0, 5.0, 1.0)
+
+    INGREDIENT_NAMES_SQL = (
+        "(SELECT group_concat(json_extract(value, '$.ingredient_name'), ' ') "
+        "FROM json_each({row}.ingredient_list))")
+
+    @classmethod
+    def _insert_row_sql(cls, row):
+        return (
+            'INSERT INTO recipe_search(rowid, name, ingredients, instructions) '
+            f'VALUES ({row}.id, {row}.name, '
+            f'{cls.INGREDIENT_NAMES_SQL.format(row=row)}, {row}.instructions);')
+
+    @classmethod
+    def create_triggers(cls):
+        """Creates the triggers that keep recipe_search in sync with recipes."""
+        triggers = (
+            'CREATE TRIGGER IF NOT EXISTS recipes_search_ai AFTER INSERT ON recipes '
+            f'BEGIN {cls._insert_row_sql("new")} END;',
+            'CREATE TRIGGER IF NOT EXISTS recipes_search_ad AFTER DELETE ON recipes '
+            'BEGIN DELETE FROM recipe_search WHERE rowid = old.id; END;',
+            'CREATE TRIGGER IF NOT EXISTS recipes_search_au '
+            'AFTER UPDATE OF name, ingredient_list, instructions ON recipes '
+            'BEGIN DELETE FROM recipe_search WHERE rowid = old.id; '
+            f'{cls._insert_row_sql("new")} END;',
+        )
+        for trigger in triggers:
+            db.execute_sql(trigger)
+
+    @classmethod
+    def rebuild_index(cls):
+        """Rebuilds the whole search index from the recipes table."""
+        with db.atomic():
+            db.execute_sql('DELETE FROM recipe_search;')
+            db.execute_sql(
+                'INSERT INTO recipe_search(rowid, name, ingredients, instructions) '
+                f'SELECT id, name, {cls.INGREDIENT_NAMES_SQL.format(row="recipes")}, '
+                'instructions FROM recipes;')
+            db.execute_sql(
+                "INSERT INTO recipe_search(recipe_search) VALUES ('optimize');")
+
+    @staticmethod
+    def to_match_expression(search_query):
+        """Turns user input into an FTS5 query matching every word as a prefix.
+        Returns None if the input has no searchable words.
+        """
+        words = re.findall(r'\w+', search_query.lower())
+        if not words:
+            return None
+        return ' '.join(f'"{word}"*' for word in words)
+
+    @classmethod
+    def search(cls, search_query, limit=20):
+        """Returns a query of recipe ids, names and bm25 scores, best first.
+
+        Every word in search_query must prefix-match a word in the
+        recipe name, ingredient names or instructions.
+        """
+        expression = cls.to_match_expression(search_query)
+        if expression is None:
+            return Recipe.select(Recipe.id, Recipe.name).where(False)
+        score = cls.bm25(*cls.WEIGHTS)
+        return (Recipe
+                .select(Recipe.id, Recipe.name, score.alias('score'))
+                .join(cls, on=(cls.rowid == Recipe.id))
+                .where(cls.match(expression))
+                .order_by(score)
+                .limit(limit))
+
+
+class IngredientSearch(FTS5Model):
+    """Trigram index over ingredient names, for substring searches.
+
+    An external content table: it stores only the index and reads names
+    from the ingredients table, sharing its rowids. Triggers on
+    ingredients keep it in sync. The trigram tokenizer indexes every
+    three character run of a name, so a query of three or more
+    characters matches anywhere in a name, across word boundaries too.
+    """
+    normalized_name = SearchField()
+
+    class Meta:
+        database = db
+        table_name = 'ingredient_search'
+        options = {'content': 'ingredients', 'content_rowid': 'id', 'tokenize': 'trigram'}
+
+    @staticmethod
+    def create_triggers():
+        """Creates the triggers that keep ingredient_search in sync with ingredients."""
+        insert = ('INSERT INTO ingredient_search(rowid, normalized_name) '
+                  'VALUES (new.id, new.normalized_name);')
+        delete = ('INSERT INTO ingredient_search(ingredient_search, rowid, normalized_name) '
+                  "VALUES ('delete', old.id, old.normalized_name);")
+        triggers = (
+            'CREATE TRIGGER IF NOT EXISTS ingredients_search_ai AFTER INSERT ON ingredients '
+            f'BEGIN {insert} END;',
+            'CREATE TRIGGER IF NOT EXISTS ingredients_search_ad AFTER DELETE ON ingredients '
+            f'BEGIN {delete} END;',
+            'CREATE TRIGGER IF NOT EXISTS ingredients_search_au '
+            'AFTER UPDATE OF normalized_name ON ingredients '
+            f'BEGIN {delete} {insert} END;',
+        )
+        for trigger in triggers:
+            db.execute_sql(trigger)
+
+    @staticmethod
+    def rebuild_index():
+        """Rebuilds the whole index from the ingredients table."""
+        with db.atomic():
+            db.execute_sql(
+                "INSERT INTO ingredient_search(ingredient_search) VALUES ('rebuild');")
+            db.execute_sql(
+                "INSERT INTO ingredient_search(ingredient_search) VALUES ('optimize');")
+
+    @staticmethod
+    def to_match_expression(normalized):
+        """Returns an FTS5 phrase matching names containing normalized."""
+        return '"{}"'.format(normalized.replace('"', '""'))
+
+    @classmethod
+    def ingredient_ids(cls, normalized):
+        """Returns a subquery of the ids of ingredients whose normalized
+        name contains normalized. Shorter queries than
+        Ingredient.SUBSTRING_MIN_LENGTH match nothing."""
+        return cls.select(cls.rowid).where(cls.match(cls.to_match_expression(normalized)))
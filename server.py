@@ -0,0 +1,325 @@
+"""HTTP/JSON service for the cookbook, built on asyncio and RecipeService.
+
+Uses only the standard library, so it runs locally with nothing else to
+install. The event loop only parses requests and writes responses; every
+peewee query runs on a bounded pool of reader threads, and writes run on
+a single writer thread, so the loop never blocks on SQLite and writers
+never wait on each other for the database lock. Identical searches that
+arrive while one is already running share its result instead of running
+again.
+
+Usage:
+    python server.py --db recipes.db --port 8080 --workers 8
+
+Routes:
+    GET    /recipes?sort=name&after=ID&limit=N     list recipe ids and names (default 100)
+    GET    /recipes/search?q=garlic&full_text=1    search recipes (limit=N, default 100)
+    GET    /recipes/ID                             show one recipe
+    POST   /recipes                                add a recipe from a JSON body
+    PATCH  /recipes/ID                             update fields from a JSON body
+    DELETE /recipes/ID?expected_version=N          delete a recipe
+    GET    /changes?since=SEQ&limit=N              recipe changes after a seq (default 100)
+    GET    /stats                                  request and coalescing counts
+
+Bodies take the same fields as RecipeService.add and update. An
+"expected_version" field (or query parameter for DELETE) makes a write
+fail with 409 if the recipe has changed since that version was read.
+/changes answers 410 when the changes after since have been compacted
+away, and the copy being kept in sync has to be made again.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+from database import configure_database
+from recipes import *
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class CookbookServer():
+    """Serves RecipeService over HTTP/1.1 with keep-alive.
+
+    Parameters:
+        workers - number of reader threads, and the most database calls
+            queued or running at once
+    """
+
+    MAX_HEADER_BYTES = 64 * 1024
+    MAX_BODY_BYTES = 1024 * 1024
+
+    ROUTES = (
+        ('GET', re.compile(r'/recipes'), 'list_recipes'),
+        ('GET', re.compile(r'/recipes/search'), 'search'),
+        ('GET', re.compile(r'/recipes/(\d+)'), 'get'),
+        ('POST', re.compile(r'/recipes'), 'create'),
+        ('PATCH', re.compile(r'/recipes/(\d+)'), 'update'),
+        ('DELETE', re.compile(r'/recipes/(\d+)'), 'delete'),
+        ('GET', re.compile(r'/changes'), 'changes'),
+        ('GET', re.compile(r'/stats'), 'stats'),
+    )
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.readers = ThreadPoolExecutor(workers, thread_name_prefix='cookbook-read')
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='cookbook-write')
+        self.slots = None
+        self.in_flight = {}
+        self.counts = {'requests': 0, 'searches': 0, 'coalesced': 0, 'errors': 0}
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        self.slots = asyncio.Semaphore(self.workers)
+        server = await asyncio.start_server(self.handle_connection, host, port,
+                                            limit=self.MAX_HEADER_BYTES)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.readers.shutdown()
+        self.writer.shutdown()
+
+    @staticmethod
+    def _call(function, args, kwargs):
+        # Runs on a worker thread. The connection goes back to the pool
+        # after each call.
+        with db.connection_context():
+            return function(*args, **kwargs)
+
+    async def run_db(self, function, *args, write=False, kwargs=None):
+        """Runs function on a reader thread, or the writer thread, and
+        returns its result. Waits for a free slot first, so requests queue
+        on the event loop rather than in the executors."""
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.writer if write else self.readers,
+                functools.partial(self._call, function, args, kwargs or {}))
+
+    async def coalesced(self, key, function, *args):
+        """Like run_db, but concurrent calls with the same key share one call."""
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.counts['coalesced'] += 1
+            return await asyncio.shield(future)
+        future = asyncio.ensure_future(self.run_db(function, *args))
+        self.in_flight[key] = future
+        future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, path, query, headers, body = request
+                status, result = await self.dispatch(method, path, query, body)
+                keep_alive = headers['connection'] == 'keep-alive'
+                writer.write(self.response(status, result, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HttpError as e:
+            writer.write(self.response(e.status, {'error': str(e)}, False))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """Returns (method, path, query, headers, body), or None when the
+        client has closed the connection."""
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'malformed request line')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        # HTTP/1.1 connections stay open unless the client says otherwise,
+        # and HTTP/1.0 ones close unless it asks to keep them.
+        connection = headers.get('connection', '').lower()
+        if connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive'):
+            headers['connection'] = 'keep-alive'
+        else:
+            headers['connection'] = 'close'
+        length = headers.get('content-length') or '0'
+        if not length.isdigit():
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'malformed Content-Length')
+        length = int(length)
+        if length > self.MAX_BODY_BYTES:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'request body too large')
+        body = await reader.readexactly(length) if length else b''
+        url = urlsplit(target)
+        path = url.path.rstrip('/') or '/'
+        return method.upper(), path, dict(parse_qsl(url.query)), headers, body
+
+    @staticmethod
+    def response(status, result, keep_alive=True):
+        status = HTTPStatus(status)
+        body = b'' if result is None else json.dumps(result, default=str).encode()
+        head = (f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+        return head.encode() + body
+
+    async def dispatch(self, method, path, query, body):
+        """Returns (status, result) for one request."""
+        self.counts['requests'] += 1
+        allowed = False
+        for route_method, pattern, handler in self.ROUTES:
+            match = pattern.fullmatch(path)
+            if match is None:
+                continue
+            allowed = True
+            if route_method == method:
+                break
+        else:
+            self.counts['errors'] += 1
+            if allowed:
+                return HTTPStatus.METHOD_NOT_ALLOWED, {'error': f'{method} not allowed on {path}'}
+            return HTTPStatus.NOT_FOUND, {'error': f'no route for {path}'}
+        try:
+            return await getattr(self, handler)(query, body, *match.groups())
+        except HttpError as e:
+            error = e
+        except DoesNotExist as e:
+            error = HttpError(HTTPStatus.NOT_FOUND, e)
+        except (VersionConflict, IntegrityError) as e:
+            error = HttpError(HTTPStatus.CONFLICT, e)
+        except ChangesCompacted as e:
+            error = HttpError(HTTPStatus.GONE, e)
+        except ValueError as e:
+            error = HttpError(HTTPStatus.BAD_REQUEST, e)
+        except Exception:
+            traceback.print_exc()
+            error = HttpError(HTTPStatus.INTERNAL_SERVER_ERROR, 'internal error')
+        self.counts['errors'] += 1
+        return error.status, {'error': str(error)}
+
+    @staticmethod
+    def read_json(body):
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'body is not valid JSON')
+        if not isinstance(data, dict):
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'body must be a JSON object')
+        return data
+
+    @classmethod
+    def read_fields(cls, body, *extra):
+        """Returns the JSON body, checking it only has recipe fields and extra."""
+        fields = cls.read_json(body)
+        unknown = set(fields) - set(RecipeService.FIELDS) - set(extra)
+        if unknown:
+            raise ValueError(f'unknown fields: {", ".join(sorted(unknown))}')
+        return fields
+
+    @staticmethod
+    def int_param(query, name, default=None):
+        value = query.get(name)
+        if value is None or value == '':
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f'{name} must be a whole number')
+
+    async def list_recipes(self, query, body):
+        recipes = await self.run_db(
+            RecipeService.list_recipes, query.get('sort', 'id'),
+            query.get('descending', '') not in ('', '0', 'false'),
+            self.int_param(query, 'after'), self.int_param(query, 'limit', 100))
+        return HTTPStatus.OK, recipes
+
+    async def search(self, query, body):
+        search_query = query.get('q', '').strip()
+        if not search_query:
+            raise HttpError(HTTPStatus.BAD_REQUEST, 'q must not be empty')
+        self.counts['searches'] += 1
+        limit = self.int_param(query, 'limit', 100)
+        if query.get('full_text', '') not in ('', '0', 'false'):
+            result = await self.coalesced(('full_text', search_query, limit),
+                                          RecipeService.full_text_search, search_query, limit)
+        else:
+            result = await self.coalesced(('search', search_query, limit),
+                                          RecipeService.search, search_query, limit)
+        return HTTPStatus.OK, result
+
+    async def get(self, query, body, recipe_id):
+        recipe = await self.run_db(Recipe.get_or_none, Recipe.id == int(recipe_id))
+        if recipe is None:
+            raise Recipe.DoesNotExist(f'no recipe with id {recipe_id}')
+        return HTTPStatus.OK, RecipeService.to_dict(recipe)
+
+    async def create(self, query, body):
+        fields = self.read_fields(body)
+        recipe = await self.run_db(RecipeService.add, write=True, kwargs=fields)
+        return HTTPStatus.CREATED, RecipeService.to_dict(recipe)
+
+    async def update(self, query, body, recipe_id):
+        fields = self.read_fields(body, 'expected_version')
+        recipe = await self.run_db(RecipeService.update, int(recipe_id), write=True,
+                                   kwargs=fields)
+        return HTTPStatus.OK, RecipeService.to_dict(recipe)
+
+    async def delete(self, query, body, recipe_id):
+        await self.run_db(RecipeService.delete, int(recipe_id),
+                          self.int_param(query, 'expected_version'), write=True)
+        return HTTPStatus.NO_CONTENT, None
+
+    async def changes(self, query, body):
+        def read_changes(since, limit):
+            return {'last_seq': RecipeChange.last_seq(),
+                    'changes': list(RecipeService.changes_since(since, limit))}
+        result = await self.run_db(read_changes, self.int_param(query, 'since', 0),
+                                   self.int_param(query, 'limit', 100))
+        return HTTPStatus.OK, result
+
+    async def stats(self, query, body):
+        return HTTPStatus.OK, dict(self.counts, workers=self.workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the cookbook over HTTP.')
+    parser.add_argument('--db', help='database file (default: $COOKBOOK_DB or recipes.db)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='database reader threads (default: 8)')
+    args = parser.parse_args()
+
+    # One pooled connection per reader thread, plus the writer's.
+    configure_database(args.db, pooled=True, max_connections=args.workers + 1)
+    Recipe.initialize()
+    db.close()
+    server = CookbookServer(args.workers)
+    print(f'Serving on http://{args.host}:{args.port}')
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,438 @@
+"""Cookbook split across several SQLite files.
+
+A ShardedCookbook keeps its recipes in N shard files, each a complete
+cookbook database with the usual tables, indexes and triggers. Recipe
+id % N names the shard a recipe is in: a new recipe is given the next
+free id in its shard's class, so ids stay unique across shards and a
+recipe is found from its id alone. New recipes go to the shard named by
+a hash of their name, which spreads them evenly.
+
+Every shard has one thread of its own that runs all the work on it, so
+writes to different shards run at the same time, each holding only its
+own file's write lock, while writes to one shard queue up in order.
+Searches, listings and exports ask every shard at once and merge what
+they return:
+
+    with ShardedCookbook(['cookbook-0.db', 'cookbook-1.db']) as cookbook:
+        recipe_id = cookbook.add('garlic bread', ingredients)
+        cookbook.search('garl', limit=20)
+        cookbook.list_recipes('name', limit=20)
+        cookbook.export(sys.stdout)
+
+Names are unique within a shard by its index, and a name is looked for
+in the other shards before a recipe is added or renamed. Adds and
+renames to a name hold the lock of the shard the name hashes to while
+they check and write, so two writers in one process cannot both find
+the name free. Writers in other processes are not covered.
+
+The model listeners, recipe cache, snapshot and indexes built in memory
+by recipes.py follow the single database db points at, not the shards.
+
+split() copies recipes into a new set of shards, from one cookbook file
+or from the shards of another set, so it both migrates a cookbook to
+shards and changes their number:
+
+    python shards.py --from recipes.db --to cookbook-0.db cookbook-1.db
+"""
+import argparse
+import contextlib
+import csv
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+from database import make_database
+from export_recipes import CSV_FIELDS, csv_rows, filtered_recipes, iter_pages, jsonl_lines
+from recipes import *
+from search import RecipeSearch
+
+
+class ShardedCookbook():
+    """Recipes split across shard files by id.
+
+    Parameters:
+        paths - shard files, created if they do not exist. A recipe is in
+            shard id % len(paths), so the files must always be given in
+            the same order. Use split() to change their number.
+        pragmas - pragmas for the shard connections, see make_database
+    """
+
+    def __init__(self, paths, pragmas=None):
+        if not paths:
+            raise ValueError('a sharded cookbook needs at least one shard')
+        self.paths = list(paths)
+        self.shards = [make_database(path, pragmas) for path in self.paths]
+        for shard in self.shards:
+            initialize_shard(shard)
+        self.executors = [ThreadPoolExecutor(1, thread_name_prefix=f'shard-{index}')
+                          for index in range(len(self.shards))]
+        # Held while a name hashing to the shard is checked and written.
+        self.name_locks = [threading.Lock() for _ in self.shards]
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Waits for work in progress and closes the shard connections."""
+        self.scatter(lambda shard: shard.close())
+        for executor in self.executors:
+            executor.shutdown()
+
+    def shard_of(self, recipe_id):
+        """Returns the index of the shard a recipe id is in."""
+        return recipe_id % len(self.shards)
+
+    def shard_for_name(self, name):
+        """Returns the index of the shard a new recipe named name goes to."""
+        return zlib.crc32(name.encode('utf-8')) % len(self.shards)
+
+    def run(self, index, function):
+        """Runs function(shard database) in the thread of one shard and
+        returns its result."""
+        return self.executors[index].submit(function, self.shards[index]).result()
+
+    def scatter(self, function, indexes=None):
+        """Runs function(shard database) on every shard, or those in
+        indexes, at the same time. Returns the results in shard order."""
+        if indexes is None:
+            indexes = range(len(self.shards))
+        futures = [self.executors[index].submit(function, self.shards[index])
+                   for index in indexes]
+        return [future.result() for future in futures]
+
+    def count(self):
+        """Returns the number of recipes in each shard."""
+        return self.scatter(lambda shard: Recipe.select().count(shard))
+
+    def get(self, recipe_id):
+        """Returns a recipe as a dict, as RecipeService.to_dict does."""
+        return self.run(self.shard_of(recipe_id), lambda shard: RecipeService.to_dict(
+            Recipe.select().where(Recipe.id == recipe_id).get(shard)))
+
+    def search(self, search_query, limit=None):
+        """Returns the id and name of recipes with an ingredient containing
+        search_query, in id order, as RecipeService.search does."""
+        def search_shard(shard):
+            query = Ingredient.search(search_query)
+            if limit is not None:
+                query = query.limit(limit)
+            return list(query.bind(shard).dicts())
+        merged = heapq.merge(*self.scatter(search_shard), key=itemgetter('id'))
+        return list(itertools.islice(merged, limit))
+
+    def full_text_search(self, search_query, limit=20):
+        """Returns the id, name and score of the best matching recipes.
+        Each shard scores its recipes against its own word counts, which
+        are alike once shards hold a few thousand recipes each."""
+        results = self.scatter(
+            lambda shard: list(RecipeSearch.search(search_query, limit).bind(shard).dicts()))
+        merged = heapq.merge(*results, key=itemgetter('score'))
+        return list(itertools.islice(merged, limit))
+
+    def list_recipes(self, sort='id', descending=False, after=None, limit=None):
+        """Returns a page of recipes, taking the same arguments and
+        returning the same dicts as RecipeService.list_recipes."""
+        field = RecipeService._sort_field(sort)
+        key = None
+        if after is not None:
+            last = self.run(self.shard_of(after), lambda shard: Recipe.select(field).where(
+                Recipe.id == after).scalar(shard))
+            if last is None:
+                raise Recipe.DoesNotExist(f'no recipe with id {after!r}')
+            key = (last, after)
+        pages = self.scatter(lambda shard: list(RecipeService._page_query(
+            sort, descending, key, limit).bind(shard).dicts()))
+        merged = heapq.merge(*pages, key=lambda row: (row[sort], row['id']),
+                             reverse=descending)
+        return list(itertools.islice(merged, limit))
+
+    def merged_pages(self, query, page_size=1000):
+        """Yields the rows of a query run on every shard, in id order, a
+        page at a time. query must select Recipe.id first.
+
+        Each shard reads its next page while the pages already read are
+        merged. Rows are passed on once no shard can still return a
+        smaller id, so pages vary in size.
+        """
+        count = len(self.shards)
+        sources = [iter_pages(query.clone().bind(shard), page_size) for shard in self.shards]
+        pending = [self.executors[index].submit(next, sources[index], None)
+                   for index in range(count)]
+        buffers = [deque() for _ in range(count)]
+        done = [False] * count
+        while True:
+            for index in range(count):
+                if buffers[index] or done[index]:
+                    continue
+                page = pending[index].result()
+                if page is None:
+                    done[index] = True
+                else:
+                    buffers[index].extend(page)
+                    pending[index] = self.executors[index].submit(next, sources[index], None)
+            # A shard with more to read can return any id above its last
+            # buffered one, so only rows up to the lowest of those are final.
+            cut = min((buffers[index][-1][0] for index in range(count) if not done[index]),
+                      default=None)
+            ready = []
+            for buffer in buffers:
+                rows = []
+                while buffer and (cut is None or buffer[0][0] <= cut):
+                    rows.append(buffer.popleft())
+                ready.append(rows)
+            page = list(heapq.merge(*ready, key=itemgetter(0)))
+            if page:
+                yield page
+            elif all(done):
+                return
+
+    def export(self, out, file_format='jsonl', page_size=1000, ingredient=None, search=None):
+        """Writes recipes from every shard to an open text stream in id
+        order and returns how many were written. Takes the arguments of
+        export_recipes.export_recipes."""
+        count = 0
+        if file_format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(CSV_FIELDS)
+        for page in self.merged_pages(filtered_recipes(ingredient, search), page_size):
+            if file_format == 'csv':
+                writer.writerows(csv_rows(page))
+            else:
+                out.writelines(jsonl_lines(page))
+            count += len(page)
+        return count
+
+    def check_names(self, names, shard_index):
+        """Raises IntegrityError if a recipe in a shard other than
+        shard_index has one of names. The shard's own unique index
+        catches names that are already in it."""
+        names = list(names)
+        others = [index for index in range(len(self.shards)) if index != shard_index]
+        found = self.scatter(lambda shard: list(Recipe.select(Recipe.name).where(
+            Recipe.name.in_(names)).tuples().execute(shard)), others)
+        for index, rows in zip(others, found):
+            if rows:
+                raise IntegrityError(
+                    f'UNIQUE constraint failed: recipes.name ({rows[0][0]!r} is in shard {index})')
+
+    @staticmethod
+    def next_id(shard, index, count):
+        """Returns the next free id in a shard, the smallest id above its
+        largest whose remainder by count is index."""
+        largest = Recipe.select(fn.max(Recipe.id)).scalar(shard) or 0
+        return largest + ((index - largest) % count or count)
+
+    def add(self, name, ingredient_list=(), prep_time=None, cook_time=None, instructions=None,
+            servings=None):
+        """Creates a recipe and returns its id. Takes the arguments of
+        RecipeService.add."""
+        values, ingredient_list = RecipeService._new_values(
+            name, ingredient_list, prep_time, cook_time, instructions, servings)
+        index = self.shard_for_name(values['name'])
+
+        def add_to_shard(shard):
+            # IMMEDIATE takes the write lock before reading the largest id,
+            # so two writers cannot both read it and pick the same next id.
+            with shard.atomic('IMMEDIATE'):
+                recipe_id = self.next_id(shard, index, len(self.shards))
+                Recipe.insert(id=recipe_id, **values).execute(shard)
+                Ingredient.insert_rows(Ingredient.rows_for(recipe_id, ingredient_list), shard)
+            return recipe_id
+        with self.name_locks[index]:
+            self.check_names([values['name']], index)
+            return self.run(index, add_to_shard)
+
+    def add_many(self, recipes, batch_size=500):
+        """Creates recipes from an iterable of dicts of RecipeService.add
+        arguments and returns how many were created.
+
+        Takes batch_size recipes per shard at a time, and writes each
+        shard's share of them in one transaction, all shards at once.
+        Recipes whose name is already used are skipped. Holds every
+        shard's name lock while a block is written.
+        """
+        count = len(self.shards)
+        recipes = iter(recipes)
+        created = 0
+        while True:
+            block = list(itertools.islice(recipes, batch_size * count))
+            if not block:
+                return created
+            batches = [{} for _ in range(count)]
+            for recipe in block:
+                values, ingredient_list = RecipeService._new_values(**recipe)
+                batch = batches[self.shard_for_name(values['name'])]
+                batch.setdefault(values['name'], (values, ingredient_list))
+
+            def add_to_shard(shard):
+                index = self.shards.index(shard)
+                batch = [recipe for name, recipe in batches[index].items() if name not in used]
+                if not batch:
+                    return 0
+                with shard.atomic('IMMEDIATE'):
+                    first_id = self.next_id(shard, index, count)
+                    ids = range(first_id, first_id + len(batch) * count, count)
+                    Recipe.insert_many([dict(values, id=recipe_id) for recipe_id, (values, _)
+                                        in zip(ids, batch)]).execute(shard)
+                    Ingredient.insert_rows((row for recipe_id, (_, ingredient_list)
+                                            in zip(ids, batch)
+                                            for row in Ingredient.rows_for(
+                                                recipe_id, ingredient_list)), shard)
+                return len(batch)
+            with contextlib.ExitStack() as stack:
+                for lock in self.name_locks:
+                    stack.enter_context(lock)
+                used = self.scatter(lambda shard: set(name for name, in Recipe.select(
+                    Recipe.name).where(Recipe.name.in_([
+                        name for batch in batches for name in batch])).tuples().execute(shard)))
+                used = set().union(*used)
+                created += sum(self.scatter(add_to_shard))
+
+    def update(self, recipe_id, expected_version=None, **fields):
+        """Updates the given fields of a recipe and returns it as a dict.
+        Takes the arguments of RecipeService.update and raises the same
+        errors.
+
+        A recipe stays in its shard when renamed, so the new name is not
+        caught by the unique index of the shard it hashes to. A rename
+        holds that shard's name lock instead, which adds and other renames
+        to the same name wait for, while it checks the other shards and
+        writes.
+        """
+        values, ingredient_list = RecipeService._update_values(fields)
+        index = self.shard_of(recipe_id)
+
+        def update_in_shard(shard):
+            with shard.atomic():
+                RecipeService._write(recipe_id, expected_version, database=shard, **values)
+                if ingredient_list is not None:
+                    Ingredient.delete().where(Ingredient.recipe == recipe_id).execute(shard)
+                    Ingredient.insert_rows(Ingredient.rows_for(recipe_id, ingredient_list),
+                                           shard)
+                return RecipeService.to_dict(
+                    Recipe.select().where(Recipe.id == recipe_id).get(shard))
+        if 'name' not in values:
+            return self.run(index, update_in_shard)
+        with self.name_locks[self.shard_for_name(values['name'])]:
+            self.check_names([values['name']], index)
+            return self.run(index, update_in_shard)
+
+    def delete(self, recipe_id, expected_version=None):
+        """Deletes a recipe and its ingredients."""
+        def delete_from_shard(shard):
+            query = Recipe.delete().where(Recipe.id == recipe_id)
+            if expected_version is not None:
+                query = query.where(Recipe.version == expected_version)
+            with shard.atomic():
+                if not query.execute(shard):
+                    RecipeService._raise_not_written(recipe_id, expected_version,
+                                                     database=shard)
+                Ingredient.delete().where(Ingredient.recipe == recipe_id).execute(shard)
+        self.run(self.shard_of(recipe_id), delete_from_shard)
+
+
+def initialize_shard(shard):
+    """Runs Recipe.initialize on a shard database. Points db at the shard
+    while it runs, so nothing else may use db meanwhile."""
+    previous = db.obj
+    db.initialize(shard)
+    try:
+        Recipe.initialize()
+    finally:
+        shard.close()
+        db.initialize(previous)
+
+
+# Tables split() copies, with the column holding the recipe id. The
+# search indexes and change log are filled by the triggers on recipes
+# and ingredients.
+COPIED_TABLES = (
+    (Recipe, 'id'),
+    (Ingredient, 'recipe_id'),
+    (RecipeSignature, 'recipe_id'),
+    (RecipeBand, 'recipe_id'),
+)
+
+
+def split(sources, targets, pragmas=None):
+    """Copies every recipe in sources, cookbook files or the shards of a
+    ShardedCookbook, into new shard files, recipe id % len(targets)
+    deciding the shard. Ids are kept, so sources must not share any.
+    Returns the number of recipes copied into each target.
+
+    Sources are upgraded to the current schema first if they need it.
+    Targets must not exist yet. They are filled at the same time, one
+    thread each.
+    """
+    for path in targets:
+        if os.path.exists(path):
+            raise ValueError(f'{path} already exists')
+    for path in sources:
+        if not os.path.exists(path):
+            raise ValueError(f'{path} does not exist')
+        initialize_shard(make_database(path, pragmas))
+    shards = [make_database(path, pragmas) for path in targets]
+    for shard in shards:
+        initialize_shard(shard)
+
+    def fill(index):
+        shard = shards[index]
+        try:
+            for path in sources:
+                shard.execute_sql('ATTACH DATABASE ? AS source', (path,))
+                try:
+                    with shard.atomic():
+                        for model, key in COPIED_TABLES:
+                            columns = ', '.join(
+                                f'"{field.column_name}"' for field in model._meta.sorted_fields
+                                if model is not Ingredient or field is not Ingredient.id)
+                            table = model._meta.table_name
+                            shard.execute_sql(
+                                f'INSERT INTO "{table}" ({columns}) SELECT {columns} '
+                                f'FROM source."{table}" WHERE {key} % ? = ?',
+                                (len(shards), index))
+                finally:
+                    shard.execute_sql('DETACH DATABASE source')
+            shard.execute_sql("INSERT INTO recipe_search(recipe_search) VALUES ('optimize')")
+            shard.execute_sql(
+                "INSERT INTO ingredient_search(ingredient_search) VALUES ('optimize')")
+            return Recipe.select().count(shard)
+        finally:
+            shard.close()
+
+    with ThreadPoolExecutor(len(shards)) as executor:
+        return list(executor.map(fill, range(len(shards))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Copy a cookbook into shard files, or one set of shards into another.')
+    parser.add_argument('--from', dest='sources', nargs='+', required=True,
+                        help='cookbook file, or every shard of a sharded cookbook')
+    parser.add_argument('--to', dest='targets', nargs='+', required=True,
+                        help='new shard files, in shard order')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        counts = split(args.sources, args.targets)
+    except ValueError as e:
+        parser.error(str(e))
+    print(json.dumps({
+        'shards': dict(zip(args.targets, counts)),
+        'recipes': sum(counts),
+        'seconds': round(time.perf_counter() - start, 3),
+    }, indent=2))
@@ -0,0 +1,159 @@
+"""Compact, read-only copy of the cookbook for read-mostly workloads.
+
+A RecipeSnapshot keeps each recipe's id, name, creation date and
+ingredients in a slotted RecipeRecord, with every ingredient stored as a
+tuple. Strings are interned in one pool, so the few thousand distinct
+ingredient names, amounts, units and preps of a cookbook are held once
+however many recipes use them. Normalized ingredient names are kept in
+a sorted list with the recipes using each, for ingredient searches.
+
+    snapshot = RecipeSnapshot()
+    snapshot.load(recipes, seq)
+    snapshot.search('garl')
+    snapshot.page('name', descending=False, key=None, limit=20)
+
+Listings, ingredient searches and ingredient tables are then answered
+without a query, a model instance or a JSON parse. The snapshot does not
+read the database itself. Whoever owns it replays changes with put() and
+remove() and records the change sequence number they are current to in
+seq (see Recipe.fresh_snapshot in recipes.py).
+"""
+import bisect
+
+
+class RecipeRecord():
+    """One recipe in a snapshot. ingredients is a tuple of
+    (name, normalized name, amount, units, prep, optional) tuples."""
+
+    __slots__ = ('id', 'name', 'date_created', 'ingredients')
+
+    def __init__(self, recipe_id, name, date_created, ingredients):
+        self.id = recipe_id
+        self.name = name
+        self.date_created = date_created
+        self.ingredients = ingredients
+
+
+class RecipeSnapshot():
+    """Recipes by id, with an ingredient name index and sort orders.
+
+    Sort orders for page() are built on first use and dropped whenever
+    a recipe is put or removed, so a burst of changes costs one sort.
+    The string pool only grows; load() again to compact it.
+    """
+
+    SORTS = ('id', 'name', 'date_created')
+
+    def __init__(self):
+        self.records = {}
+        self.postings = {}
+        self.ingredient_names = []
+        self.strings = {}
+        self.orders = {}
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, recipe_id):
+        return recipe_id in self.records
+
+    def get(self, recipe_id):
+        return self.records.get(recipe_id)
+
+    def load(self, recipes, seq=0):
+        """Replaces the contents with recipes, an iterable of
+        (id, name, date_created, ingredients) tuples as put() takes them."""
+        self.__init__()
+        for recipe_id, name, date_created, ingredients in recipes:
+            self._add(recipe_id, name, date_created, ingredients)
+        self.ingredient_names = sorted(self.postings)
+        self.seq = seq
+
+    def put(self, recipe_id, name, date_created, ingredients):
+        """Adds a recipe, replacing it if it is already present."""
+        self.remove(recipe_id)
+        for normalized in self._add(recipe_id, name, date_created, ingredients):
+            bisect.insort(self.ingredient_names, normalized)
+        self.orders.clear()
+
+    def remove(self, recipe_id):
+        """Drops a recipe if it is present."""
+        record = self.records.pop(recipe_id, None)
+        if record is None:
+            return
+        for ingredient in record.ingredients:
+            normalized = ingredient[1]
+            recipe_ids = self.postings.get(normalized)
+            if recipe_ids is None:
+                continue
+            recipe_ids.discard(recipe_id)
+            if not recipe_ids:
+                del self.postings[normalized]
+                del self.ingredient_names[bisect.bisect_left(self.ingredient_names, normalized)]
+        self.orders.clear()
+
+    def _add(self, recipe_id, name, date_created, ingredients):
+        """Stores a record and indexes its ingredients. Returns the
+        normalized names that were not in the index before."""
+        strings = self.strings
+        ingredients = tuple(
+            tuple(strings.setdefault(value, value) if isinstance(value, str) else value
+                  for value in ingredient)
+            for ingredient in ingredients)
+        self.records[recipe_id] = RecipeRecord(recipe_id, name, date_created, ingredients)
+        new_names = []
+        for ingredient in ingredients:
+            recipe_ids = self.postings.get(ingredient[1])
+            if recipe_ids is None:
+                recipe_ids = self.postings[ingredient[1]] = set()
+                new_names.append(ingredient[1])
+            recipe_ids.add(recipe_id)
+        return new_names
+
+    def search(self, query, limit=None, substring=True):
+        """Returns the id and name of recipes with an ingredient whose
+        normalized name contains query, in id order. With substring
+        False, names must start with query instead."""
+        names = self.ingredient_names
+        recipe_ids = set()
+        if substring:
+            for name in names:
+                if query in name:
+                    recipe_ids.update(self.postings[name])
+        else:
+            for i in range(bisect.bisect_left(names, query), len(names)):
+                if not names[i].startswith(query):
+                    break
+                recipe_ids.update(self.postings[names[i]])
+        recipe_ids = sorted(recipe_ids)[:limit]
+        return [{'id': recipe_id, 'name': self.records[recipe_id].name}
+                for recipe_id in recipe_ids]
+
+    def sort_key(self, recipe_id, sort):
+        """Returns the (sort value, id) key of a recipe, or None if it is
+        not in the snapshot."""
+        record = self.records.get(recipe_id)
+        if record is None:
+            return None
+        return (getattr(record, sort), recipe_id)
+
+    def page(self, sort, descending, key, limit):
+        """Returns the recipes after key, a (sort value, id) pair, in the
+        order and layout RecipeService.list_recipes uses."""
+        order = self.orders.get(sort)
+        if order is None:
+            order = self.orders[sort] = sorted(
+                (getattr(record, sort), record.id) for record in self.records.values())
+        if descending:
+            end = len(order) if key is None else bisect.bisect_left(order, key)
+            start = 0 if limit is None else max(end - limit, 0)
+            keys = reversed(order[start:end])
+        else:
+            start = 0 if key is None else bisect.bisect_right(order, key)
+            keys = order[start:None if limit is None else start + limit]
+        if sort == 'date_created':
+            return [{'id': recipe_id, 'name': self.records[recipe_id].name,
+                     'date_created': value} for value, recipe_id in keys]
+        return [{'id': recipe_id, 'name': self.records[recipe_id].name}
+                for _, recipe_id in keys]
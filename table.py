@@ -0,0 +1,171 @@
+"""Renders rows of values as a text table, Markdown, CSV or JSON.
+
+Rows are tuples with one value per column. Column widths are measured in
+a single pass over the rows and a format template is built once for the
+layout, so rendering is linear in the number of rows. Output goes
+straight to a stream with writelines.
+"""
+import json
+from collections import namedtuple
+from functools import lru_cache
+
+
+# key names the value in JSON output, header is shown above it, align is
+# a format alignment ('<', '^' or '>') and to_text turns a value into the
+# text shown in text, Markdown and CSV output.
+TableColumn = namedtuple('TableColumn', 'key header align to_text', defaults=('^', str))
+
+
+# csv, shutil and textwrap are imported where they are used, since most
+# runs never need them and they add to the start up time of every run.
+
+
+def terminal_width(fallback=100):
+    import shutil
+    return shutil.get_terminal_size((fallback, 24)).columns
+
+
+@lru_cache(maxsize=256)
+def compile_layout(columns, widths):
+    """Returns the row template and the header lines of a text table with
+    the given columns and widths. Layouts repeat, so they are cached.
+    """
+    cells = ' | '.join(f'{{{idx}:{column.align}{width}.{width}}}'
+                       for idx, (column, width) in enumerate(zip(columns, widths)))
+    template = f'| {cells} |\n'
+    header = template.replace(':>', ':^').replace(':<', ':^').format(
+        *(column.header for column in columns))
+    return template, header + '=' * (len(header) - 1) + '\n'
+
+
+class TableRenderer():
+    """Writes rows in one of FORMATS.
+
+    Parameters:
+        columns - tuple of TableColumn
+        max_width - widest a text table may be, or None for no limit
+        wrap - wrap cells that do not fit onto extra lines instead of
+            truncating them
+        widths - fixed column widths. With these the rows are written as
+            they are read, instead of being measured first.
+    """
+
+    FORMATS = ('text', 'markdown', 'csv', 'json')
+
+    def __init__(self, columns, max_width=None, wrap=False, widths=None):
+        self.columns = tuple(columns)
+        self.header_widths = [len(column.header) for column in self.columns]
+        self.max_width = max_width
+        self.wrap = wrap
+        self.widths = widths
+
+    def write(self, rows, out, table_format='text'):
+        """Writes rows to out in the given format."""
+        if table_format not in self.FORMATS:
+            raise ValueError(f'unknown table format {table_format!r}')
+        getattr(self, f'write_{table_format}')(rows, out)
+
+    def text_rows(self, rows):
+        """Yields each row as a tuple of cell strings."""
+        converters = [column.to_text for column in self.columns]
+        for row in rows:
+            yield tuple([convert(value) for convert, value in zip(converters, row)])
+
+    def text_columns(self, rows):
+        """Returns a list of cell strings per column, converted a column
+        at a time."""
+        columns = list(zip(*rows)) or [()] * len(self.columns)
+        return [list(map(column.to_text, values))
+                for column, values in zip(self.columns, columns)]
+
+    def measure(self, text_columns):
+        """Returns column widths fitting the headers and every cell."""
+        return [max(header_width, max(map(len, cells), default=0))
+                for header_width, cells in zip(self.header_widths, text_columns)]
+
+    def fit(self, widths):
+        """Narrows the widest columns so the table fits max_width.
+        No column is narrowed below its header.
+        """
+        # Each cell is padded by a space either side, plus one bar per column
+        # and one at the end.
+        overhead = 3 * len(widths) + 1
+        if self.max_width is None or sum(widths) + overhead <= self.max_width:
+            return widths
+        floors = [min(width, header_width)
+                  for width, header_width in zip(widths, self.header_widths)]
+        # Binary search for the largest cap on column width that fits.
+        low, high = 1, max(widths)
+        while low < high:
+            cap = (low + high + 1) // 2
+            total = sum(max(min(width, cap), floor) for width, floor in zip(widths, floors))
+            if total + overhead <= self.max_width:
+                low = cap
+            else:
+                high = cap - 1
+        return [max(min(width, low), floor) for width, floor in zip(widths, floors)]
+
+    def write_text(self, rows, out):
+        if self.widths is None:
+            text_columns = self.text_columns(rows)
+            measured = self.measure(text_columns)
+            widths = self.fit(measured)
+            text_rows = zip(*text_columns)
+            fits = widths == measured
+        else:
+            widths = self.widths
+            text_rows = self.text_rows(rows)
+            fits = False
+        template, header = compile_layout(self.columns, tuple(widths))
+        out.write(header)
+        if fits:
+            out.writelines(template.format(*cells) for cells in text_rows)
+            return
+        lines = self._wrapped(text_rows, widths) if self.wrap else self._truncated(text_rows, widths)
+        out.writelines(template.format(*cells) for row_lines in lines for cells in row_lines)
+
+    @staticmethod
+    def _truncated(text_rows, widths):
+        for cells in text_rows:
+            if any(len(cell) > width for cell, width in zip(cells, widths)):
+                cells = [cell if len(cell) <= width else cell[:width - 1] + '…'
+                         for cell, width in zip(cells, widths)]
+            yield (cells,)
+
+    @staticmethod
+    def _wrapped(text_rows, widths):
+        import textwrap
+        for cells in text_rows:
+            if all(len(cell) <= width for cell, width in zip(cells, widths)):
+                yield (cells,)
+                continue
+            parts = [textwrap.wrap(cell, width) or [''] for cell, width in zip(cells, widths)]
+            height = max(len(part) for part in parts)
+            yield [[part[line] if line < len(part) else '' for part in parts]
+                   for line in range(height)]
+
+    def write_markdown(self, rows, out):
+        aligns = {'<': ':---', '^': ':---:', '>': '---:'}
+        out.write('| ' + ' | '.join(column.header for column in self.columns) + ' |\n')
+        out.write('| ' + ' | '.join(aligns[column.align] for column in self.columns) + ' |\n')
+        out.writelines('| ' + ' | '.join(cell.replace('|', '\\|').replace('\n', ' ')
+                                         for cell in cells) + ' |\n'
+                       for cells in self.text_rows(rows))
+
+    def write_csv(self, rows, out):
+        import csv
+        writer = csv.writer(out)
+        writer.writerow([column.header for column in self.columns])
+        writer.writerows(self.text_rows(rows))
+
+    def write_json(self, rows, out):
+        """Writes a JSON array of objects keyed by column key, one per line."""
+        keys = [column.key for column in self.columns]
+        objects = (json.dumps(dict(zip(keys, row)), default=str) for row in rows)
+        first = next(objects, None)
+        if first is None:
+            out.write('[]\n')
+            return
+        out.write('[\n' + first)
+        out.writelines(',\n' + line for line in objects)
+        out.write('\n]\n')
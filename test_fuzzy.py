@@ -0,0 +1,69 @@
+"""NameIndex lookups on cookbooks where a common word is in most names."""
+import pytest
+
+from database import configure_database, db
+from fuzzy import NameIndex
+from import_recipes import import_recipes
+from recipes import Recipe
+
+
+def chicken_index():
+    """3000 chicken dishes, 3000 chicken soups and one of each plain."""
+    index = NameIndex()
+    index.load([(number, f'chicken dish {number}') for number in range(1, 3001)] +
+               [(3001, 'Chicken')] +
+               [(4000 + number, f'chicken soup {number}') for number in range(3000)] +
+               [(9000, 'Chicken  Soup')])
+    return index
+
+
+def test_exact_name_comes_first_among_common_words():
+    index = chicken_index()
+
+    assert index.search('chicken')[0] == (3001, 1.0)
+    assert index.search('CHICKEN soup')[0] == (9000, 1.0)
+    assert index.search(' chicken   SOUP ', limit=1) == [(9000, 1.0)]
+
+
+def test_closest_name_is_scored_when_candidates_are_capped():
+    index = chicken_index()
+
+    # No exact match, and far more candidates than are scored.
+    assert index.search('chiken')[0][0] == 3001
+    assert index.search('chiken soup')[0][0] == 9000
+    assert index.search('chiken soup') == index.search('chiken soup')
+
+
+def test_exact_names_follow_renames_and_removals():
+    index = chicken_index()
+
+    index.add(3001, 'Roast Chicken')
+    assert (3001, 1.0) not in index.search('chicken')
+    assert index.search('roast chicken')[0] == (3001, 1.0)
+    index.remove(3001)
+    assert 3001 not in [recipe_id for recipe_id, _ in index.search('roast chicken')]
+    index.add(3002, 'Chicken')
+    index.add(3003, 'chicken')
+    assert index.search('Chicken', limit=2) == [(3002, 1.0), (3003, 1.0)]
+    assert 'roast chicken' not in index.exact
+
+
+@pytest.fixture
+def cookbook(tmp_path):
+    configure_database(str(tmp_path / 'cookbook.db'))
+    Recipe.initialize()
+    Recipe.reset_name_index()
+    names = [f'chicken dish {number}' for number in range(1, 3001)] + ['Chicken']
+    report = import_recipes(
+        f'{{"name": "{name}", "ingredient_list": []}}' for name in names)
+    assert report.inserted == len(names), report.errors
+    yield
+    Recipe.reset_name_index()
+    db.close()
+
+
+def test_suggest_recipes_accepts_name_in_other_case(cookbook):
+    recipe = Recipe.suggest_recipes('CHICKEN')
+
+    assert recipe is not None
+    assert recipe.name == 'Chicken'
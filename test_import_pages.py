@@ -0,0 +1,215 @@
+"""End to end runs of import_pages against pages served on localhost.
+
+A ThreadingHTTPServer serves fixture pages: a recipe as JSON-LD, one as
+microdata, a page with no recipe and a page whose JSON-LD is cut short.
+The tests import them through the fetch threads and parse processes
+into a fresh database, then check what was saved and what was reported.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from database import configure_database, db
+from import_pages import import_pages, parse_page
+from recipes import Ingredient, Recipe
+
+
+JSON_LD_PAGE = '''<!DOCTYPE html>
+<html><head><title>Garlic Bread</title>
+<script type="application/ld+json">
+{"@context": "https://schema.org",
+ "@graph": [
+  {"@type": "WebPage", "name": "Garlic Bread | Example Kitchen"},
+  {"@type": "Recipe",
+   "name": "Garlic Bread",
+   "recipeIngredient": ["1 lb french bread, sliced in half",
+                        "4 cloves garlic, minced",
+                        "1/2 cup butter",
+                        "2 tbsp parsley (optional)"],
+   "prepTime": "PT5M",
+   "cookTime": "PT10M",
+   "recipeYield": "8 servings",
+   "recipeInstructions": [{"@type": "HowToStep", "text": "Mix the butter and garlic."},
+                          {"@type": "HowToStep", "text": "Spread and bake."}]}
+ ]}
+</script>
+</head><body><h1>Garlic Bread</h1></body></html>
+'''
+
+MICRODATA_PAGE = '''<!DOCTYPE html>
+<html><body>
+<article itemscope itemtype="https://schema.org/Recipe">
+  <h1 itemprop="name">Black Bean Enchiladas</h1>
+  <meta itemprop="prepTime" content="PT20M">
+  <meta itemprop="cookTime" content="PT1H">
+  <p>Serves <span itemprop="recipeYield">4</span></p>
+  <ul>
+    <li itemprop="recipeIngredient">2 cups black beans, rinsed
+    <li itemprop="recipeIngredient">8 corn tortillas
+    <li itemprop="recipeIngredient">1 red onion, diced
+  </ul>
+  <div itemprop="recipeInstructions">
+    <p>Fill the tortillas.</p>
+    <p>Bake until bubbling.</p>
+  </div>
+</article>
+</body></html>
+'''
+
+NO_RECIPE_PAGE = '''<!DOCTYPE html>
+<html><head><title>About us</title></head>
+<body><p>We have been cooking since 1998.</p></body></html>
+'''
+
+MALFORMED_PAGE = '''<!DOCTYPE html>
+<html><head>
+<script type="application/ld+json">
+{"@context": "https://schema.org", "@type": "Recipe", "name": "Lost Soup",
+ "recipeIngredient": ["1 carrot", "2 cups water"
+</script>
+</head><body><div><p>Lost Soup</body>
+'''
+
+PAGES = {
+    '/garlic-bread': JSON_LD_PAGE,
+    '/enchiladas': MICRODATA_PAGE,
+    '/about': NO_RECIPE_PAGE,
+    '/soup': MALFORMED_PAGE,
+}
+
+GARLIC_BREAD_INGREDIENTS = [
+    {'ingredient_name': 'french bread', 'ingredient_amount': '1',
+     'ingredient_units': 'lb', 'optional': False, 'prep': 'sliced in half'},
+    {'ingredient_name': 'garlic', 'ingredient_amount': '4',
+     'ingredient_units': 'cloves', 'optional': False, 'prep': 'minced'},
+    {'ingredient_name': 'butter', 'ingredient_amount': '1/2',
+     'ingredient_units': 'cup', 'optional': False, 'prep': ''},
+    {'ingredient_name': 'parsley', 'ingredient_amount': '2',
+     'ingredient_units': 'tbsp', 'optional': True, 'prep': ''},
+]
+
+ENCHILADAS_INGREDIENTS = [
+    {'ingredient_name': 'black beans', 'ingredient_amount': '2',
+     'ingredient_units': 'cups', 'optional': False, 'prep': 'rinsed'},
+    {'ingredient_name': 'corn tortillas', 'ingredient_amount': '8',
+     'ingredient_units': '', 'optional': False, 'prep': ''},
+    {'ingredient_name': 'red onion', 'ingredient_amount': '1',
+     'ingredient_units': '', 'optional': False, 'prep': 'diced'},
+]
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open, so the fetcher's reuse is exercised.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        page = PAGES.get(self.path)
+        body = (page or 'not found').encode('utf-8')
+        self.send_response(200 if page is not None else 404)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+
+@pytest.fixture(autouse=True)
+def cookbook(tmp_path):
+    configure_database(str(tmp_path / 'cookbook.db'))
+    Recipe.initialize()
+    yield
+    db.close()
+
+
+def saved_recipes():
+    """Returns the saved recipes by name, with their ingredient rows."""
+    recipes = {}
+    for recipe in Recipe.select().order_by(Recipe.id):
+        rows = (Ingredient
+                .select(Ingredient.name, Ingredient.normalized_name, Ingredient.amount,
+                        Ingredient.units, Ingredient.prep, Ingredient.optional)
+                .where(Ingredient.recipe == recipe.id)
+                .order_by(Ingredient.position)
+                .tuples())
+        recipes[recipe.name] = {
+            'ingredient_list': json.loads(recipe.ingredient_list),
+            'rows': list(rows),
+            'prep_seconds': recipe.prep_seconds,
+            'cook_seconds': recipe.cook_seconds,
+            'servings': recipe.servings,
+            'instructions': recipe.instructions,
+        }
+    return recipes
+
+
+def test_parse_page_extracts_ingredient_dicts():
+    _, (bread,) = parse_page('bread', JSON_LD_PAGE)
+    _, (enchiladas,) = parse_page('enchiladas', MICRODATA_PAGE)
+    assert bread['ingredient_list'] == GARLIC_BREAD_INGREDIENTS
+    assert enchiladas['ingredient_list'] == ENCHILADAS_INGREDIENTS
+    assert parse_page('about', NO_RECIPE_PAGE) == ('about', [])
+    assert parse_page('soup', MALFORMED_PAGE) == ('soup', [])
+
+
+@pytest.mark.parametrize('parse_workers', [0, 2])
+def test_import_pages_saves_recipes_and_reports_errors(server, parse_workers):
+    urls = [server + path for path in ('/garlic-bread', '/enchiladas', '/about', '/soup',
+                                       '/missing')]
+
+    report = import_pages(urls, fetch_workers=4, parse_workers=parse_workers, batch_size=1)
+
+    result = report.as_dict()
+    assert (result['read'], result['inserted'], result['updated'], result['invalid']) == \
+        (5, 2, 0, 3)
+    assert sorted(result['errors']) == sorted([
+        f'{server}/about: no schema.org Recipe found',
+        f'{server}/soup: no schema.org Recipe found',
+        f'{server}/missing: HTTP 404 Not Found',
+    ])
+
+    recipes = saved_recipes()
+    assert sorted(recipes) == ['Black Bean Enchiladas', 'Garlic Bread']
+
+    bread = recipes['Garlic Bread']
+    assert bread['ingredient_list'] == GARLIC_BREAD_INGREDIENTS
+    assert bread['rows'] == [
+        ('french bread', 'french bread', '1', 'lb', 'sliced in half', False),
+        ('garlic', 'garlic', '4', 'cloves', 'minced', False),
+        ('butter', 'butter', '1/2', 'cup', '', False),
+        ('parsley', 'parsley', '2', 'tbsp', '', True),
+    ]
+    assert (bread['prep_seconds'], bread['cook_seconds'], bread['servings']) == (300, 600, 8)
+    assert bread['instructions'] == 'Mix the butter and garlic.\nSpread and bake.'
+
+    enchiladas = recipes['Black Bean Enchiladas']
+    assert enchiladas['ingredient_list'] == ENCHILADAS_INGREDIENTS
+    assert [row[1] for row in enchiladas['rows']] == ['black beans', 'corn tortillas',
+                                                      'red onion']
+    assert (enchiladas['prep_seconds'], enchiladas['cook_seconds'], enchiladas['servings']) == \
+        (1200, 3600, 4)
+    assert enchiladas['instructions'] == 'Fill the tortillas.\nBake until bubbling.'
+
+
+def test_import_pages_again_updates_recipes(server):
+    urls = [server + '/garlic-bread', server + '/enchiladas']
+    import_pages(urls, fetch_workers=2, parse_workers=0)
+
+    report = import_pages(urls, fetch_workers=2, parse_workers=0)
+
+    assert (report.read, report.inserted, report.updated, report.invalid) == (2, 0, 2, 0)
+    assert sorted(saved_recipes()) == ['Black Bean Enchiladas', 'Garlic Bread']
@@ -0,0 +1,140 @@
+"""Query plans of RecipeFilter's combined filters.
+
+Builds a cookbook where each condition matches a known share of the
+recipes, then checks which index plan() drives the query with and that
+SQLite's EXPLAIN QUERY PLAN never reads the whole recipes table.
+"""
+import json
+import re
+
+import pytest
+
+from database import configure_database, db
+from import_recipes import import_recipes
+from recipes import Recipe, RecipeFilter
+
+
+RECIPE_COUNT = 3000
+
+
+def recipe_line(number):
+    """Every recipe uses salt, one in 10 red onion and one in 300 saffron.
+    One in 500 is a paella, the rest are stews. Prep takes 5 to 30
+    minutes and cooking 10 to 60."""
+    ingredients = ['salt', 'olive oil']
+    if number % 10 == 0:
+        ingredients.append('red onion')
+    if number % 300 == 0:
+        ingredients.append('saffron threads')
+    dish = 'paella' if number % 500 == 0 else 'stew'
+    return json.dumps({
+        'name': f'{dish} {number}',
+        'ingredient_list': [{'ingredient_name': name, 'ingredient_amount': '1',
+                             'ingredient_units': 'tsp', 'optional': False, 'prep': ''}
+                            for name in ingredients],
+        'prep_time': f'{(number % 6 + 1) * 5} mins',
+        'cook_time': f'{(number % 6 + 1) * 10} mins',
+    })
+
+
+@pytest.fixture(scope='module', autouse=True)
+def cookbook(tmp_path_factory):
+    configure_database(str(tmp_path_factory.mktemp('filter') / 'cookbook.db'))
+    Recipe.initialize()
+    report = import_recipes(recipe_line(number) for number in range(1, RECIPE_COUNT + 1))
+    assert report.inserted == RECIPE_COUNT, report.errors
+    yield
+    db.close()
+
+
+def plan_lines(recipe_filter):
+    """Returns the EXPLAIN QUERY PLAN lines of the filter's query, with
+    peewee's table aliases (t1, t2, ...) replaced by the table names."""
+    sql, params = recipe_filter.query().sql()
+    aliases = {alias: table for table, alias in re.findall(r'"(\w+)" AS "(t\d+)"', sql)}
+    return [re.sub(r'\bt\d+\b', lambda match: aliases.get(match.group(), match.group()), row[3])
+            for row in db.execute_sql(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+
+def assert_no_recipes_scan(lines):
+    scans = [line for line in lines
+             if re.match(r'SCAN recipes\b', line) and 'USING INDEX' not in line
+             and 'USING COVERING INDEX' not in line]
+    assert scans == [], lines
+
+
+def matching_ids(recipe_filter):
+    return [row.id for row in recipe_filter.query()]
+
+
+def test_time_bounds_only():
+    recipe_filter = RecipeFilter(max_prep=15 * 60, max_total=30 * 60)
+    driver, _ = recipe_filter.plan()
+    lines = plan_lines(recipe_filter)
+
+    assert driver == ('duration', 'total_seconds')
+    assert_no_recipes_scan(lines)
+    assert any('USING COVERING INDEX recipe_total_seconds (total_seconds<?)' in line
+               for line in lines), lines
+    # 5 to 10 minutes of prep and 10 to 20 of cooking.
+    assert matching_ids(recipe_filter) == [
+        number for number in range(1, RECIPE_COUNT + 1) if number % 6 in (0, 1)]
+
+
+def test_ingredient_include_and_exclude():
+    recipe_filter = RecipeFilter(include=['saffron'], exclude=['onion'])
+    driver, _ = recipe_filter.plan()
+    lines = plan_lines(recipe_filter)
+
+    assert driver == ('ingredient', 'saffron')
+    assert_no_recipes_scan(lines)
+    assert any(line.startswith('SCAN ingredient_search VIRTUAL TABLE') for line in lines), lines
+    # The exclusion is checked on each matching recipe's own ingredients.
+    assert any('USING INDEX ingredient_recipe_id_position (recipe_id=?)' in line
+               for line in lines), lines
+    assert matching_ids(recipe_filter) == [
+        number for number in range(300, RECIPE_COUNT + 1, 300) if number % 10]
+
+
+def test_short_ingredient_uses_name_index():
+    # Too short for the trigram index, so matched as a prefix.
+    recipe_filter = RecipeFilter(include=['sa'], exclude=['re'])
+    driver, _ = recipe_filter.plan()
+    lines = plan_lines(recipe_filter)
+
+    assert driver == ('ingredient', 'sa')
+    assert_no_recipes_scan(lines)
+    assert any('USING INDEX ingredient_normalized_name (normalized_name>? AND normalized_name<?)'
+               in line for line in lines), lines
+    assert matching_ids(recipe_filter) == [
+        number for number in range(1, RECIPE_COUNT + 1) if number % 10]
+
+
+def test_name_search():
+    recipe_filter = RecipeFilter(name='paella')
+    driver, _ = recipe_filter.plan()
+    lines = plan_lines(recipe_filter)
+
+    assert driver == ('name', '"paella"*')
+    assert_no_recipes_scan(lines)
+    assert any(line.startswith('SCAN recipe_search VIRTUAL TABLE') for line in lines), lines
+    assert matching_ids(recipe_filter) == list(range(500, RECIPE_COUNT + 1, 500))
+
+
+def test_time_ingredients_and_name_together():
+    recipe_filter = RecipeFilter(include=['saffron', 'salt'], exclude=['onion'], name='stew',
+                                 max_total=45 * 60)
+    driver, estimates = recipe_filter.plan()
+    lines = plan_lines(recipe_filter)
+
+    assert driver == ('ingredient', 'saffron')
+    assert estimates[driver] == RECIPE_COUNT // 300
+    assert_no_recipes_scan(lines)
+    assert any(line.startswith('SCAN ingredient_search VIRTUAL TABLE') for line in lines), lines
+    assert any('USING INTEGER PRIMARY KEY (rowid=?)' in line
+               and line.startswith('SEARCH recipes') for line in lines), lines
+    # The conditions that do not drive the query are not looked up.
+    assert not any('recipe_total_seconds' in line for line in lines), lines
+    assert matching_ids(recipe_filter) == [
+        number for number in range(300, RECIPE_COUNT + 1, 300)
+        if number % 10 and number % 500 and number % 6 in (0, 1, 2)]